@@ -3,10 +3,14 @@ from pydantic import BaseModel
 from contextlib import asynccontextmanager
 from fastmcp import Client
 import json
-import requests
 import re
 import logging
 
+from ollama_client import OllamaError
+from ollama_pool import close_ollama_pool, get_ollama_pool
+from structured_output import extract_json_object
+from config import ROUTING_NUM_PREDICT
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -35,20 +39,13 @@ class BotRequest(BaseModel):
 TOOLS_SCHEMA = {}
 
 # Функция для вызова Ollama
-def call_ollama(prompt: str) -> str:
+async def call_ollama(prompt: str, **params) -> str:
     """Вызывает локальную модель Ollama для анализа запроса"""
     try:
-        response = requests.post(
-            "http://localhost:11434/api/generate",
-            json={
-                "model": "llama3",  # Укажите вашу модель, например, llama3
-                "prompt": prompt,
-                "stream": False
-            }
-        )
-        response.raise_for_status()
-        return response.json()["response"]
-    except requests.RequestException as e:
+        # Модель задаётся в config.py (OLLAMA_MODEL)
+        data = await get_ollama_pool().generate(prompt, **params)
+        return data["response"]
+    except OllamaError as e:
         raise HTTPException(status_code=500, detail=f"Ollama error: {str(e)}")
 
 # Инициализация MCP-клиента и получение схем инструментов
@@ -69,6 +66,8 @@ async def lifespan(app: FastAPI):
     yield
 
 app.lifespan = lifespan
+# Закрываем общий пул соединений к Ollama при остановке сервиса
+app.router.on_shutdown.append(close_ollama_pool)
 
 # Эндпоинт для обработки запросов от Telegram-бота
 @app.post("/process")
@@ -130,17 +129,19 @@ async def process_request(bot_request: BotRequest):
     ```
     """
 
-    # Вызов Ollama для анализа запроса
-    ollama_response = call_ollama(prompt)
+    # Вызов Ollama для анализа запроса: format="json" не даёт модели писать текст вокруг JSON
+    ollama_response = await call_ollama(prompt, format="json", options={"num_predict": ROUTING_NUM_PREDICT})
     logger.info(f"Ollama response: {ollama_response}")
 
     try:
-        # Парсинг последнего JSON-блока
-        matches = list(re.finditer(r'```json\s*(.*?)\s*```', ollama_response, re.DOTALL))
-        if not matches:
-            raise ValueError("Ollama did not return valid JSON")
-        # Берем последний JSON-блок
-        decision = json.loads(matches[-1].group(1))
+        decision = extract_json_object(ollama_response)
+        if decision is None:
+            # Парсинг последнего JSON-блока
+            matches = list(re.finditer(r'```json\s*(.*?)\s*```', ollama_response, re.DOTALL))
+            if not matches:
+                raise ValueError("Ollama did not return valid JSON")
+            # Берем последний JSON-блок
+            decision = json.loads(matches[-1].group(1))
         logger.info(f"Parsed decision: {decision}")
     except (ValueError, json.JSONDecodeError) as e:
         logger.error(f"Error parsing Ollama response: {str(e)}")
@@ -0,0 +1,619 @@
+# benchmark.py
+#
+# Нагрузочный тест mcp_agent_core.app без настоящих llama3 и OpenProject:
+# поддельная Ollama с настраиваемой задержкой и скоростью генерации, MCP-серверы
+# (по образцу math_server, rag_query, time_server) в том же процессе.
+#
+#   python benchmark.py --requests 200 --concurrency 8 --output bench.json
+#   python benchmark.py --stream --payload-bytes 200000 --payload-kind json --compare bench.json
+#   python benchmark.py --replay agent_cassette.jsonl.gz --replay-speed 0
+#
+# --replay прогоняет записанные запросы (CASSETTE_MODE = "record") через текущую сборку агента:
+# Ollama и MCP отвечают из кассеты, сравниваются время ответа и выбор инструментов.
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import re
+import subprocess
+import time
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import aiohttp
+from aiohttp import web
+from fastmcp import FastMCP
+
+import config
+from metrics import REQUEST_ID_HEADER
+
+logger = logging.getLogger("Benchmark")
+
+# Запрос пользователя -> решение, которое вернёт поддельная Ollama на этапе выбора инструмента
+SCENARIOS = [
+    ("Сложи числа 3 и 4", {"function": "add_numbers", "args": {"a": 3, "b": 4}}),
+    ("Который сейчас час", {"function": "get_current_time", "args": {}}),
+    ("Кто участники проекта", {"function": "information_about_project_participants", "args": {}}),
+    ("Покажи задачи проекта", {"function": "list_project_tasks", "args": {}}),
+]
+
+# Инструмент с ответом размера --payload-bytes: его результат сжимается и пересказывается LLM
+# (ответ information_about_project_participants короткий — сжатие больших результатов на нём не нагружается)
+PAYLOAD_TOOL = "list_project_tasks"
+PAYLOAD_TOOL_POLICY = {"response_mode": "llm_summarize", "drop_fields": ["_links"], "side_effect_free": True}
+
+PARTICIPANTS = "Руководитель, архитектор и разработчик - Ваганов Алексей, Аналитик - Дмитрий Гришаев, разработчик Дмитрий Акинфиев"
+
+USER_PART_RE = re.compile(r"Запрос пользователя: (.*)")
+
+
+# === Поддельная Ollama ===
+
+class FakeOllama:
+    """
+    /api/generate и /api/chat с задержкой prefill и заданной скоростью генерации.
+    Одновременно генерируется не больше parallel ответов — как OLLAMA_NUM_PARALLEL.
+    Первый запрос к модели ждёт её загрузки (load_latency); пустой промпт только загружает модель
+    """
+
+    def __init__(self, prefill_latency: float, token_rate: float, reply_tokens: int, parallel: int,
+                 load_latency: float = 0.0):
+        self.prefill_latency = prefill_latency
+        self.token_rate = token_rate
+        self.reply_tokens = reply_tokens
+        self.load_latency = load_latency
+        self.slots = asyncio.Semaphore(parallel)
+        self.loaded: Dict[str, asyncio.Task] = {}
+        self.requests = 0
+
+    def reply_text(self, body: Dict[str, Any]) -> str:
+        text = body.get("prompt", "") + json.dumps(body.get("messages", ""), ensure_ascii=False)
+        # Выбор инструмента и извлечение аргументов для уже выбранного инструмента
+        if "Доступные инструменты" in text or "Аргументы инструмента" in text:
+            match = USER_PART_RE.search(text.replace("\\n", "\n"))
+            user_input = match.group(1) if match else ""
+            for query, decision in SCENARIOS:
+                if user_input.startswith(query):
+                    return json.dumps(decision, ensure_ascii=False)
+            return json.dumps(SCENARIOS[-1][1], ensure_ascii=False)
+        return " ".join(["Ответ"] + ["данные"] * (self.reply_tokens - 1))
+
+    @staticmethod
+    def tokens(text: str) -> List[str]:
+        return [text[i:i + 4] for i in range(0, len(text), 4)]
+
+    async def load(self, model: str) -> float:
+        """Загружает модель (один раз); возвращает, сколько запрос ждал загрузки"""
+        started = time.perf_counter()
+        if model not in self.loaded:
+            self.loaded[model] = asyncio.ensure_future(asyncio.sleep(self.load_latency))
+        await self.loaded[model]
+        return time.perf_counter() - started
+
+    def final_chunk(self, body: Dict[str, Any], tokens: int, started: float,
+                    load_seconds: float = 0.0) -> Dict[str, Any]:
+        return {
+            "model": body.get("model"), "response": "", "done": True,
+            "load_duration": int(load_seconds * 1e9),
+            "prompt_eval_count": 100, "prompt_eval_duration": int(self.prefill_latency * 1e9),
+            "eval_count": tokens, "eval_duration": int(tokens / self.token_rate * 1e9),
+            "total_duration": int((time.perf_counter() - started) * 1e9),
+        }
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.requests += 1
+        chat = request.path.endswith("/chat")
+        tokens = self.tokens(self.reply_text(body))
+        started = time.perf_counter()
+        load_seconds = await self.load(body.get("model", ""))
+        if not chat and not body.get("prompt"):
+            return web.json_response(self.final_chunk(body, 0, started, load_seconds))
+
+        async with self.slots:
+            await asyncio.sleep(self.prefill_latency)
+            if not body.get("stream", True):
+                await asyncio.sleep(len(tokens) / self.token_rate)
+                data = self.final_chunk(body, len(tokens), started, load_seconds)
+                text = "".join(tokens)
+                data["response"] = text
+                if chat:
+                    data["message"] = {"role": "assistant", "content": text}
+                return web.json_response(data)
+
+            response = web.StreamResponse()
+            response.content_type = "application/x-ndjson"
+            await response.prepare(request)
+            try:
+                for token in tokens:
+                    chunk = {"model": body.get("model"), "done": False}
+                    if chat:
+                        chunk["message"] = {"role": "assistant", "content": token}
+                    else:
+                        chunk["response"] = token
+                    await response.write((json.dumps(chunk, ensure_ascii=False) + "\n").encode())
+                    await asyncio.sleep(1 / self.token_rate)
+                final = self.final_chunk(body, len(tokens), started, load_seconds)
+                await response.write((json.dumps(final) + "\n").encode())
+            except (ConnectionResetError, asyncio.CancelledError):
+                # Агент оборвал генерацию (ранняя остановка) — слот освобождается сразу
+                pass
+            return response
+
+    async def handle_ps(self, request: web.Request) -> web.Response:
+        return web.json_response({"models": [
+            {"name": model if ":" in model else f"{model}:latest"} for model in self.loaded
+        ]})
+
+    async def start(self, port: int) -> web.AppRunner:
+        app = web.Application()
+        app.router.add_post("/api/generate", self.handle)
+        app.router.add_post("/api/chat", self.handle)
+        app.router.add_get("/api/ps", self.handle_ps)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        return runner
+
+
+# === MCP-серверы в том же процессе ===
+
+def build_payload(size: int, kind: str) -> str:
+    """Результат PAYLOAD_TOOL заданного размера: текст или JSON-список записей"""
+    if kind == "json":
+        records, length, i = [], 2, 0
+        while length < size:
+            record = {"id": i, "subject": f"Задача {i}", "assignee": "Ваганов Алексей",
+                      "status": "В работе", "_links": {"self": {"href": f"/api/v3/work_packages/{i}"}}}
+            records.append(record)
+            length += len(json.dumps(record, ensure_ascii=False)) + 1
+            i += 1
+        return json.dumps(records, ensure_ascii=False)
+    repeats = max(1, size // (len(PARTICIPANTS) + 1))
+    return "\n".join([PARTICIPANTS] * repeats)
+
+
+def build_mcp_servers(payload: str, tool_latency: float) -> Dict[str, FastMCP]:
+    math = FastMCP("Math Server")
+
+    @math.tool(name="add_numbers", description="Если необходимо сложить два числа")
+    async def add_numbers(a: float, b: float) -> float:
+        await asyncio.sleep(tool_latency)
+        return a + b
+
+    rag = FastMCP("information about project participants")
+
+    @rag.tool(name="information_about_project_participants", description="Отвечает на вопросы об участниках проекта")
+    async def rag_query() -> str:
+        await asyncio.sleep(tool_latency)
+        return PARTICIPANTS
+
+    @rag.tool(name=PAYLOAD_TOOL, description="Возвращает список задач проекта")
+    async def list_project_tasks() -> str:
+        await asyncio.sleep(tool_latency)
+        return payload
+
+    clock = FastMCP("Time Server")
+
+    @clock.tool(name="get_current_time", description="Возвращает текущее время в формате ISO")
+    async def get_current_time() -> str:
+        await asyncio.sleep(tool_latency)
+        return datetime.now().isoformat()
+
+    return {"math": math, "rag_query": rag, "time": clock}
+
+
+async def serve_app(app: Any, port: int) -> Tuple[Any, asyncio.Task]:
+    """ASGI-приложение под uvicorn в текущем event loop; остановка — server.should_exit"""
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", access_log=False))
+    task = asyncio.create_task(server.serve())
+    await wait_for_port(port)
+    return server, task
+
+
+async def wait_for_port(port: int, timeout: float = 15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"Port {port} did not open in {timeout} s")
+
+
+# === Нагрузка и отчёт ===
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    low, high = int(k), min(int(k) + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (k - low)
+
+
+def latency_summary(values: List[float]) -> Dict[str, float]:
+    return {
+        "p50": round(percentile(values, 50), 3),
+        "p95": round(percentile(values, 95), 3),
+        "p99": round(percentile(values, 99), 3),
+        "mean": round(sum(values) / len(values), 3) if values else 0.0,
+        "max": round(max(values), 3) if values else 0.0,
+    }
+
+
+METRIC_LINE_RE = re.compile(r'^(agent_\w+?)_(sum|count)\{(.*)\} (\S+)$')
+
+
+def parse_metrics(text: str) -> Dict[Tuple[str, str], List[float]]:
+    """Суммы и количества гистограмм из /metrics: (метрика, метки) -> [sum, count]"""
+    series: Dict[Tuple[str, str], List[float]] = {}
+    for line in text.splitlines():
+        match = METRIC_LINE_RE.match(line)
+        if not match:
+            continue
+        name, kind, labels, value = match.groups()
+        entry = series.setdefault((name, labels), [0.0, 0.0])
+        entry[0 if kind == "sum" else 1] = float(value)
+    return series
+
+
+def stage_breakdown(before: str, after: str) -> Dict[str, Dict[str, Dict[str, float]]]:
+    """Среднее время стадий за прогон: разность гистограмм /metrics до и после"""
+    start, end = parse_metrics(before), parse_metrics(after)
+    result: Dict[str, Dict[str, Dict[str, float]]] = {}
+    for (name, labels), (total, count) in end.items():
+        prev_total, prev_count = start.get((name, labels), [0.0, 0.0])
+        count -= prev_count
+        if count <= 0:
+            continue
+        result.setdefault(name, {})[labels.replace('"', "")] = {
+            "count": int(count),
+            "mean_ms": round(1000 * (total - prev_total) / count, 3),
+        }
+    return result
+
+
+async def sse_lines(response: aiohttp.ClientResponse) -> AsyncIterator[str]:
+    """
+    Строки SSE-ответа. Режем их сами, как ollama_client._post_stream: событие done с большим
+    результатом инструмента длиннее лимита строки StreamReader (LineTooLong)
+    """
+    buffer = b""
+    async for data in response.content.iter_any():
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8").strip()
+    if buffer:
+        yield buffer.decode("utf-8").strip()
+
+
+async def send_query(session: aiohttp.ClientSession, url: str, query: str,
+                     stream: bool) -> Tuple[int, float, Optional[float]]:
+    """(HTTP-статус, время ответа, время до первого токена) в миллисекундах"""
+    started = time.perf_counter()
+    first_token = None
+    async with session.post(url, json={"user_input": query}) as response:
+        if stream:
+            async for line in sse_lines(response):
+                if first_token is None and line.startswith("event: token"):
+                    first_token = 1000 * (time.perf_counter() - started)
+        else:
+            await response.read()
+        return response.status, 1000 * (time.perf_counter() - started), first_token
+
+
+async def run_load(base_url: str, args: argparse.Namespace) -> Dict[str, Any]:
+    url = f"{base_url}/query/stream" if args.stream else f"{base_url}/query"
+    queue: asyncio.Queue = asyncio.Queue()
+    rng = random.Random(args.seed)
+    for i in range(args.requests):
+        query = rng.choice(SCENARIOS)[0]
+        queue.put_nowait(f"{query} #{i}" if args.unique_queries else query)
+
+    latencies: List[float] = []
+    first_tokens: List[float] = []
+    statuses: Dict[str, int] = {}
+
+    async def worker(session: aiohttp.ClientSession):
+        while not queue.empty():
+            query = queue.get_nowait()
+            try:
+                status, latency, first_token = await send_query(session, url, query, args.stream)
+            except aiohttp.ClientError as e:
+                logger.warning(f"Request failed: {e}")
+                status, latency, first_token = 0, None, None
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            if status == 200:
+                latencies.append(latency)
+                if first_token is not None:
+                    first_tokens.append(first_token)
+
+    timeout = aiohttp.ClientTimeout(total=args.request_timeout)
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(session) for _ in range(args.concurrency)))
+        duration = time.perf_counter() - started
+
+    summary = {
+        "requests": args.requests,
+        "ok": len(latencies),
+        "statuses": statuses,
+        "duration_s": round(duration, 3),
+        "rps": round(len(latencies) / duration, 3) if duration else 0.0,
+        "latency_ms": latency_summary(latencies),
+    }
+    if args.stream:
+        summary["first_token_ms"] = latency_summary(first_tokens)
+    return summary
+
+
+def routing_decision(response: Dict[str, Any]) -> List[str]:
+    """Выбранные инструменты и аргументы ответа агента — для сравнения прогонов"""
+    calls = response.get("calls") or [response]
+    return [f"{call.get('tool_name')}({json.dumps(call.get('args') or {}, sort_keys=True, ensure_ascii=False)})"
+            for call in calls]
+
+
+async def send_recorded_query(session: aiohttp.ClientSession, base_url: str,
+                              query: Dict[str, Any]) -> Tuple[int, float, Optional[Dict[str, Any]]]:
+    """Записанный запрос с его X-Request-ID (по нему ищутся ответы в кассете): статус, время, ответ"""
+    started = time.perf_counter()
+    headers = {REQUEST_ID_HEADER: query["request_id"]}
+    async with session.post(f"{base_url}{query['endpoint']}", json={"user_input": query["user_input"]},
+                            headers=headers) as response:
+        result = None
+        if query["endpoint"].endswith("/stream"):
+            event = None
+            async for line in sse_lines(response):
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                elif line.startswith("data: ") and event == "done":
+                    result = json.loads(line[len("data: "):])
+        elif response.status == 200:
+            result = await response.json()
+        return response.status, 1000 * (time.perf_counter() - started), result
+
+
+async def run_replay(base_url: str, queries: List[Dict[str, Any]], args: argparse.Namespace) -> Dict[str, Any]:
+    queue: asyncio.Queue = asyncio.Queue()
+    for query in queries:
+        queue.put_nowait(query)
+
+    latencies: List[float] = []
+    recorded: List[float] = []
+    statuses: Dict[str, int] = {}
+    changes: List[Dict[str, Any]] = []
+    same = 0
+
+    async def worker(session: aiohttp.ClientSession):
+        nonlocal same
+        while not queue.empty():
+            query = queue.get_nowait()
+            try:
+                status, latency, result = await send_recorded_query(session, base_url, query)
+            except aiohttp.ClientError as e:
+                logger.warning(f"Request failed: {e}")
+                status, latency, result = 0, None, None
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            if status != 200 or result is None:
+                continue
+            latencies.append(latency)
+            recorded.append(query["duration_ms"])
+            before, after = routing_decision(query["response"]), routing_decision(result)
+            if before == after:
+                same += 1
+            else:
+                changes.append({"request_id": query["request_id"], "user_input": query["user_input"],
+                                "recorded": before, "replayed": after})
+
+    timeout = aiohttp.ClientTimeout(total=args.request_timeout)
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(session) for _ in range(args.concurrency)))
+        duration = time.perf_counter() - started
+
+    return {
+        "requests": len(queries),
+        "ok": len(latencies),
+        "statuses": statuses,
+        "duration_s": round(duration, 3),
+        "rps": round(len(latencies) / duration, 3) if duration else 0.0,
+        "latency_ms": latency_summary(latencies),
+        "recorded_latency_ms": latency_summary(recorded),
+        "routing": {"same": same, "changed": len(changes), "changes": changes[:50]},
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous: Dict[str, Any], current: Dict[str, Any], max_regression: float) -> bool:
+    """Печатает сравнение с прошлым прогоном. False — есть регрессия больше max_regression"""
+    ok = True
+    rows = [("rps", previous["summary"]["rps"], current["summary"]["rps"], False)]
+    for key in ("p50", "p95", "p99"):
+        rows.append((f"latency {key}, ms", previous["summary"]["latency_ms"][key],
+                     current["summary"]["latency_ms"][key], True))
+    print(f"\nСравнение с прогоном {previous.get('git_commit')} ({previous.get('timestamp')}):")
+    for name, old, new, lower_is_better in rows:
+        change = (new - old) / old if old else 0.0
+        regression = change > max_regression if lower_is_better else change < -max_regression
+        ok = ok and not regression
+        mark = "  РЕГРЕССИЯ" if regression else ""
+        print(f"  {name:<18} {old:>10.3f} -> {new:>10.3f} ({change:+.1%}){mark}")
+    return ok
+
+
+async def main(args: argparse.Namespace) -> Dict[str, Any]:
+    ports = {"ollama": args.base_port, "agent": args.base_port + 1,
+             "math": args.base_port + 2, "rag_query": args.base_port + 3, "time": args.base_port + 4}
+    # Остальные хосты Ollama — на портах после пяти основных
+    ollama_ports = [ports["ollama"]] + [args.base_port + 5 + i for i in range(args.ollama_hosts - 1)]
+
+    # Конфигурация подменяется до импорта агента: он читает её при импорте
+    config.TOOL_POLICIES[PAYLOAD_TOOL] = PAYLOAD_TOOL_POLICY
+    if args.replay:
+        # Серверы MCP — как при записи (их инструменты в кассете), Ollama и MCP не нужны
+        from cassette import CassettePlayer, load_cassette
+
+        entries = load_cassette(args.replay)
+        queries = [entry for entry in entries if entry.get("type") == "query"]
+        config.MCP_SERVERS_CONFIG = CassettePlayer(entries, 0).servers_config or config.MCP_SERVERS_CONFIG
+        config.CASSETTE_MODE = "replay"
+        config.CASSETTE_PATH = args.replay
+        config.CASSETTE_REPLAY_SPEED = args.replay_speed
+    else:
+        config.OLLAMA_BASE_URL = f"http://127.0.0.1:{ports['ollama']}"
+        config.OLLAMA_API_URL = f"{config.OLLAMA_BASE_URL}/api/generate"
+        config.OLLAMA_HOSTS = [f"http://127.0.0.1:{port}" for port in ollama_ports]
+        config.MCP_SERVERS_CONFIG = {
+            name: {"url": f"http://127.0.0.1:{ports[name]}/mcp", "transport": "streamable-http"}
+            for name in ("math", "rag_query", "time")
+        }
+        if args.record:
+            config.CASSETTE_MODE = "record"
+            config.CASSETTE_PATH = args.record
+    config.RESPONSE_CACHE_ENABLED = args.cache
+    config.TOOL_ROUTER_ENABLED = not args.no_fast_path
+    config.LOG_LEVEL = args.log_level
+    config.TRACE_SAMPLE_RATE = 0.0
+    config.MCP_TOOLS_SNAPSHOT_PATH = None
+    config.LLM_MAX_CONCURRENCY = args.llm_parallel * args.ollama_hosts
+    config.LLM_MAX_QUEUE = max(config.LLM_MAX_QUEUE, args.concurrency * 2)
+
+    fake_ollamas = [
+        FakeOllama(args.prefill_latency, args.token_rate, args.reply_tokens, args.llm_parallel, args.model_load_latency)
+        for _ in ollama_ports
+    ]
+    ollama_runners = []
+    servers = []
+    if not args.replay:
+        ollama_runners = [await fake.start(port) for fake, port in zip(fake_ollamas, ollama_ports)]
+        payload = build_payload(args.payload_bytes, args.payload_kind)
+        servers = [
+            await serve_app(mcp.http_app(transport="streamable-http"), ports[name])
+            for name, mcp in build_mcp_servers(payload, args.tool_latency).items()
+        ]
+
+    import mcp_agent_core
+
+    servers.append(await serve_app(mcp_agent_core.app, ports["agent"]))
+    base_url = f"http://127.0.0.1:{ports['agent']}"
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            # Прогрев: сессии MCP, соединения с Ollama, префиксы промпта
+            # (при воспроизведении прогрева нет: в кассете только записанные запросы)
+            for query, _ in ([] if args.replay else SCENARIOS):
+                await send_query(session, f"{base_url}/query", f"{query} прогрев", False)
+            async with session.get(f"{base_url}/metrics") as response:
+                metrics_before = await response.text()
+
+        if args.replay:
+            print(f"Воспроизведение: {len(queries)} записанных запросов из {args.replay}, "
+                  f"{args.concurrency} одновременно, скорость {args.replay_speed}")
+            summary = await run_replay(base_url, queries, args)
+        else:
+            print(f"Нагрузка: {args.requests} запросов, {args.concurrency} одновременно, "
+                  f"{'/query/stream' if args.stream else '/query'}")
+            summary = await run_load(base_url, args)
+
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"{base_url}/metrics") as response:
+                metrics_after = await response.text()
+            async with session.get(f"{base_url}/stats") as response:
+                agent_stats = await response.json()
+    finally:
+        # Сначала агент (закрывает сессии MCP), потом MCP-серверы
+        for server, task in reversed(servers):
+            server.should_exit = True
+            await task
+        for runner in ollama_runners:
+            await runner.cleanup()
+
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "params": vars(args),
+        "summary": summary,
+        "stages": stage_breakdown(metrics_before, metrics_after),
+        "fake_ollama_requests": [fake.requests for fake in fake_ollamas],
+        "agent_stats": agent_stats,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест MCP-агента с поддельными Ollama и MCP-серверами")
+    parser.add_argument("--requests", type=int, default=100, help="сколько запросов отправить")
+    parser.add_argument("--concurrency", type=int, default=4, help="сколько запросов одновременно")
+    parser.add_argument("--stream", action="store_true", help="нагружать /query/stream вместо /query")
+    parser.add_argument("--prefill-latency", type=float, default=0.2, help="задержка prefill Ollama, сек")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="скорость генерации Ollama, токенов/сек")
+    parser.add_argument("--reply-tokens", type=int, default=40, help="длина итогового ответа, токенов")
+    parser.add_argument("--llm-parallel", type=int, default=1, help="сколько генераций Ollama идёт одновременно")
+    parser.add_argument("--ollama-hosts", type=int, default=1, help="сколько поддельных хостов Ollama запустить")
+    parser.add_argument("--model-load-latency", type=float, default=0.0,
+                        help="время загрузки модели поддельной Ollama при первом запросе, сек")
+    parser.add_argument("--tool-latency", type=float, default=0.01, help="задержка инструментов MCP, сек")
+    parser.add_argument("--payload-bytes", type=int, default=2000, help=f"размер ответа {PAYLOAD_TOOL}")
+    parser.add_argument("--payload-kind", choices=("text", "json"), default="text", help=f"вид ответа {PAYLOAD_TOOL}")
+    parser.add_argument("--cache", action="store_true", help="не выключать кэш ответов агента")
+    parser.add_argument("--unique-queries", action=argparse.BooleanOptionalAction, default=True,
+                        help="делать запросы уникальными (без кэша и объединения одинаковых)")
+    parser.add_argument("--no-fast-path", action="store_true", help="всегда выбирать инструмент через LLM")
+    parser.add_argument("--request-timeout", type=float, default=300.0, help="таймаут одного запроса, сек")
+    parser.add_argument("--base-port", type=int, default=18400, help="первый из портов стенда (пять + по одному на каждый хост Ollama после первого)")
+    parser.add_argument("--seed", type=int, default=0, help="seed выбора сценариев")
+    parser.add_argument("--log-level", default="WARNING", help="уровень логов агента")
+    parser.add_argument("--record", help="записать обращения к Ollama и MCP за прогон в кассету")
+    parser.add_argument("--replay", help="прогнать запросы из кассеты вместо синтетической нагрузки")
+    parser.add_argument("--replay-speed", type=float, default=1.0,
+                        help="скорость воспроизведения кассеты (0 — без задержек)")
+    parser.add_argument("--output", help="куда сохранить результаты (JSON)")
+    parser.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--max-regression", type=float, default=0.1,
+                        help="допустимое ухудшение при сравнении (0.1 — 10%%)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    results = asyncio.run(main(args))
+
+    summary = results["summary"]
+    print(json.dumps({key: value for key, value in summary.items() if key != "routing"}, ensure_ascii=False, indent=2))
+    for stage, value in sorted(results["stages"].get("agent_stage_duration_seconds", {}).items()):
+        print(f"  {stage:<40} {value['count']:>6}  {value['mean_ms']:>10.3f} ms")
+
+    routing = summary.get("routing")
+    if routing:
+        print(f"Выбор инструментов: совпал в {routing['same']}, изменился в {routing['changed']}")
+        for change in routing["changes"][:10]:
+            print(f"  {change['user_input']!r}: {change['recorded']} -> {change['replayed']}")
+
+    output = args.output or f"benchmark_{datetime.now():%Y%m%d_%H%M%S}.json"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены в {output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            previous = json.load(f)
+        if not compare(previous, results, args.max_regression):
+            raise SystemExit(1)
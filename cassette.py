@@ -0,0 +1,432 @@
+# cassette.py
+
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import time
+from collections import defaultdict
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import mcp.types
+from fastmcp.client.client import CallToolResult
+
+from metrics import current_request_id
+from ollama_client import OllamaError
+from tool_result_cache import canonical_args
+
+logger = logging.getLogger("Cassette")
+
+
+def _open(path: str, mode: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def _dumps(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def load_cassette(path: str) -> List[Dict[str, Any]]:
+    """Записи кассеты по порядку; оборванная последняя строка (сервис упал при записи) пропускается"""
+    entries = []
+    with _open(path, "r") as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                logger.warning(f"Skipping broken cassette line in {path}")
+    return entries
+
+
+def ollama_key(path: str, model: Optional[str], body: Dict[str, Any]) -> str:
+    """Ключ запроса к Ollama: хэш эндпоинта, модели и тела без признака стриминга"""
+    return hashlib.sha1(_dumps([path, model, body]).encode("utf-8")).hexdigest()
+
+
+def result_to_dict(result: Any) -> Dict[str, Any]:
+    """Результат call_tool в JSON; data сохраняется, только если она сама JSON"""
+    data = getattr(result, "data", None)
+    try:
+        json.dumps(data)
+    except (TypeError, ValueError):
+        data = None
+    return {
+        "content": [block.model_dump(mode="json", exclude_none=True) for block in getattr(result, "content", [])],
+        "structured_content": getattr(result, "structured_content", None),
+        "data": data,
+        "is_error": getattr(result, "is_error", False),
+    }
+
+
+def result_from_dict(value: Dict[str, Any]) -> CallToolResult:
+    content = mcp.types.CallToolResult.model_validate({"content": value["content"]}).content
+    return CallToolResult(
+        content=content, structured_content=value.get("structured_content"),
+        data=value.get("data"), is_error=value.get("is_error", False)
+    )
+
+
+class CassetteWriter:
+    """Дописывает записи в файл кассеты в фоне: запрос не ждёт диск"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+        # Статистика
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def append(self, entry: Dict[str, Any]):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=10000)
+            self._task = asyncio.get_running_loop().create_task(self._write_loop())
+        try:
+            self._queue.put_nowait(entry)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def _write_loop(self):
+        while True:
+            batch = [await self._queue.get()]
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await asyncio.to_thread(self._write, batch)
+                self.written += len(batch)
+            except OSError as e:
+                self.errors += len(batch)
+                logger.warning(f"Cassette write to {self.path} failed: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, batch: List[Dict[str, Any]]):
+        lines = "".join(_dumps(entry) + "\n" for entry in batch)
+        with _open(self.path, "a") as f:
+            f.write(lines)
+
+    async def close(self):
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), 10)
+        except asyncio.TimeoutError:
+            logger.warning("Cassette writer did not finish before shutdown")
+        self._task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"mode": "record", "path": self.path, "written": self.written,
+                "dropped": self.dropped, "errors": self.errors}
+
+
+# === Запись ===
+
+class RecordingOllama:
+    """Обёртка клиента Ollama: каждый запрос и ответ (чанки — со смещением во времени) пишутся в кассету"""
+
+    def __init__(self, client: Any, writer: CassetteWriter):
+        self.client = client
+        self.writer = writer
+
+    def _entry(self, path: str, model: Optional[str], body: Dict[str, Any], stream: bool) -> Dict[str, Any]:
+        return {
+            "type": "ollama", "request_id": current_request_id(), "path": path, "stream": stream,
+            "key": ollama_key(path, model, body), "started_at": time.time(),
+        }
+
+    async def _record(self, entry: Dict[str, Any], call) -> Dict[str, Any]:
+        started = time.perf_counter()
+        try:
+            data = await call
+            entry["response"] = data
+            return data
+        except OllamaError as e:
+            entry["error"], entry["status"] = str(e), e.status
+            raise
+        finally:
+            entry["duration_ms"] = round(1000 * (time.perf_counter() - started), 3)
+            self.writer.append(entry)
+
+    async def _record_stream(self, entry: Dict[str, Any], stream) -> AsyncIterator[Dict[str, Any]]:
+        started = time.perf_counter()
+        chunks: List[Tuple[float, Dict[str, Any]]] = []
+        try:
+            async for chunk in stream:
+                chunks.append((round(1000 * (time.perf_counter() - started), 3), chunk))
+                yield chunk
+        except OllamaError as e:
+            entry["error"], entry["status"] = str(e), e.status
+            raise
+        finally:
+            # Агент мог оборвать генерацию — записано то, что он успел получить
+            await stream.aclose()
+            entry["chunks"] = chunks
+            entry["duration_ms"] = round(1000 * (time.perf_counter() - started), 3)
+            self.writer.append(entry)
+
+    async def generate(self, prompt: str, model: Optional[str] = None, **params: Any) -> Dict[str, Any]:
+        entry = self._entry("/api/generate", model, {"prompt": prompt, **params}, False)
+        return await self._record(entry, self.client.generate(prompt, model, **params))
+
+    async def chat(self, messages: List[Dict[str, str]], model: Optional[str] = None,
+                   **params: Any) -> Dict[str, Any]:
+        entry = self._entry("/api/chat", model, {"messages": messages, **params}, False)
+        return await self._record(entry, self.client.chat(messages, model, **params))
+
+    def generate_stream(self, prompt: str, model: Optional[str] = None,
+                        **params: Any) -> AsyncIterator[Dict[str, Any]]:
+        entry = self._entry("/api/generate", model, {"prompt": prompt, **params}, True)
+        return self._record_stream(entry, self.client.generate_stream(prompt, model, **params))
+
+    def chat_stream(self, messages: List[Dict[str, str]], model: Optional[str] = None,
+                    **params: Any) -> AsyncIterator[Dict[str, Any]]:
+        entry = self._entry("/api/chat", model, {"messages": messages, **params}, True)
+        return self._record_stream(entry, self.client.chat_stream(messages, model, **params))
+
+    def stats(self) -> Dict[str, Any]:
+        return self.client.stats()
+
+
+class RecordingMCPPool:
+    """Обёртка пула MCP-сессий: список инструментов и каждый call_tool пишутся в кассету"""
+
+    def __init__(self, pool: Any, writer: CassetteWriter, servers_config: Dict[str, Dict[str, Any]]):
+        self.pool = pool
+        self.writer = writer
+        self.servers_config = servers_config
+
+    async def list_tools(self, server_name: str):
+        tools = await self.pool.list_tools(server_name)
+        self.writer.append({
+            "type": "tools", "server": server_name, "config": self.servers_config.get(server_name),
+            "tools": [tool.model_dump(mode="json", exclude_none=True) for tool in tools],
+        })
+        return tools
+
+    async def call_tool(self, server_name: str, tool_name: str, args: Dict[str, Any],
+                        progress_handler: Optional[Callable[..., Awaitable[None]]] = None,
+                        idempotent: bool = False):
+        entry = {
+            "type": "mcp", "request_id": current_request_id(), "server": server_name,
+            "tool": tool_name, "args": args, "started_at": time.time(),
+        }
+        started = time.perf_counter()
+        try:
+            result = await self.pool.call_tool(server_name, tool_name, args, progress_handler, idempotent)
+            entry["result"] = result_to_dict(result)
+            return result
+        except Exception as e:
+            entry["error"] = str(e)
+            raise
+        finally:
+            entry["duration_ms"] = round(1000 * (time.perf_counter() - started), 3)
+            self.writer.append(entry)
+
+    async def close(self):
+        await self.pool.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return self.pool.stats()
+
+
+# === Воспроизведение ===
+
+class CassetteMiss(Exception):
+    """В кассете нет подходящего ответа"""
+
+
+def as_chunks(entry: Dict[str, Any]) -> List[Tuple[float, Dict[str, Any]]]:
+    """Ответ записи в виде чанков стриминга (запись без стриминга — один итоговый чанк)"""
+    if "chunks" in entry:
+        return [(offset, chunk) for offset, chunk in entry["chunks"]]
+    return [(entry.get("duration_ms", 0.0), entry.get("response", {}))]
+
+
+def as_response(entry: Dict[str, Any]) -> Dict[str, Any]:
+    """Ответ записи без стриминга (чанки склеиваются, итоговые поля — из последнего)"""
+    if "response" in entry:
+        return entry["response"]
+    chunks = [chunk for _, chunk in entry.get("chunks", [])]
+    data = dict(chunks[-1]) if chunks else {}
+    if chunks and "message" in chunks[0]:
+        text = "".join(chunk.get("message", {}).get("content", "") for chunk in chunks)
+        data["message"] = {"role": "assistant", "content": text}
+    else:
+        data["response"] = "".join(chunk.get("response", "") for chunk in chunks)
+    return data
+
+
+class CassettePlayer:
+    """
+    Ответы Ollama и MCP из кассеты. Запрос к Ollama ищется по ключу (тот же промпт и параметры),
+    иначе берётся n-й запрос к тому же эндпоинту в записанном запросе с тем же X-Request-ID —
+    так новая сборка с изменённым промптом всё равно получает ответ. Задержки — как в записи,
+    делённые на speed (0 — без задержек)
+    """
+
+    def __init__(self, entries: List[Dict[str, Any]], speed: float):
+        self.speed = speed
+        self.tools: Dict[str, List[Dict[str, Any]]] = {}
+        # Конфигурация MCP-серверов на момент записи (для MCP_SERVERS_CONFIG при воспроизведении)
+        self.servers_config: Dict[str, Dict[str, Any]] = {}
+        self._ollama_by_key: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        self._ollama_by_request: Dict[Tuple[str, str], List[Dict[str, Any]]] = defaultdict(list)
+        self._mcp: Dict[Tuple[str, str], List[Dict[str, Any]]] = defaultdict(list)
+        self._cursors: Dict[Any, int] = defaultdict(int)
+
+        for entry in entries:
+            kind = entry.get("type")
+            if kind == "tools":
+                self.tools[entry["server"]] = entry["tools"]
+                if entry.get("config"):
+                    self.servers_config[entry["server"]] = entry["config"]
+            elif kind == "ollama":
+                self._ollama_by_key[entry["key"]].append(entry)
+                self._ollama_by_request[(entry["request_id"], entry["path"])].append(entry)
+            elif kind == "mcp":
+                self._mcp[(entry["tool"], canonical_args(entry["args"]))].append(entry)
+
+        # Статистика
+        self.exact = 0
+        self.fuzzy = 0
+        self.misses = 0
+        self.mcp_hits = 0
+        self.mcp_misses = 0
+
+    def _next(self, cursor_key: Any, entries: List[Dict[str, Any]]) -> Dict[str, Any]:
+        # Одинаковые запросы получают записанные ответы по очереди, после последнего — снова последний
+        index = self._cursors[cursor_key]
+        self._cursors[cursor_key] = index + 1
+        return entries[min(index, len(entries) - 1)]
+
+    def find_ollama(self, path: str, model: Optional[str], body: Dict[str, Any]) -> Dict[str, Any]:
+        key = ollama_key(path, model, body)
+        request_key = (current_request_id(), path)
+        sequence = self._cursors[("request", request_key)]
+        self._cursors[("request", request_key)] = sequence + 1
+        by_request = self._ollama_by_request.get(request_key, [])
+
+        if sequence < len(by_request) and by_request[sequence]["key"] == key:
+            self.exact += 1
+            return by_request[sequence]
+        if key in self._ollama_by_key:
+            self.exact += 1
+            return self._next(("key", key), self._ollama_by_key[key])
+        if sequence < len(by_request):
+            self.fuzzy += 1
+            return by_request[sequence]
+        self.misses += 1
+        raise CassetteMiss(f"No recorded Ollama response for {path} in request {request_key[0]}")
+
+    def find_mcp(self, tool_name: str, args: Dict[str, Any]) -> Dict[str, Any]:
+        key = (tool_name, canonical_args(args))
+        if key not in self._mcp:
+            self.mcp_misses += 1
+            raise CassetteMiss(f"No recorded result for {tool_name}({key[1]})")
+        self.mcp_hits += 1
+        return self._next(("mcp", key), self._mcp[key])
+
+    async def wait_until(self, started: float, offset_ms: float):
+        if self.speed <= 0:
+            return
+        delay = offset_ms / 1000 / self.speed - (time.perf_counter() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": "replay",
+            "speed": self.speed,
+            "ollama_exact": self.exact,
+            "ollama_fuzzy": self.fuzzy,
+            "ollama_misses": self.misses,
+            "mcp_hits": self.mcp_hits,
+            "mcp_misses": self.mcp_misses,
+        }
+
+
+class ReplayOllama:
+    """Клиент Ollama, отвечающий из кассеты"""
+
+    def __init__(self, player: CassettePlayer):
+        self.player = player
+        self.requests = 0
+
+    async def _respond(self, path: str, model: Optional[str], body: Dict[str, Any]) -> Dict[str, Any]:
+        self.requests += 1
+        started = time.perf_counter()
+        try:
+            entry = self.player.find_ollama(path, model, body)
+        except CassetteMiss as e:
+            raise OllamaError(str(e)) from e
+        await self.player.wait_until(started, entry.get("duration_ms", 0.0))
+        if "error" in entry:
+            raise OllamaError(entry["error"], status=entry.get("status"))
+        return as_response(entry)
+
+    async def _respond_stream(self, path: str, model: Optional[str],
+                              body: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        self.requests += 1
+        started = time.perf_counter()
+        try:
+            entry = self.player.find_ollama(path, model, body)
+        except CassetteMiss as e:
+            raise OllamaError(str(e)) from e
+        for offset, chunk in as_chunks(entry):
+            await self.player.wait_until(started, offset)
+            yield chunk
+        if "error" in entry:
+            raise OllamaError(entry["error"], status=entry.get("status"))
+
+    async def generate(self, prompt: str, model: Optional[str] = None, **params: Any) -> Dict[str, Any]:
+        return await self._respond("/api/generate", model, {"prompt": prompt, **params})
+
+    async def chat(self, messages: List[Dict[str, str]], model: Optional[str] = None,
+                   **params: Any) -> Dict[str, Any]:
+        return await self._respond("/api/chat", model, {"messages": messages, **params})
+
+    def generate_stream(self, prompt: str, model: Optional[str] = None,
+                        **params: Any) -> AsyncIterator[Dict[str, Any]]:
+        return self._respond_stream("/api/generate", model, {"prompt": prompt, **params})
+
+    def chat_stream(self, messages: List[Dict[str, str]], model: Optional[str] = None,
+                    **params: Any) -> AsyncIterator[Dict[str, Any]]:
+        return self._respond_stream("/api/chat", model, {"messages": messages, **params})
+
+    def stats(self) -> Dict[str, Any]:
+        return {"requests": self.requests, "replay": True}
+
+
+class ReplayMCPPool:
+    """Пул MCP, отвечающий из кассеты: инструменты и результаты вызовов — записанные"""
+
+    def __init__(self, player: CassettePlayer):
+        self.player = player
+
+    async def list_tools(self, server_name: str):
+        if server_name not in self.player.tools:
+            raise CassetteMiss(f"No recorded tools for server {server_name}")
+        return [mcp.types.Tool.model_validate(tool) for tool in self.player.tools[server_name]]
+
+    async def call_tool(self, server_name: str, tool_name: str, args: Dict[str, Any],
+                        progress_handler: Optional[Callable[..., Awaitable[None]]] = None,
+                        idempotent: bool = False):
+        # Уведомления о прогрессе не записываются: при воспроизведении приходит только результат
+        started = time.perf_counter()
+        entry = self.player.find_mcp(tool_name, args)
+        await self.player.wait_until(started, entry.get("duration_ms", 0.0))
+        if "error" in entry:
+            raise RuntimeError(entry["error"])
+        return result_from_dict(entry["result"])
+
+    async def close(self):
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {"replay": True}
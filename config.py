@@ -1,8 +1,12 @@
 # config.py
 
 LOG_LEVEL = "INFO"
+# request_id — идентификатор запроса к агенту (заголовок X-Request-ID)
+LOG_FORMAT = "%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s"
 
 # Список MCP-серверов
+# Вместо "url" можно указать "urls" — несколько реплик одного сервера:
+# запросы распределяются между ними, сбоящая реплика временно отключается
 MCP_SERVERS_CONFIG = {
     "rag_query": {
         "url": "http://localhost:3337/mcp",
@@ -33,4 +37,294 @@ MCP_SERVERS_CONFIG = {
 # }
 
 # URL Ollama
-OLLAMA_API_URL = "http://localhost:11434/api/generate"
\ No newline at end of file
+OLLAMA_BASE_URL = "http://localhost:11434"
+OLLAMA_API_URL = f"{OLLAMA_BASE_URL}/api/generate"
+OLLAMA_MODEL = "llama3"
+
+# Общий пул keep-alive соединений к Ollama (один на процесс)
+OLLAMA_POOL_LIMIT = 16
+OLLAMA_POOL_LIMIT_PER_HOST = 8
+OLLAMA_KEEPALIVE_TIMEOUT = 60
+# Таймауты, сек: установка соединения и ожидание данных от модели
+OLLAMA_CONNECT_TIMEOUT = 5
+OLLAMA_READ_TIMEOUT = 300
+
+# Хосты Ollama (ollama_pool.py): запрос уходит на наименее загруженный хост, где модель уже
+# в памяти, иначе — на наименее загруженный (модель загрузится, это считается холодной загрузкой)
+OLLAMA_HOSTS = [OLLAMA_BASE_URL]
+# Модели, которые загружаются на все хосты при запуске сервиса (None — все модели из LLM_STAGE_MODELS)
+OLLAMA_PRELOAD_MODELS = None
+# В рабочие часы (часы с — по, локальное время) и дни (0 — понедельник) keep_alive загруженных
+# моделей продлевается, чтобы они не выгружались между запросами (None — круглосуточно)
+OLLAMA_BUSINESS_HOURS = (8, 20)
+OLLAMA_BUSINESS_DAYS = (0, 1, 2, 3, 4)
+# Как часто проверять модели в памяти хостов (/api/ps) и продлевать keep_alive, сек
+# (должно быть меньше OLLAMA_KEEP_ALIVE)
+OLLAMA_KEEP_ALIVE_REFRESH_INTERVAL = 600
+# Хост, не ответивший на запрос, столько секунд не получает новых запросов
+OLLAMA_HOST_RETRY_AFTER = 10
+# Загрузка модели дольше стольких секунд считается холодной загрузкой
+OLLAMA_COLD_LOAD_THRESHOLD = 1.0
+
+# Пул MCP-сессий: сколько одновременных сессий держать на один сервер
+# (можно переопределить ключом "max_sessions" в MCP_SERVERS_CONFIG)
+MCP_POOL_MAX_SESSIONS_PER_SERVER = 4
+# Таймаут установки MCP-сессии, сек
+MCP_POOL_CONNECT_TIMEOUT = 10
+
+# Обнаружение инструментов MCP: серверы опрашиваются одновременно
+# Таймаут опроса одного сервера, сек — недоступный сервер не задерживает запуск дольше этого
+MCP_DISCOVERY_TIMEOUT = 10
+# Как часто перечитывать списки инструментов, сек (и сразу по notifications/tools/list_changed)
+MCP_DISCOVERY_REFRESH_INTERVAL = 300
+# Снимок последнего удачного каталога инструментов: по нему сервис отвечает сразу после запуска,
+# не дожидаясь серверов (None — не сохранять)
+MCP_TOOLS_SNAPSHOT_PATH = "mcp_tools_snapshot.json"
+
+# Реплики MCP-серверов
+# После стольких ошибок подряд реплика отключается ...
+MCP_BREAKER_FAILURE_THRESHOLD = 3
+# ... на столько секунд, потом получает один пробный запрос
+MCP_BREAKER_RESET_TIMEOUT = 30
+# Как часто проверять (ping) реплики без недавних удачных запросов, сек (0 — не проверять)
+MCP_HEALTH_PROBE_INTERVAL = 15
+# Таймаут проверки, сек
+MCP_HEALTH_PROBE_TIMEOUT = 5
+
+# Быстрый выбор инструмента без LLM по близости запроса к описанию инструмента
+TOOL_ROUTER_ENABLED = True
+# Размерность хэшированных векторов признаков
+TOOL_ROUTER_DIM = 1024
+# Минимальная косинусная близость лучшего инструмента
+TOOL_ROUTER_MIN_SCORE = 0.3
+# Минимальный отрыв лучшего инструмента от второго
+TOOL_ROUTER_MIN_MARGIN = 0.1
+
+# Каталог инструментов в промпте выбора инструмента: не больше TOP_K самых
+# близких к запросу инструментов и не больше TOKEN_BUDGET токенов на их описания.
+# Только для ROUTING_PREFIX_MODE = "off": переиспользуемый префикс содержит весь каталог
+TOOL_CATALOG_TOP_K = 8
+TOOL_CATALOG_TOKEN_BUDGET = 1500
+# Среднее число символов на токен для грубой оценки размера промпта
+PROMPT_CHARS_PER_TOKEN = 3
+
+# Сколько держать модель загруженной в Ollama после запроса
+OLLAMA_KEEP_ALIVE = "30m"
+# Переиспользование обработанного Ollama префикса промпта выбора инструмента:
+#   "chat"    — префикс уходит system-сообщением в /api/chat, Ollama переиспользует KV-кэш
+#   "context" — префикс прогоняется один раз, дальше передаются его context-токены
+#   "off"     — весь промпт каждый раз целиком (как раньше), с отбором инструментов под запрос
+# В режимах "chat" и "context" в префиксе все инструменты каталога: отбор под запрос менял бы
+# префикс от запроса к запросу, и Ollama не смогла бы его переиспользовать
+ROUTING_PREFIX_MODE = "chat"
+# Сколько разных префиксов (наборов инструментов) держать в кэше
+ROUTING_PREFIX_CACHE_SIZE = 16
+
+# Политики инструментов. Ключ — имя инструмента или шаблон ("openproject-delete-*").
+# Подходящие политики сливаются от общих к частным: поля конкретного шаблона ("openproject-list-*")
+# важнее полей общего ("openproject-*"), поля точного имени — всех шаблонов.
+#   response_cache_ttl — сколько секунд кэшировать итоговый ответ агента, 0 — не кэшировать
+#                        (по умолчанию RESPONSE_CACHE_DEFAULT_TTL)
+#   result_cache_ttl   — сколько секунд кэшировать результат call_tool, 0 — не кэшировать (по умолчанию)
+#   result_stale_ttl   — сколько ещё секунд отдавать устаревший результат, обновляя его в фоне
+#   response_mode      — как результат инструмента превращается в ответ:
+#                        "passthrough"   — отдаётся как есть,
+#                        "template"      — по шаблону response_template, без LLM,
+#                        "llm_summarize" — пересказывается LLM,
+#                        не задан        — как есть, если это короткий текст на русском, иначе LLM
+#   response_template  — шаблон str.format: поля структурированного результата и {text} — весь текст
+#   drop_fields        — ключи JSON-результата, которые не нужны LLM (убираются на любой глубине)
+#   items_path         — путь к массиву записей в JSON-результате ("_embedded.elements"),
+#                        по умолчанию корневой или самый большой массив
+#   call_timeout       — сколько секунд ждать ответа инструмента (по умолчанию TOOL_CALL_TIMEOUT)
+#   side_effect_free   — инструмент только читает данные, его можно вызвать заранее (PREFETCH_ENABLED)
+#                        и повторить после обрыва сессии MCP (остальные не повторяются — запись могла пройти)
+#   stream_progress    — текст из уведомлений о прогрессе инструмента сразу отдаётся в /query/stream
+#                        токенами (для инструментов, чей ответ идёт как есть: response_mode passthrough)
+TOOL_POLICIES = {
+    "get_current_time": {
+        "response_cache_ttl": 0, "side_effect_free": True,
+        "response_mode": "template", "response_template": "Текущее время: {text}"
+    },
+    # Фрагменты документации (rag_query.py) пересказываются LLM (response_mode по умолчанию)
+    "information_about_project_participants": {
+        "response_cache_ttl": 600, "result_cache_ttl": 600, "result_stale_ttl": 600, "side_effect_free": True
+    },
+    "search_project_docs": {"response_cache_ttl": 600, "result_cache_ttl": 600, "side_effect_free": True},
+    "ask_llama3": {
+        "response_cache_ttl": 0, "response_mode": "passthrough", "stream_progress": True, "call_timeout": 150
+    },
+    "openproject-*": {"drop_fields": ["_links", "_type", "lockVersion"], "items_path": "_embedded.elements"},
+    "openproject-list-*": {
+        "response_cache_ttl": 60, "result_cache_ttl": 60, "result_stale_ttl": 120, "side_effect_free": True
+    },
+    "openproject-get-*": {
+        "response_cache_ttl": 30, "result_cache_ttl": 30, "result_stale_ttl": 60, "side_effect_free": True
+    },
+    # Инструменты, меняющие данные, не кэшируются никогда
+    "openproject-create-*": {"response_cache_ttl": 0},
+    "openproject-update-*": {"response_cache_ttl": 0},
+    "openproject-delete-*": {"response_cache_ttl": 0},
+}
+
+# Кэш итоговых ответов агента
+RESPONSE_CACHE_ENABLED = True
+# TTL для инструментов без response_cache_ttl, сек: 0 — кэшируются только инструменты,
+# явно объявленные кэшируемыми (ответ неизвестного инструмента может зависеть от побочных эффектов)
+RESPONSE_CACHE_DEFAULT_TTL = 0
+RESPONSE_CACHE_MAX_ENTRIES = 1000
+# Файл SQLite, чтобы кэш переживал перезапуск (None — только в памяти)
+RESPONSE_CACHE_PATH = None
+
+# Кэш результатов call_tool (TTL — в TOOL_POLICIES)
+TOOL_RESULT_CACHE_MAX_ENTRIES = 500
+
+# Планировщик запросов к Ollama
+# Сколько генераций одновременно отправлять в Ollama (при нескольких OLLAMA_HOSTS — на все хосты вместе)
+LLM_MAX_CONCURRENCY = 1
+# Сколько запросов может ждать в очереди, остальные сразу получают 503
+LLM_MAX_QUEUE = 8
+# Сколько ждут ответа агента клиенты (telegram_bot.py): /query — весь ответ целиком,
+# /query/stream — очередное событие SSE, сек
+AGENT_CLIENT_TIMEOUT = 90
+AGENT_STREAM_READ_TIMEOUT = 300
+# Сколько секунд запрос может ждать слот (по типу запроса), дальше — 503.
+# Пока запрос ждёт слот, событий в /query/stream нет: ожидание чуть меньше таймаута чтения
+# потокового клиента, чтобы он получил 503 с Retry-After, а не оборвал соединение сам.
+# Генерация на CPU идёт минутами, поэтому короче ждать нельзя — иначе при LLM_MAX_CONCURRENCY = 1
+# отказ получит почти любой одновременный запрос. Клиент /query (AGENT_CLIENT_TIMEOUT) может
+# перестать ждать раньше; ответ при этом досчитывается и попадает в кэш для повторного запроса
+LLM_QUEUE_TIMEOUTS = {
+    "routing": AGENT_STREAM_READ_TIMEOUT - 30,
+    "summarize": AGENT_STREAM_READ_TIMEOUT - 30,
+}
+# Отказывать сразу, если по среднему времени генераций запрос не дождётся слота до своего
+# таймаута (по умолчанию запрос ждёт, пока таймаут не истечёт на самом деле)
+LLM_SHED_PREDICTED = False
+
+# Ответ выбора инструмента ограничивается JSON Schema (параметр format Ollama),
+# построенной по именам и inputSchema инструментов
+ROUTING_STRUCTURED_OUTPUT = True
+# Максимум токенов в ответе выбора инструмента
+ROUTING_NUM_PREDICT = 256
+
+# Модели по стадиям обработки запроса (llm_stages.py)
+#   routing   — выбор инструмента и аргументов: короткая классификация, хватает небольшой модели
+#   arguments — аргументы для инструмента, выбранного без LLM (TOOL_ROUTER_ENABLED), если их нельзя
+#               взять из текста запроса как есть
+#   summarize — пересказ результата инструмента
+#   qa        — свободные ответы qa_server
+# model          — модель Ollama (None — OLLAMA_MODEL)
+# options        — параметры генерации Ollama: num_ctx, num_predict, temperature ...
+# escalate_model — модель, которой запрос повторяется, если ответ не прошёл проверку
+#                  (не JSON, неизвестный инструмент, аргументы не по схеме)
+# По умолчанию все стадии — на OLLAMA_MODEL. Чтобы выбирать инструмент небольшой моделью,
+# загрузите её (ollama pull llama3.2:3b) и укажите у routing и arguments:
+#   "model": "llama3.2:3b", "escalate_model": OLLAMA_MODEL
+LLM_STAGE_MODELS = {
+    "routing": {
+        "model": OLLAMA_MODEL,
+        "options": {"num_ctx": 4096, "num_predict": ROUTING_NUM_PREDICT, "temperature": 0},
+    },
+    "arguments": {
+        "model": OLLAMA_MODEL,
+        "options": {"num_ctx": 2048, "num_predict": ROUTING_NUM_PREDICT, "temperature": 0},
+    },
+    "summarize": {"model": OLLAMA_MODEL, "options": {"num_ctx": 8192}},
+    "qa": {"model": OLLAMA_MODEL, "options": {"num_ctx": 4096}},
+}
+
+# Выбор инструмента может вернуть план из нескольких независимых вызовов
+# ({"calls": [...]}), они выполняются параллельно, а ответ пересказывается одним проходом LLM
+ROUTING_MULTI_TOOL = True
+# Максимум вызовов в одном плане
+MULTI_TOOL_MAX_CALLS = 4
+# Таймаут вызова инструмента по умолчанию, сек (в TOOL_POLICIES — call_timeout)
+TOOL_CALL_TIMEOUT = 30
+
+# Спекулятивный вызов инструмента, пока LLM выбирает инструмент (по умолчанию выключен).
+# Инструмент предсказывается по похожим прошлым запросам или по индексу инструментов;
+# вызываются только side_effect_free инструменты с аргументами, не требующими LLM
+PREFETCH_ENABLED = False
+# Сколько прошлых выборов LLM помнить для предсказания
+PREFETCH_HISTORY_SIZE = 500
+# Минимальная близость к прошлому запросу, чтобы взять его инструмент
+PREFETCH_MIN_SIMILARITY = 0.6
+# Иначе — минимальная близость к описанию инструмента (ниже порога быстрого выбора)
+PREFETCH_MIN_SCORE = 0.2
+
+# Результат инструмента без response_mode отдаётся без пересказа LLM,
+# если он не длиннее стольких символов ...
+RESPONSE_BYPASS_MAX_CHARS = 400
+# ... и доля букв среди непробельных символов не меньше этой (не JSON и не набор чисел)
+RESPONSE_BYPASS_MIN_ALPHA_RATIO = 0.6
+
+# Трассы отладки (промпты, решения, выводы инструментов, ответы LLM): GET /debug/traces/{request_id}
+# Доля запросов, для которых сохраняется трасса (заголовок X-Debug-Trace: 1 — всегда)
+TRACE_SAMPLE_RATE = 0.1
+# Сколько трасс держать в памяти и их суммарный размер, символов (старые вытесняются)
+TRACE_MAX_TRACES = 200
+TRACE_MAX_CHARS = 20_000_000
+# Длиннее этого отдельный артефакт обрезается
+TRACE_MAX_EVENT_CHARS = 200_000
+# Файл JSONL, куда в фоне выгружаются завершённые трассы (None — не выгружать)
+TRACE_EXPORT_PATH = None
+
+# Сжатие результата инструмента перед RAG-промптом
+# Сколько токенов результата инструмента может попасть в промпт; лишние записи отбрасываются
+# по близости к запросу пользователя
+TOOL_OUTPUT_TOKEN_BUDGET = 2000
+# Размер куска при нарезке нетабличного текста, токенов
+TOOL_OUTPUT_CHUNK_TOKENS = 200
+# Начиная с такого размера JSON разбирается потоково, по записям, без json.loads целиком
+TOOL_OUTPUT_STREAM_MIN_CHARS = 1_000_000
+
+# QA-сервер (qa_server.py)
+# Сколько вопросов генерируется одновременно, остальные ждут очереди ...
+QA_MAX_CONCURRENCY = 2
+# ... не больше QA_MAX_QUEUE, остальным сразу отказ
+QA_MAX_QUEUE = 16
+# Сколько секунд отводится на вопрос вместе с ожиданием очереди; по истечении возвращается
+# то, что модель успела сгенерировать
+QA_REQUEST_DEADLINE = 120
+# Как часто отправлять агенту сгенерированный текст уведомлениями о прогрессе MCP, сек
+QA_PROGRESS_INTERVAL = 0.3
+
+# Поиск по документации проекта (rag_index.py, сервер rag_query.py)
+# Папка с документами (выгрузка документации 1С:СППР) и какие файлы индексировать
+RAG_DOCS_DIR = "docs"
+RAG_FILE_EXTENSIONS = (".txt", ".md")
+# Папка индекса: векторы (memmap NumPy), тексты фрагментов и метаданные
+RAG_INDEX_DIR = "rag_index"
+# Размер фрагмента документа, токенов (символов — PROMPT_CHARS_PER_TOKEN на токен)
+RAG_CHUNK_TOKENS = 300
+# Векторы фрагментов: "hash" — хэшированные признаки слов (как у быстрого выбора инструмента), без модели,
+# "ollama" — модель RAG_EMBED_MODEL через /api/embed (сначала ollama pull nomic-embed-text)
+RAG_EMBEDDER = "hash"
+RAG_EMBED_MODEL = "nomic-embed-text"
+# Сколько фрагментов отправлять в Ollama одним запросом
+RAG_EMBED_BATCH = 64
+# Размерность векторов "hash"
+RAG_HASH_DIM = 1024
+# Префиксы текста для модели векторов (nomic-embed-text различает вопросы и документы)
+RAG_QUERY_PREFIX = "search_query: "
+RAG_DOCUMENT_PREFIX = "search_document: "
+# Сколько фрагментов возвращать агенту
+RAG_TOP_K = 5
+# Начиная с такого числа фрагментов поиск идёт по грубому индексу (IVF): векторы разбиты
+# на кластеры, сравниваются только фрагменты RAG_IVF_NPROBE ближайших к вопросу кластеров
+RAG_IVF_MIN_ROWS = 50_000
+RAG_IVF_NPROBE = 16
+# Когда удалённых (из изменившихся файлов) фрагментов больше этой доли, индекс переписывается
+RAG_COMPACT_RATIO = 0.3
+# Как часто проверять папку документов на изменения, сек (0 — только при запуске)
+RAG_REINDEX_INTERVAL = 600
+
+# Запись и воспроизведение обращений к Ollama и MCP (cassette.py)
+# "off", "record" — дописывать запросы, ответы и их время в файл, "replay" — отвечать из файла
+# без Ollama и MCP-серверов (прогон: python benchmark.py --replay <файл>)
+CASSETTE_MODE = "off"
+# Файл записи (JSONL; с расширением .gz — сжатый)
+CASSETTE_PATH = "agent_cassette.jsonl.gz"
+# Скорость воспроизведения: 1 — как записано, 2 — вдвое быстрее, 0 — без задержек
+CASSETTE_REPLAY_SPEED = 1.0
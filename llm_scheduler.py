@@ -0,0 +1,183 @@
+# llm_scheduler.py
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("LLMScheduler")
+
+# Чем меньше число, тем раньше запрос получает слот
+PRIORITY_ROUTING = 0
+PRIORITY_SUMMARIZE = 1
+
+PRIORITY_NAMES = {PRIORITY_ROUTING: "routing", PRIORITY_SUMMARIZE: "summarize"}
+
+
+class SchedulerOverloaded(Exception):
+    """Запрос к LLM отклонён: очередь заполнена или он не успеет дождаться слота"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    def __init__(self, priority: int, seq: int, future: asyncio.Future):
+        self.priority = priority
+        self.seq = seq
+        self.future = future
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class LLMScheduler:
+    """
+    Допуск запросов к Ollama: не больше max_concurrency генераций одновременно,
+    не больше max_queue ожидающих. Короткие запросы выбора инструмента обслуживаются
+    раньше длинных запросов на итоговый ответ. Запрос, который заведомо не дождётся
+    слота до своего дедлайна, отклоняется сразу (shed_predicted), а не по таймауту клиента.
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int, queue_timeouts: Dict[str, float],
+                 shed_predicted: bool = False):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeouts = queue_timeouts
+        self.shed_predicted = shed_predicted
+
+        self._active = 0
+        self._waiting = 0
+        # Выполняющиеся генерации: номер -> (приоритет, время начала)
+        self._running: Dict[int, Tuple[int, float]] = {}
+        self._queue: List[_Waiter] = []
+        self._seq = itertools.count()
+        # Скользящее среднее времени генерации по приоритетам, сек
+        self._service_time: Dict[int, float] = {}
+
+        # Статистика
+        self.granted: Dict[str, int] = {name: 0 for name in PRIORITY_NAMES.values()}
+        self.wait_time_total: Dict[str, float] = {name: 0.0 for name in PRIORITY_NAMES.values()}
+        self.shed: Dict[str, int] = {"queue_full": 0, "deadline": 0, "predicted": 0}
+        self.max_depth_seen = 0
+
+    def overloaded(self) -> bool:
+        """Очередь заполнена — новые запросы будут отклонены"""
+        return self._waiting >= self.max_queue
+
+    def _service(self, priority: int) -> float:
+        if priority in self._service_time:
+            return self._service_time[priority]
+        return max(self._service_time.values(), default=0.0)
+
+    def _estimated_wait(self, priority: int) -> float:
+        """
+        Через сколько освободится слот для нового запроса: слоты освобождаются, когда выполняющиеся
+        генерации доработают своё среднее время (уже прошедшее вычитается), затем по очереди
+        их занимают ожидающие впереди — каждый на среднее время своего приоритета
+        """
+        if not self._service_time:
+            return 0.0
+        now = time.perf_counter()
+        free_at = [
+            max(0.0, self._service(running_priority) - (now - started))
+            for running_priority, started in self._running.values()
+        ]
+        free_at += [0.0] * max(0, self.max_concurrency - len(free_at))
+        heapq.heapify(free_at)
+        ahead = sorted(waiter for waiter in self._queue if not waiter.future.done() and waiter.priority <= priority)
+        for waiter in ahead:
+            heapq.heappush(free_at, heapq.heappop(free_at) + self._service(waiter.priority))
+        return free_at[0]
+
+    async def acquire(self, priority: int):
+        name = PRIORITY_NAMES[priority]
+        timeout = self.queue_timeouts.get(name)
+        started = time.perf_counter()
+
+        if self._active < self.max_concurrency and self._waiting == 0:
+            self._active += 1
+            self.granted[name] += 1
+            return
+
+        if self._waiting >= self.max_queue:
+            self.shed["queue_full"] += 1
+            raise SchedulerOverloaded("LLM queue is full", retry_after=self._estimated_wait(priority))
+        if self.shed_predicted and timeout is not None and self._estimated_wait(priority) > timeout:
+            self.shed["predicted"] += 1
+            raise SchedulerOverloaded("LLM queue wait would exceed the deadline",
+                                      retry_after=self._estimated_wait(priority))
+
+        waiter = _Waiter(priority, next(self._seq), asyncio.get_running_loop().create_future())
+        heapq.heappush(self._queue, waiter)
+        self._waiting += 1
+        self.max_depth_seen = max(self.max_depth_seen, self._waiting)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+        except asyncio.TimeoutError:
+            if waiter.future.done():
+                # Слот выдали в момент таймаута — отдаём его обратно
+                self.release()
+            else:
+                waiter.future.cancel()
+                self._waiting -= 1
+            self.shed["deadline"] += 1
+            raise SchedulerOverloaded("LLM queue deadline exceeded", retry_after=self._estimated_wait(priority))
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.release()
+            else:
+                waiter.future.cancel()
+                self._waiting -= 1
+            raise
+
+        self.granted[name] += 1
+        self.wait_time_total[name] += time.perf_counter() - started
+
+    def release(self):
+        # Слот передаётся следующему в очереди без уменьшения счётчика активных
+        while self._queue:
+            waiter = heapq.heappop(self._queue)
+            if waiter.future.done():
+                continue
+            self._waiting -= 1
+            waiter.future.set_result(None)
+            return
+        self._active -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority: int):
+        await self.acquire(priority)
+        started = time.perf_counter()
+        token = next(self._seq)
+        self._running[token] = (priority, started)
+        try:
+            yield
+        finally:
+            del self._running[token]
+            elapsed = time.perf_counter() - started
+            previous = self._service_time.get(priority)
+            self._service_time[priority] = elapsed if previous is None else 0.8 * previous + 0.2 * elapsed
+            self.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "active": self._active,
+            "queue_depth": self._waiting,
+            "max_queue_depth_seen": self.max_depth_seen,
+            "granted": dict(self.granted),
+            "avg_wait_ms": {
+                name: round(1000 * self.wait_time_total[name] / count, 3) if count else 0.0
+                for name, count in self.granted.items()
+            },
+            "avg_service_ms": {
+                PRIORITY_NAMES[priority]: round(1000 * value, 3) for priority, value in self._service_time.items()
+            },
+            "shed": dict(self.shed),
+        }
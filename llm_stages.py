@@ -0,0 +1,93 @@
+# llm_stages.py
+
+import logging
+from typing import Any, Dict, List
+
+from config import LLM_STAGE_MODELS, OLLAMA_MODEL
+from metrics import LLM_CALL_DURATION, LLM_ESCALATIONS
+
+logger = logging.getLogger("LLMStages")
+
+
+def stage_models(stages: Dict[str, Dict[str, Any]] = LLM_STAGE_MODELS,
+                 default_model: str = OLLAMA_MODEL) -> List[str]:
+    """Все модели стадий вместе с моделями эскалации (их загружает ollama_pool при запуске)"""
+    models: List[str] = []
+    for stage in stages.values():
+        for model in (stage.get("model") or default_model, stage.get("escalate_model")):
+            if model and model not in models:
+                models.append(model)
+    return models
+
+
+class LLMStages:
+    """
+    Модель и параметры генерации каждой стадии (LLM_STAGE_MODELS): небольшая модель для выбора
+    инструмента, большая — для ответов. Учитывает вызовы: время по стадиям и моделям
+    и долю повторов на модели эскалации
+    """
+
+    def __init__(self, stages: Dict[str, Dict[str, Any]] = LLM_STAGE_MODELS, default_model: str = OLLAMA_MODEL):
+        self.stages = stages
+        self.default_model = default_model
+
+        # Статистика: стадия -> счётчики, стадия -> модель -> счётчики
+        self.counters: Dict[str, Dict[str, int]] = {}
+        self.models: Dict[str, Dict[str, Dict[str, float]]] = {}
+
+    def model(self, stage: str, escalated: bool = False) -> str:
+        config = self.stages.get(stage, {})
+        model = config.get("model") or self.default_model
+        return (config.get("escalate_model") or model) if escalated else model
+
+    def can_escalate(self, stage: str) -> bool:
+        return self.model(stage, escalated=True) != self.model(stage)
+
+    def params(self, stage: str, escalated: bool = False, **params: Any) -> Dict[str, Any]:
+        """Параметры вызова Ollama для стадии: model и options (options из params дополняют options стадии)"""
+        options = {**self.stages.get(stage, {}).get("options", {}), **params.pop("options", {})}
+        if options:
+            params["options"] = options
+        return {"model": self.model(stage, escalated), **params}
+
+    def record(self, stage: str, model: str, seconds: float, escalated: bool = False, ok: bool = True):
+        """Вызов LLM стадии: время и успех — по модели; первые попытки — база для доли эскалаций"""
+        LLM_CALL_DURATION.observe(seconds, stage=stage, model=model, status="ok" if ok else "error")
+        counters = self.counters.setdefault(stage, {"requests": 0, "escalations": 0})
+        if not escalated:
+            counters["requests"] += 1
+        entry = self.models.setdefault(stage, {}).setdefault(model, {"calls": 0, "errors": 0, "time_total": 0.0})
+        entry["calls"] += 1
+        entry["time_total"] += seconds
+        if not ok:
+            entry["errors"] += 1
+
+    def escalate(self, stage: str, reason: str):
+        """Ответ небольшой модели не прошёл проверку — запрос повторяется на модели эскалации"""
+        LLM_ESCALATIONS.inc(stage=stage, reason=reason)
+        self.counters.setdefault(stage, {"requests": 0, "escalations": 0})["escalations"] += 1
+        logger.warning(
+            f"{stage}: reply of {self.model(stage)} rejected ({reason}), retrying with {self.model(stage, True)}"
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        result: Dict[str, Any] = {}
+        for stage in self.stages:
+            counters = self.counters.get(stage, {"requests": 0, "escalations": 0})
+            result[stage] = {
+                "model": self.model(stage),
+                "escalate_model": self.model(stage, True) if self.can_escalate(stage) else None,
+                "requests": counters["requests"],
+                "escalations": counters["escalations"],
+                "escalation_rate": round(counters["escalations"] / counters["requests"], 4)
+                if counters["requests"] else 0.0,
+                "models": {
+                    model: {
+                        "calls": entry["calls"],
+                        "errors": entry["errors"],
+                        "avg_ms": round(1000 * entry["time_total"] / entry["calls"], 3),
+                    }
+                    for model, entry in self.models.get(stage, {}).items()
+                },
+            }
+        return result
@@ -5,18 +5,67 @@
 import logging
 import asyncio
 import json
-from typing import Dict, List, Optional, Any
-from fastapi import FastAPI
+import math
+import time
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Any, Tuple
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from contextlib import asynccontextmanager
+from contextlib import aclosing, asynccontextmanager
 
-from fastmcp import Client
 from fastmcp import tools as Tool
 
-from config import LOG_LEVEL, MCP_SERVERS_CONFIG, OLLAMA_API_URL
-from tools import extract_text_content
+from config import (
+    LOG_LEVEL, LOG_FORMAT, MCP_SERVERS_CONFIG,
+    MCP_POOL_MAX_SESSIONS_PER_SERVER, MCP_POOL_CONNECT_TIMEOUT,
+    MCP_DISCOVERY_TIMEOUT, MCP_DISCOVERY_REFRESH_INTERVAL, MCP_TOOLS_SNAPSHOT_PATH,
+    MCP_BREAKER_FAILURE_THRESHOLD, MCP_BREAKER_RESET_TIMEOUT, MCP_HEALTH_PROBE_INTERVAL, MCP_HEALTH_PROBE_TIMEOUT,
+    TOOL_ROUTER_ENABLED, TOOL_ROUTER_DIM, TOOL_ROUTER_MIN_SCORE, TOOL_ROUTER_MIN_MARGIN,
+    TOOL_CATALOG_TOP_K, TOOL_CATALOG_TOKEN_BUDGET, PROMPT_CHARS_PER_TOKEN,
+    ROUTING_PREFIX_MODE, ROUTING_PREFIX_CACHE_SIZE, OLLAMA_KEEP_ALIVE,
+    RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_DEFAULT_TTL, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_PATH,
+    TOOL_RESULT_CACHE_MAX_ENTRIES,
+    LLM_MAX_CONCURRENCY, LLM_MAX_QUEUE, LLM_QUEUE_TIMEOUTS, LLM_SHED_PREDICTED,
+    ROUTING_STRUCTURED_OUTPUT,
+    RESPONSE_BYPASS_MAX_CHARS, RESPONSE_BYPASS_MIN_ALPHA_RATIO,
+    TOOL_OUTPUT_TOKEN_BUDGET, TOOL_OUTPUT_CHUNK_TOKENS, TOOL_OUTPUT_STREAM_MIN_CHARS,
+    ROUTING_MULTI_TOOL, MULTI_TOOL_MAX_CALLS, TOOL_CALL_TIMEOUT,
+    PREFETCH_ENABLED, PREFETCH_HISTORY_SIZE, PREFETCH_MIN_SIMILARITY, PREFETCH_MIN_SCORE,
+    TRACE_SAMPLE_RATE, TRACE_MAX_TRACES, TRACE_MAX_CHARS, TRACE_MAX_EVENT_CHARS, TRACE_EXPORT_PATH,
+    CASSETTE_MODE, CASSETTE_PATH, CASSETTE_REPLAY_SPEED
+)
+from cassette import (
+    CassettePlayer, CassetteWriter, RecordingMCPPool, RecordingOllama, ReplayMCPPool, ReplayOllama,
+    load_cassette
+)
+from llm_stages import LLMStages
+from llm_scheduler import LLMScheduler, SchedulerOverloaded, PRIORITY_ROUTING, PRIORITY_SUMMARIZE
+from mcp_pool import MCPSessionPool
+from metrics import (
+    REQUEST_ID_HEADER, REQUESTS, REQUEST_DURATION, MCP_CALL_DURATION,
+    install_request_id_logging, new_request_id, observe_ollama_timings, observe_stage,
+    current_request_id, registry, request_id_var, stage_timer
+)
+from ollama_client import OllamaError
+from ollama_pool import close_ollama_pool, get_ollama_pool
+from output_compactor import OutputCompactor
+from prefetch import Prefetch, SpeculativePrefetcher
+from prompt_cache import RoutingPrefix, RoutingPrefixCache
+from response_cache import ResponseCache, flight_key
+from response_modes import ResponseRenderer
+from server_registry import ServerRegistry
+from singleflight import SingleFlight
+from structured_output import JsonObjectScanner, build_routing_schema, validate_args
+from tool_catalog import CatalogEntry, ToolCatalog, estimate_tokens
+from tool_discovery import ToolDiscovery
+from tool_policies import get_tool_policy
+from tool_result_cache import ToolResultCache
+from tool_router import ToolIndex, ToolRouter
+from trace_store import TraceStore
+from tools import extract_structured_content, extract_text_content, extract_text_parts
 
-logging.basicConfig(level=LOG_LEVEL)
+install_request_id_logging()
+logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
 logger = logging.getLogger("MCPAgent")
 
 
@@ -24,47 +73,194 @@ class UserQueryRequest(BaseModel):
     user_input: str
 
 
+class ToolCall(BaseModel):
+    tool_name: Optional[str] = None
+    args: Dict[str, Any] = {}
+    reply: Optional[str] = None
+    ok: bool = False
+
+
 class AgentResponse(BaseModel):
     tool_name: Optional[str] = None
     args: Dict[str, Any] = {}
     reply: Optional[str] = None
+    # Вызовы инструментов, если запрос потребовал несколько
+    calls: List[ToolCall] = []
+
+
+class QueryAbandoned(Exception):
+    """Обработка запроса, к которой присоединились другие, прервана"""
+
+
+def overloaded_event(error: SchedulerOverloaded) -> Dict[str, Any]:
+    return {
+        "event": "error",
+        "status": 503,
+        "retry_after": round(error.retry_after, 1),
+        "reply": "Сервер перегружен, попробуйте позже",
+    }
+
+
+def routing_user_part(user_input: str) -> str:
+    """Изменяемая часть промпта выбора инструмента — идёт после статичного префикса"""
+    return f"Запрос пользователя: {user_input}\n"
+
+
+def plan_calls(decision: Optional[Dict[str, Any]], max_calls: int) -> List[Dict[str, Any]]:
+    """
+    Вызовы из ответа выбора инструмента: один {"function", "args"}
+    или план {"calls": [...]}; повторы одного и того же вызова убираются
+    """
+    if not isinstance(decision, dict):
+        return []
+    if "function" in decision:
+        return [decision]
+    calls, seen = [], set()
+    for call in decision.get("calls") or []:
+        if not isinstance(call, dict) or "function" not in call:
+            continue
+        key = (call["function"], json.dumps(call.get("args") or {}, sort_keys=True, default=str))
+        if key in seen:
+            continue
+        seen.add(key)
+        calls.append(call)
+    return calls[:max_calls]
+
+
+def arguments_prompt(tool: Any, user_input: str) -> str:
+    """Промпт извлечения аргументов для инструмента, уже выбранного без LLM"""
+    schema = json.dumps(getattr(tool, "inputSchema", None) or {}, ensure_ascii=False)
+    return (
+        f"Аргументы инструмента {tool.name}: {tool.description or ''}\n"
+        f"Схема аргументов: {schema}\n"
+        f"Извлеки из запроса пользователя аргументы для этого инструмента. "
+        f'Ответь только JSON: {{"function": "{tool.name}", "args": {{...}}}}\n'
+        f"{routing_user_part(user_input)}"
+    )
+
+
+def parse_llm_reply(text: str) -> Dict[str, Any]:
+    # Проверяем, является ли ответ валидным JSON
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        #logger.warning("LLM вернул текст вместо JSON")
+        return {"response": text}
 
 
 class MCPAgent:
     def __init__(self):
         self.tools_map: Dict[str, Tool] = {}
-        self.mcp_clients: Dict[str, Client] = {}
+        # Реплики MCP-серверов: выбор наименее загруженной, отключение сбоящих, проверки в фоне
+        self.servers = ServerRegistry(
+            MCP_SERVERS_CONFIG, MCP_BREAKER_FAILURE_THRESHOLD, MCP_BREAKER_RESET_TIMEOUT,
+            MCP_HEALTH_PROBE_INTERVAL, MCP_HEALTH_PROBE_TIMEOUT
+        )
+        # Долгоживущие MCP-сессии, переиспользуются между запросами
+        self.session_pool = MCPSessionPool(
+            self.servers,
+            MCP_SERVERS_CONFIG,
+            max_sessions_per_server=MCP_POOL_MAX_SESSIONS_PER_SERVER,
+            connect_timeout=MCP_POOL_CONNECT_TIMEOUT,
+            on_tools_changed=lambda server_name: self.discovery.request_refresh(server_name)
+        )
+        self.mcp_pool = self.session_pool
+        # Хосты Ollama: выбор хоста, где модель уже в памяти, keep-alive соединения к каждому
+        self.ollama_pool = get_ollama_pool()
+        self.ollama = self.ollama_pool
+        # Допуск запросов к Ollama: ограничение параллельности и очередь с приоритетами
+        self.llm_scheduler = LLMScheduler(
+            LLM_MAX_CONCURRENCY, LLM_MAX_QUEUE, LLM_QUEUE_TIMEOUTS, LLM_SHED_PREDICTED
+        )
+        # Модели и параметры генерации по стадиям, повтор на большой модели
+        self.llm_stages = LLMStages()
+        # Векторный индекс инструментов для выбора без LLM
+        self.tool_index = ToolIndex(TOOL_ROUTER_DIM)
+        self.router = ToolRouter(self.tool_index, TOOL_ROUTER_MIN_SCORE, TOOL_ROUTER_MIN_MARGIN)
+        # Отобранные и заранее отрендеренные описания инструментов для промпта
+        self.tool_catalog = ToolCatalog(
+            self.tool_index, TOOL_CATALOG_TOP_K, TOOL_CATALOG_TOKEN_BUDGET, PROMPT_CHARS_PER_TOKEN
+        )
+        # Статичные префиксы промпта выбора инструмента, версия — версия каталога
+        self.prefix_cache = RoutingPrefixCache(ROUTING_PREFIX_CACHE_SIZE)
+        # Кэш итоговых ответов по нормализованному запросу
+        self.response_cache = ResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_PATH)
+        # Кэш результатов инструментов по (инструмент, аргументы)
+        self.tool_results = ToolResultCache(TOOL_RESULT_CACHE_MAX_ENTRIES)
+        # Обрабатываемые сейчас запросы: дубликаты присоединяются к ним
+        self.inflight_queries = SingleFlight()
+        # Режимы ответа по результату инструмента: как есть, по шаблону или пересказ LLM
+        self.response_renderer = ResponseRenderer(RESPONSE_BYPASS_MAX_CHARS, RESPONSE_BYPASS_MIN_ALPHA_RATIO)
+        # Сжатие результата инструмента под бюджет токенов RAG-промпта
+        self.output_compactor = OutputCompactor(
+            TOOL_OUTPUT_TOKEN_BUDGET, TOOL_OUTPUT_CHUNK_TOKENS, TOOL_OUTPUT_STREAM_MIN_CHARS,
+            PROMPT_CHARS_PER_TOKEN
+        )
+        # Отладочные трассы запросов вместо печати промптов в stdout
+        self.traces = TraceStore(
+            TRACE_SAMPLE_RATE, TRACE_MAX_TRACES, TRACE_MAX_CHARS, TRACE_MAX_EVENT_CHARS, TRACE_EXPORT_PATH
+        )
+        # Вызов предсказанного инструмента параллельно с LLM (опционально)
+        self.prefetch_enabled = PREFETCH_ENABLED
+        self.prefetcher = SpeculativePrefetcher(
+            self.tool_index, PREFETCH_HISTORY_SIZE, PREFETCH_MIN_SIMILARITY, PREFETCH_MIN_SCORE
+        )
+        # Запись обращений к Ollama и MCP в кассету или ответы из неё вместо Ollama и MCP
+        self.cassette: Optional[Any] = None
+        if CASSETTE_MODE == "record":
+            self.cassette = CassetteWriter(CASSETTE_PATH)
+            self.ollama = RecordingOllama(self.ollama, self.cassette)
+            self.mcp_pool = RecordingMCPPool(self.mcp_pool, self.cassette, MCP_SERVERS_CONFIG)
+        elif CASSETTE_MODE == "replay":
+            self.cassette = CassettePlayer(load_cassette(CASSETTE_PATH), CASSETTE_REPLAY_SPEED)
+            self.ollama = ReplayOllama(self.cassette)
+            self.mcp_pool = ReplayMCPPool(self.cassette)
+            logger.info(f"Replaying Ollama and MCP from {CASSETTE_PATH} (speed {CASSETTE_REPLAY_SPEED})")
+        # Опрос серверов MCP одновременно, снимок каталога на диске и фоновое обновление
+        self.discovery = ToolDiscovery(
+            self.mcp_pool, MCP_SERVERS_CONFIG, MCP_DISCOVERY_TIMEOUT, MCP_DISCOVERY_REFRESH_INTERVAL,
+            MCP_TOOLS_SNAPSHOT_PATH, self.set_tools
+        )
 
     async def discover_tools(self):
         """Обнаружение инструментов через MCP"""
         logger.info("Discovering tools from MCP servers...")
+        await self.discovery.refresh()
 
-        for server_name, server_config in MCP_SERVERS_CONFIG.items():
-            url = server_config["url"]
-            transport = server_config.get("transport", "default")
-            try:
-                # Формируем config точно так, как в рабочем скрипте
-                full_config = {
-                    "mcpServers": {
-                        server_name: {
-                            "url": url,
-                            "transport": transport
-                        }
-                    }
-                }
+    async def start_discovery(self):
+        """
+        Запуск: если есть снимок каталога — отвечаем по нему сразу, серверы опрашиваются в фоне;
+        иначе ждём опроса (не дольше MCP_DISCOVERY_TIMEOUT)
+        """
+        from_snapshot = self.discovery.load_snapshot()
+        if not from_snapshot:
+            await self.discover_tools()
+        self.discovery.start(refresh_now=from_snapshot)
+        if CASSETTE_MODE != "replay":
+            self.servers.start(self.session_pool.ping)
+
+    async def start_sessions(self):
+        """Сессии к репликам MCP-серверов открываются при запуске, а не первым запросом"""
+        if CASSETTE_MODE == "replay":
+            return
+        await self.session_pool.warm_up()
 
-                # Создаём клиент
-                client = Client(full_config)
-                self.mcp_clients[server_name] = client
-
-                async with client:
-                    tools = await client.list_tools()
-                    for tool in tools:
-                        tool.server_url = url  # сохраняем URL для дальнейшего вызова
-                        self.tools_map[tool.name] = tool
-                        logger.info(f"Found tool '{tool.name}' on {server_name}")
-            except Exception as e:
-                logger.error(f"Can't connect to server {url}: {e}")
+    async def start_ollama(self):
+        """Загрузка моделей на хосты Ollama и продление их keep_alive (при воспроизведении кассеты — не нужно)"""
+        if CASSETTE_MODE == "replay":
+            return
+        await self.ollama_pool.warm_up()
+        self.ollama_pool.start()
+
+    def set_tools(self, tools_map: Dict[str, Any], tool_servers: Dict[str, str]):
+        """
+        Замена каталога целиком: запросы видят либо старый, либо новый tools_map.
+        Кэши ключуются версией каталога (tool_catalog.version), она меняется вместе с ним
+        """
+        self.tool_index.update(tools_map)
+        self.tool_catalog.update(tools_map)
+        self.servers.set_tool_servers(tool_servers)
+        self.tools_map = tools_map
     # async def discover_tools(self):
     #     print("""Обнаружение инструментов через MCP""")
     #     logger.info("Discovering tools from MCP servers...")
@@ -90,59 +286,253 @@ class MCPAgent:
     #         except Exception as e:
     #             logger.error(f"Can't connect to server {server_config['url']}: {e}")
 
-    def build_prompt_for_llm(self, user_input: str) -> str:
-        """Формирует промпт для LLM с описанием инструментов"""
-        prompt = "Ты помощник, который должен выбрать подходящий инструмент. При выборе инструмента обращай внимание на описание\n"
-        prompt += "Доступные инструменты:\n\n"
+    def build_routing_prefix(self, entries: List[CatalogEntry]) -> str:
+        """Статичная часть промпта выбора инструмента: инструкция, инструменты и формат ответа"""
+        parts = [
+            "Ты помощник, который должен выбрать подходящий инструмент. При выборе инструмента обращай внимание на описание\n",
+            "Доступные инструменты:\n\n",
+        ]
+        # Описания инструментов отрендерены заранее, здесь только нумерация
+        for i, entry in enumerate(entries, start=1):
+            parts.append(f"{i}. {entry.text}")
 
-        for i, (name, tool) in enumerate(self.tools_map.items(), start=1):
-            description = getattr(tool, "description", "Нет описания")
-            input_schema = getattr(tool, "inputSchema", {})
+        parts.append(
+            "ОТВЕЧАЙ ТОЛЬКО JSON, БЕЗ ЛИШНИХ СЛОВ:\n"
+            "{\n"
+            '  "function": "...",\n'
+            '  "args": {...}\n'
+            "}\n\n"
+        )
+        if ROUTING_MULTI_TOOL:
+            parts.append(
+                "Если для ответа нужны данные нескольких инструментов, перечисли все независимые вызовы:\n"
+                '{"calls": [{"function": "...", "args": {...}}, {"function": "...", "args": {...}}]}\n\n'
+            )
+        return "".join(parts)
 
-            prompt += f"{i}. Инструмент: {name}\n"
-            prompt += f"   Описание: {description}\n"
-            prompt += f"   Параметры: {input_schema}\n\n"
+    def get_routing_prefix(self, user_input: str) -> RoutingPrefix:
+        """
+        Префикс промпта (из кэша, если уже собран). При переиспользовании префикса в нём
+        весь каталог — префикс один на версию каталога; без него — отобранные под запрос инструменты
+        """
+        if ROUTING_PREFIX_MODE == "off":
+            entries = self.tool_catalog.select(user_input)
+        else:
+            entries = self.tool_catalog.stable()
+        return self.prefix_cache.get(
+            self.tool_catalog.version,
+            tuple(entry.name for entry in entries),
+            lambda: self.build_routing_prefix(entries)
+        )
 
-        prompt += f"Запрос пользователя: {user_input}\n\n"
-        prompt += "ОТВЕЧАЙ ТОЛЬКО JSON, БЕЗ ЛИШНИХ СЛОВ:\n"
-        prompt += "{\n"
-        prompt += '  "function": "...",\n'
-        prompt += '  "args": {...}\n'
-        prompt += "}\n"
+    def build_prompt_for_llm(self, user_input: str, prefix: Optional[RoutingPrefix] = None) -> str:
+        """Формирует промпт для LLM с описанием инструментов"""
+        prefix = prefix or self.get_routing_prefix(user_input)
+        prompt = prefix.text + routing_user_part(user_input)
 
+        logger.info(
+            f"Routing prompt: {len(prefix.key[1])}/{len(self.tool_catalog.entries)} tools, "
+            f"{len(prompt)} chars, ~{estimate_tokens(prompt, PROMPT_CHARS_PER_TOKEN)} tokens"
+        )
         #logger.debug(f"Сформированный промпт:\n{prompt}")
-        print(prompt)
+        self.traces.event("routing_prompt", prompt)
         return prompt
-    async def query_ollama(self, prompt: str) -> Optional[Dict[str, Any]]:
-        """Вызывает Ollama API для получения JSON-ответа"""
-        import aiohttp
 
-        payload = {
-            "model": "llama3",
-            "prompt": prompt,
-            "stream": False
-        }
+    async def prime_routing_prefix(self, prefix: RoutingPrefix):
+        """Прогоняет префикс через Ollama один раз и запоминает его context"""
+        async with prefix.lock:
+            if prefix.context is not None:
+                return
+            # context привязан к модели: префикс прогоняется моделью стадии routing.
+            # num_predict 0 — без генерации, иначе сгенерированный токен попал бы в context перед вопросом
+            data = await self.ollama.generate(
+                prefix.text, **self.llm_stages.params("routing", keep_alive=OLLAMA_KEEP_ALIVE, options={"num_predict": 0})
+            )
+            if "prompt_eval_duration" in data:
+                self.prefix_cache.prefill.record(False, data["prompt_eval_duration"] / 1e6,
+                                                 data.get("prompt_eval_count", 0))
+            prefix.context = data.get("context") or []
+            prefix.warm = True
+
+    def routing_format_schema(self, prefix: RoutingPrefix) -> Dict[str, Any]:
+        """JSON Schema ответа для отобранных в префикс инструментов"""
+        if prefix.format_schema is None:
+            tools = [self.tools_map[name] for name in prefix.key[1] if name in self.tools_map]
+            prefix.format_schema = build_routing_schema(
+                tools, MULTI_TOOL_MAX_CALLS if ROUTING_MULTI_TOOL else 1
+            )
+        return prefix.format_schema
+
+    def routing_problem(self, decision: Any) -> Optional[str]:
+        """Почему решение выбора инструмента нельзя выполнить (None — можно)"""
+        if decision is None:
+            return "no_reply"
+        calls = plan_calls(decision, MULTI_TOOL_MAX_CALLS if ROUTING_MULTI_TOOL else 1)
+        if not calls:
+            return "invalid_reply"
+        for call in calls:
+            tool = self.tools_map.get(call["function"])
+            if tool is None:
+                return "unknown_tool"
+            _, errors = validate_args(call.get("args") or {}, getattr(tool, "inputSchema", None) or {})
+            if errors:
+                return "invalid_args"
+        return None
+
+    async def route_llm(self, user_input: str) -> Optional[Dict[str, Any]]:
+        """Выбор инструмента небольшой моделью; ответ, не прошедший проверку, — повтор на модели эскалации"""
+        decision = await self.query_routing_llm(user_input)
+        problem = self.routing_problem(decision)
+        if problem is None or not self.llm_stages.can_escalate("routing"):
+            return decision
+        self.llm_stages.escalate("routing", problem)
+        self.traces.event("routing_escalation", {"reason": problem, "decision": decision})
+        return await self.query_routing_llm(user_input, escalated=True)
+
+    async def query_routing_llm(self, user_input: str, escalated: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        Выбор инструмента через LLM. Статичный префикс промпта отправляется так,
+        чтобы Ollama переиспользовала уже обработанный контекст и prefill
+        приходился только на текст пользователя.
+        Ответ читается потоком и обрывается, как только JSON-объект закрылся.
+        escalated — повтор на модели эскалации стадии routing
+        """
+        with stage_timer("prompt_build"):
+            prefix = self.get_routing_prefix(user_input)
+            prompt = self.build_prompt_for_llm(user_input, prefix)
+        warm = prefix.warm and not escalated
+        # context префикса получен моделью стадии, модели эскалации промпт отправляется целиком
+        mode = "off" if escalated and ROUTING_PREFIX_MODE == "context" else ROUTING_PREFIX_MODE
+
+        params = self.llm_stages.params("routing", escalated, keep_alive=OLLAMA_KEEP_ALIVE)
+        if ROUTING_STRUCTURED_OUTPUT:
+            # Ollama ограничивает генерацию схемой: только известные инструменты и их параметры
+            params["format"] = self.routing_format_schema(prefix)
+
+        scanner = JsonObjectScanner()
+        parts: List[str] = []
+        final: Dict[str, Any] = {}
+        first_token_ms = None
+        try:
+            async with self.llm_scheduler.slot(PRIORITY_ROUTING):
+                started = time.perf_counter()
+                if mode == "chat":
+                    stream = self.ollama.chat_stream(
+                        [
+                            {"role": "system", "content": prefix.text},
+                            {"role": "user", "content": routing_user_part(user_input)},
+                        ],
+                        **params
+                    )
+                elif mode == "context":
+                    await self.prime_routing_prefix(prefix)
+                    warm = True
+                    started = time.perf_counter()
+                    stream = self.ollama.generate_stream(
+                        routing_user_part(user_input), context=prefix.context, **params
+                    )
+                else:
+                    stream = self.ollama.generate_stream(prompt, **params)
+
+                # aclosing закрывает соединение при выходе из цикла — Ollama прекращает генерацию
+                async with aclosing(stream) as chunks:
+                    async for chunk in chunks:
+                        token = chunk.get("message", {}).get("content", "") if "message" in chunk \
+                            else chunk.get("response", "")
+                        if token and first_token_ms is None:
+                            first_token_ms = 1000 * (time.perf_counter() - started)
+                        parts.append(token)
+                        if chunk.get("done"):
+                            final = chunk
+                            break
+                        if scanner.feed(token):
+                            logger.info(f"Routing JSON complete after {len(parts)} chunks, stopping generation")
+                            break
+        except OllamaError as e:
+            logger.error(f"Ошибка при обращении к Ollama: {e}", exc_info=True)
+            self.llm_stages.record("routing", params["model"], time.perf_counter() - started, escalated, ok=False)
+            return None
+        total_ms = 1000 * (time.perf_counter() - started)
+        observe_stage("routing_llm", total_ms / 1000)
+        self.llm_stages.record("routing", params["model"], total_ms / 1000, escalated)
+
+        # Если генерацию оборвали, итоговых метрик Ollama нет — берём время до первого токена
+        if "prompt_eval_duration" in final:
+            prefill_ms = final["prompt_eval_duration"] / 1e6
+            observe_ollama_timings("routing", final)
+        else:
+            prefill_ms = first_token_ms
+            if first_token_ms is not None:
+                observe_stage("routing_prefill", first_token_ms / 1000)
+                observe_stage("routing_generation", (total_ms - first_token_ms) / 1000)
+        if prefill_ms is not None and not escalated:
+            self.prefix_cache.prefill.record(warm, prefill_ms, final.get("prompt_eval_count", 0))
+            logger.info(
+                f"Routing prefill ({'warm' if warm else 'cold'}, mode={ROUTING_PREFIX_MODE}): "
+                f"{final.get('prompt_eval_count', '?')} tokens, {prefill_ms:.1f} ms"
+            )
+        if ROUTING_PREFIX_MODE != "off" and not escalated:
+            prefix.warm = True
+
+        return scanner.result() or parse_llm_reply("".join(parts))
 
-        async with aiohttp.ClientSession() as session:
+    async def extract_args_llm(self, user_input: str, tool_name: str) -> Optional[Dict[str, Any]]:
+        """
+        Аргументы для инструмента, выбранного без LLM (стадия arguments): в промпте только он один.
+        Аргументы не по схеме — повтор на модели эскалации; None — не удалось
+        """
+        tool = self.tools_map[tool_name]
+        schema = getattr(tool, "inputSchema", None) or {}
+        prompt = arguments_prompt(tool, user_input)
+        params: Dict[str, Any] = {"keep_alive": OLLAMA_KEEP_ALIVE}
+        if ROUTING_STRUCTURED_OUTPUT:
+            params["format"] = build_routing_schema([tool])
+
+        for escalated in (False, True):
+            stage_params = self.llm_stages.params("arguments", escalated, **params)
+            started = time.perf_counter()
             try:
-                async with session.post(OLLAMA_API_URL, json=payload) as res:
-                    if res.status == 200:
-                        data = await res.text()
-                        lines = data.strip().split('\n')
-                        last_line = json.loads(lines[-1])
-                        
-                        # Проверяем, является ли "response" валидным JSON
-                        try:
-                            return json.loads(last_line["response"])
-                        except json.JSONDecodeError:
-                            #logger.warning("LLM вернул текст вместо JSON")
-                            return {"response": last_line["response"]}
-                    else:
-                        logger.error(f"Ollama API error: {res.status} — {await res.text()}")
-                        return None
-            except Exception as e:
+                async with self.llm_scheduler.slot(PRIORITY_ROUTING):
+                    started = time.perf_counter()
+                    data = await self.ollama.generate(prompt, **stage_params)
+            except OllamaError as e:
                 logger.error(f"Ошибка при обращении к Ollama: {e}", exc_info=True)
+                self.llm_stages.record("arguments", stage_params["model"], time.perf_counter() - started,
+                                       escalated, ok=False)
+                problem = "no_reply"
+            else:
+                elapsed = time.perf_counter() - started
+                observe_stage("arguments_llm", elapsed)
+                self.llm_stages.record("arguments", stage_params["model"], elapsed, escalated)
+                reply = parse_llm_reply(data.get("response", ""))
+                args = reply.get("args") if isinstance(reply, dict) else None
+                _, errors = validate_args(args, schema)
+                if not errors:
+                    self.traces.event("arguments", {"tool_name": tool_name, "args": args, "escalated": escalated})
+                    return args
+                problem = "invalid_args"
+            if escalated or not self.llm_stages.can_escalate("arguments"):
                 return None
+            self.llm_stages.escalate("arguments", problem)
+        return None
+
+    async def query_ollama(self, prompt: str, priority: int = PRIORITY_SUMMARIZE) -> Optional[Dict[str, Any]]:
+        """Вызывает Ollama API для получения JSON-ответа"""
+        params = self.llm_stages.params("summarize")
+        started = time.perf_counter()
+        try:
+            async with self.llm_scheduler.slot(priority):
+                started = time.perf_counter()
+                with stage_timer("summarize_llm"):
+                    data = await self.ollama.generate(prompt, **params)
+        except OllamaError as e:
+            logger.error(f"Ошибка при обращении к Ollama: {e}", exc_info=True)
+            self.llm_stages.record("summarize", params["model"], time.perf_counter() - started, ok=False)
+            return None
+        self.llm_stages.record("summarize", params["model"], time.perf_counter() - started)
+        observe_ollama_timings("summarize", data)
+
+        return parse_llm_reply(data["response"])
     # async def query_ollama(self, prompt: str) -> Optional[Dict[str, Any]]:
     #     """Вызывает Ollama API для выбора инструмента"""
     #     import aiohttp
@@ -167,107 +557,564 @@ class MCPAgent:
     #                 logger.error(f"Ollama API error: {res.status} — {await res.text()}")
     #                 return None
 
-    async def process_query(self, user_input: str) -> AgentResponse:
-        """Основной метод обработки запроса от пользователя"""
-        logger.info(f"Processing user input: {user_input}")
-
+    async def call_selected_tool(self, user_input: str, on_event: Optional[Callable[[Dict[str, Any]], None]] = None
+                                 ) -> Tuple[AgentResponse, Optional[Any]]:
+        """
+        Выбор инструмента (или нескольких) через LLM и вызов.
+        Возвращает ответ с текстом результата и сам результат (None — инструмент не вызван или ошибка);
+        для плана из нескольких вызовов — список результатов по порядку response.calls.
+        on_event — события /query/stream во время вызова одного инструмента (см. call_tool)
+        """
         if not self.tools_map:
-            return AgentResponse(reply="Нет доступных инструментов")
+            return AgentResponse(reply="Нет доступных инструментов"), None
 
-        prompt = self.build_prompt_for_llm(user_input)
-        decision = await self.query_ollama(prompt)
+        prefetch = None
+        decision = None
+        fast_route = self.router.route(user_input, self.tools_map) if TOOL_ROUTER_ENABLED else None
+        try:
+            if fast_route is not None:
+                tool_name, args = fast_route
+                if args is None:
+                    # Инструмент однозначен, аргументы из текста запроса достаёт LLM
+                    args = await self.extract_args_llm(user_input, tool_name)
+                if args is not None:
+                    decision = {"function": tool_name, "args": args}
+            if decision is None:
+                if self.prefetch_enabled:
+                    # Пока LLM выбирает, вероятный инструмент уже вызывается
+                    prefetch = self.prefetcher.start(user_input, self.tools_map, self.prefetch_call)
+                decision = await self.route_llm(user_input)
+                if self.prefetch_enabled and isinstance(decision, dict) and decision.get("function") in self.tools_map:
+                    self.prefetcher.record(user_input, decision["function"])
 
-        print(f"[DEBUG] LLM выбор mcp сервера: {decision}")
+            self.traces.event("routing_decision", decision)
 
-        if not decision or "function" not in decision:
-            return AgentResponse(reply="Не удалось определить действие")
+            calls = plan_calls(decision, MULTI_TOOL_MAX_CALLS if ROUTING_MULTI_TOOL else 1)
+            if not calls:
+                return AgentResponse(reply="Не удалось определить действие"), None
+            if len(calls) == 1:
+                return await self.call_tool(calls[0], prefetch, on_event)
+            return await self.call_tools_parallel(calls, prefetch)
+        finally:
+            self.prefetcher.release(prefetch)
 
+    def prefetch_call(self, tool_name: str, args: Dict[str, Any]) -> Optional[Awaitable[Any]]:
+        """Корутина вызова инструмента для упреждающего запуска (None — сервер не найден)"""
+        server_name = self.servers.server_for(tool_name)
+        if not server_name:
+            return None
+        policy = get_tool_policy(tool_name)
+        return self.tool_results.get_or_call(
+            tool_name, args, policy,
+            lambda: self.mcp_pool.call_tool(
+                server_name, tool_name, args, idempotent=policy.get("side_effect_free", False)
+            )
+        )
+
+    async def call_tools_parallel(self, calls: List[Dict[str, Any]],
+                                  prefetch: Optional[Prefetch] = None) -> Tuple[AgentResponse, Optional[List[Any]]]:
+        """
+        Независимые вызовы плана выполняются одновременно, у каждого свой таймаут.
+        Ошибка одного вызова не отменяет остальные
+        """
+        logger.info(f"Executing {len(calls)} tool calls in parallel: {[call['function'] for call in calls]}")
+        outcomes = await asyncio.gather(*(self.call_tool(call, prefetch) for call in calls), return_exceptions=True)
+
+        tool_calls: List[ToolCall] = []
+        results: List[Any] = []
+        for call, outcome in zip(calls, outcomes):
+            if isinstance(outcome, BaseException):
+                logger.error(f"Tool call {call['function']} failed: {outcome}")
+                tool_calls.append(ToolCall(
+                    tool_name=call["function"], args=call.get("args") or {},
+                    reply=f"Ошибка при вызове инструмента: {outcome}"
+                ))
+                results.append(None)
+                continue
+            response, result = outcome
+            ok = result is not None
+            # Полный результат (бывает в мегабайты) идёт только в RAG-промпт через results;
+            # в ответе клиенту у успешного вызова — краткий статус, текст — только у ошибки
+            reply = f"получен результат ({len(response.reply or '')} символов)" if ok else response.reply
+            tool_calls.append(ToolCall(
+                tool_name=response.tool_name or call["function"], args=response.args, reply=reply, ok=ok
+            ))
+            results.append(result)
+
+        reply = "\n\n".join(f"{call.tool_name}: {call.reply}" for call in tool_calls)
+        response = AgentResponse(reply=reply, calls=tool_calls)
+        if not any(call.ok for call in tool_calls):
+            return response, None
+        return response, results
+
+    async def call_tool(self, decision: Dict[str, Any], prefetch: Optional[Prefetch] = None,
+                        on_event: Optional[Callable[[Dict[str, Any]], None]] = None
+                        ) -> Tuple[AgentResponse, Optional[Any]]:
+        """
+        Вызов одного инструмента по решению {"function", "args"}.
+        Для инструмента с политикой stream_progress в on_event сразу уходит событие tool,
+        а текст уведомлений о прогрессе — событиями token
+        """
         tool_name = decision["function"]
-        args = decision.get("args", {})
+        args = decision.get("args") or {}
 
         if tool_name not in self.tools_map:
-            return AgentResponse(reply=f"Неизвестный инструмент: {tool_name}")
+            return AgentResponse(reply=f"Неизвестный инструмент: {tool_name}"), None
 
         tool = self.tools_map[tool_name]
-        server_url = getattr(tool, "server_url", None)
 
-        if not server_url:
-            logger.warning(f"No server URL found for tool {tool_name}")
-            return AgentResponse(reply="Ошибка: сервер не найден")
-
-        # Ищем имя сервера по URL
-        server_name = None
-        for name, conf in MCP_SERVERS_CONFIG.items():
-            if conf["url"] == server_url:
-                server_name = name
-                break
+        # Аргументы проверяются по схеме до вызова, а не ошибкой на сервере MCP
+        args, errors = validate_args(args, getattr(tool, "inputSchema", None) or {})
+        if errors:
+            logger.warning(f"Invalid args for {tool_name}: {errors}")
+            reply = f"Некорректные аргументы для инструмента {tool_name}: {'; '.join(errors)}"
+            return AgentResponse(tool_name=tool_name, args=args, reply=reply), None
+        # Сервер инструмента — из индекса, построенного при обнаружении
+        server_name = self.servers.server_for(tool_name)
 
         if not server_name:
-            return AgentResponse(reply="Ошибка: конфигурация сервера не найдена")
-
-        # Создаём новый клиент для этого вызова
-        server_config = MCP_SERVERS_CONFIG[server_name]
+            logger.warning(f"No server found for tool {tool_name}")
+            return AgentResponse(reply="Ошибка: сервер не найден"), None
 
-        config = {
-            "mcpServers": {
-                server_name: {
-                    "url": server_config["url"],
-                    "transport": server_config["transport"]
-                }
-            }
-        }
+        policy = get_tool_policy(tool_name)
+        timeout = policy.get("call_timeout", TOOL_CALL_TIMEOUT)
+        progress_handler = None
+        if on_event is not None and policy.get("stream_progress"):
+            on_event({"event": "tool", "tool_name": tool_name, "args": args})
 
-        client = Client(config)
+            async def progress_handler(progress: float, total: Optional[float], message: Optional[str]):
+                if message:
+                    on_event({"event": "token", "text": message})
 
+        # Если этот вызов уже начат заранее, ждём его, а не вызываем повторно
+        call = self.prefetcher.claim(prefetch, tool_name, args) or self.tool_results.get_or_call(
+            tool_name, args, policy,
+            # Сессия берётся из пула, а не создаётся на каждый вызов;
+            # идемпотентные инструменты отвечают из кэша результатов
+            lambda: self.mcp_pool.call_tool(
+                server_name, tool_name, args, progress_handler, idempotent=policy.get("side_effect_free", False)
+            )
+        )
+        started = time.perf_counter()
+        status = "error"
         try:
-            async with client:
-                result = await client.call_tool(tool_name, args)
-                # Логируем полный ответ от сервера
-                #print(f"[DEBUG] Raw MCP response: {result}")
-                #logger.debug(f"Raw MCP response for {tool_name}: {result}")
+            result = await asyncio.wait_for(call, timeout)
+            status = "ok"
+            # Логируем полный ответ от сервера
+            #print(f"[DEBUG] Raw MCP response: {result}")
+            #logger.debug(f"Raw MCP response for {tool_name}: {result}")
 
+            with stage_timer("output_extraction"):
                 reply = extract_text_content(result)
-                print(f"[DEBUG] extract_text_content: {reply}")
+            self.traces.event("tool_output", {"tool_name": tool_name, "output": reply})
+        except asyncio.TimeoutError:
+            status = "timeout"
+            logger.error(f"Tool {tool_name} timed out after {timeout} s")
+            reply = f"Инструмент {tool_name} не ответил за {timeout} с"
+            return AgentResponse(tool_name=tool_name, args=args, reply=reply), None
+        except Exception as e:
+            logger.error(f"Ошибка при вызове инструмента: {e}", exc_info=True)
+            reply = f"Ошибка при вызове инструмента: {str(e)}"
+            return AgentResponse(tool_name=tool_name, args=args, reply=reply), None
+        finally:
+            elapsed = time.perf_counter() - started
+            MCP_CALL_DURATION.observe(elapsed, server=server_name, tool=tool_name, status=status)
+            observe_stage("mcp_call", elapsed)
 
-                rag_prompt = f"""
-                Пользователь спросил: "{user_input}"
+        return AgentResponse(tool_name=tool_name, args=args, reply=reply), result
 
-                Вот данные, полученные от MCP-инструмента:
-                {reply}
+    async def prepare_reply(self, user_input: str, response: AgentResponse, result: Any) -> Optional[str]:
+        """
+        Ответ по режиму инструмента без LLM (записывается в response.reply)
+        или RAG-промпт со сжатым результатом, если его нужно пересказать
+        """
+        if response.calls:
+            return await self.prepare_plan_prompt(user_input, response, result)
 
-                В полученных данных MCP-инструмента найди ответ на вопрос и сделай человекочитаемый вывод только на русском языке.
-                """
-                #logger.debug(f"RAG-промпт для LLM:\n{rag_prompt}")
-                print(f"[DEBUG] RAG-промпт для LLM: {rag_prompt}")
-                rag_response = await self.query_ollama(rag_prompt)
-                print(f"[DEBUG] RAG-ответ от LLM: {rag_response}")
+        policy = get_tool_policy(response.tool_name)
+        reply = self.response_renderer.render(
+            response.tool_name, policy, response.reply, extract_structured_content(result)
+        )
+        if reply is not None:
+            logger.info(f"Reply for {response.tool_name} built without LLM summarization")
+            response.reply = reply
+            return None
 
-                reply = rag_response.get("response", "Не могу интерпретировать данные") \
-                    if isinstance(rag_response, dict) else "LLM не вернул текстовый ответ"
+        # Разбор и отбор записей большого результата — в потоке, чтобы не блокировать event loop
+        with stage_timer("output_compaction"):
+            tool_output = await asyncio.to_thread(
+                self.output_compactor.compact, response.tool_name, policy, user_input, extract_text_parts(result)
+            )
+        return self.build_rag_prompt(user_input, tool_output)
 
+    async def prepare_plan_prompt(self, user_input: str, response: AgentResponse, results: List[Any]) -> str:
+        """
+        Один RAG-промпт по результатам всех вызовов плана: бюджет токенов делится между
+        успешными вызовами, неудачные попадают в промпт текстом ошибки
+        """
+        succeeded = [call for call in response.calls if call.ok]
+        budget = max(1, TOOL_OUTPUT_TOKEN_BUDGET // len(succeeded))
 
-        except Exception as e:
-            logger.error(f"Ошибка при вызове инструмента: {e}", exc_info=True)
-            reply = f"Ошибка при вызове инструмента: {str(e)}"
+        async def section(call: ToolCall, result: Any) -> str:
+            header = f"Инструмент {call.tool_name} ({json.dumps(call.args, ensure_ascii=False)})"
+            if not call.ok:
+                return f"{header}: {call.reply}"
+            output = await asyncio.to_thread(
+                self.output_compactor.compact, call.tool_name, get_tool_policy(call.tool_name),
+                user_input, extract_text_parts(result), budget
+            )
+            return f"{header}:\n{output}"
+
+        with stage_timer("output_compaction"):
+            sections = await asyncio.gather(
+                *(section(call, result) for call, result in zip(response.calls, results))
+            )
+        return self.build_rag_prompt(user_input, "\n\n".join(sections))
 
-        return AgentResponse(tool_name=tool_name, args=args, reply=reply)
+    def build_rag_prompt(self, user_input: str, tool_output: str) -> str:
+        """Формирует промпт для итогового ответа по данным MCP-инструмента"""
+        rag_prompt = f"""
+            Пользователь спросил: "{user_input}"
+
+            Вот данные, полученные от MCP-инструмента:
+            {tool_output}
+
+            В полученных данных MCP-инструмента найди ответ на вопрос и сделай человекочитаемый вывод только на русском языке.
+            """
+        #logger.debug(f"RAG-промпт для LLM:\n{rag_prompt}")
+        self.traces.event("rag_prompt", rag_prompt)
+        return rag_prompt
+
+    async def get_cached_response(self, user_input: str) -> Tuple[Optional[AgentResponse], Tuple[str, str]]:
+        """Ищет готовый ответ в кэше. Возвращает ответ (или None) и ключ кэша"""
+        cache_key = ResponseCache.make_key(self.tool_catalog.version, user_input)
+        if not RESPONSE_CACHE_ENABLED:
+            return None, cache_key
+        cached = await self.response_cache.get(cache_key[0])
+        if cached is not None:
+            logger.info(f"Response cache hit: {cache_key[1]}")
+            return AgentResponse(**cached), cache_key
+        return None, cache_key
+
+    async def cache_response(self, cache_key: Tuple[str, str], response: AgentResponse):
+        """Кладёт успешный ответ в кэш согласно политике инструмента"""
+        # Ответы по плану из нескольких вызовов не кэшируются: у инструментов разные политики,
+        # результаты каждого и так лежат в кэше результатов
+        if not RESPONSE_CACHE_ENABLED or not response.tool_name:
+            return
+        ttl = get_tool_policy(response.tool_name).get("response_cache_ttl", RESPONSE_CACHE_DEFAULT_TTL)
+        if ttl <= 0:
+            return
+        key, query = cache_key
+        await self.response_cache.set(key, query, response.tool_name, response.model_dump(), ttl)
+
+    async def process_query(self, user_input: str) -> AgentResponse:
+        """Основной метод обработки запроса от пользователя"""
+        logger.info(f"Processing user input: {user_input}")
+
+        cached, cache_key = await self.get_cached_response(user_input)
+        if cached is not None:
+            return cached
+
+        # Одинаковые запросы, пришедшие одновременно, считаются один раз
+        response = await self.join_query(user_input, cache_key)
+        return response.model_copy(deep=True)
+
+    async def join_query(self, user_input: str, cache_key: Tuple[str, str]) -> AgentResponse:
+        """Присоединяется к уже идущей обработке такого же запроса или запускает её"""
+        try:
+            return await self.inflight_queries.do(
+                flight_key(user_input), lambda: self.run_query(user_input, cache_key)
+            )
+        except QueryAbandoned:
+            # Потоковый клиент, начавший обработку, отключился — считаем сами
+            return await self.run_query(user_input, cache_key)
+
+    async def run_query(self, user_input: str, cache_key: Tuple[str, str]) -> AgentResponse:
+        response, result = await self.call_selected_tool(user_input)
+        if result is None:
+            return response
+
+        rag_prompt = await self.prepare_reply(user_input, response, result)
+        if rag_prompt is None:
+            await self.cache_response(cache_key, response)
+            return response
+
+        rag_response = await self.query_ollama(rag_prompt)
+        self.traces.event("llm_reply", rag_response)
+
+        if not isinstance(rag_response, dict):
+            response.reply = "LLM не вернул текстовый ответ"
+            return response
+
+        response.reply = rag_response.get("response", "Не могу интерпретировать данные")
+        if "response" in rag_response:
+            await self.cache_response(cache_key, response)
+        return response
+
+    async def process_query_stream(self, user_input: str) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Потоковая обработка запроса: события status/tool/token/done.
+        Токены итогового ответа отдаются по мере генерации Ollama
+        """
+        logger.info(f"Processing user input (stream): {user_input}")
+
+        cached, cache_key = await self.get_cached_response(user_input)
+        if cached is not None:
+            yield {"event": "done", **cached.model_dump()}
+            return
+
+        flight = self.inflight_queries.begin(flight_key(user_input))
+        if flight is None:
+            # Такой же запрос уже обрабатывается — ждём его результат
+            yield {"event": "status", "stage": "coalesced"}
+            try:
+                response = await self.join_query(user_input, cache_key)
+            except SchedulerOverloaded as e:
+                yield overloaded_event(e)
+                return
+            yield {"event": "done", **response.model_dump()}
+            return
+
+        try:
+            yield {"event": "status", "stage": "routing"}
+
+            # Пока инструмент работает, его события (текст из уведомлений о прогрессе) отдаются сразу
+            events: asyncio.Queue = asyncio.Queue()
+            selected = asyncio.ensure_future(self.call_selected_tool(user_input, events.put_nowait))
+            tool_announced = False
+            getter = None
+            try:
+                while True:
+                    getter = asyncio.ensure_future(events.get())
+                    await asyncio.wait((getter, selected), return_when=asyncio.FIRST_COMPLETED)
+                    if not getter.done():
+                        getter.cancel()
+                        break
+                    tool_announced = True
+                    yield getter.result()
+                while not events.empty():
+                    yield events.get_nowait()
+            finally:
+                selected.cancel()
+                if getter is not None:
+                    getter.cancel()
+            response, result = selected.result()
+            if result is None:
+                flight.set_result(response.model_copy(deep=True))
+                yield {"event": "done", **response.model_dump()}
+                return
+
+            if response.calls:
+                yield {
+                    "event": "tool",
+                    "tool_name": ", ".join(call.tool_name for call in response.calls),
+                    "calls": [{"tool_name": call.tool_name, "args": call.args} for call in response.calls],
+                }
+            elif not tool_announced:
+                yield {"event": "tool", "tool_name": response.tool_name, "args": response.args}
+
+            rag_prompt = await self.prepare_reply(user_input, response, result)
+            if rag_prompt is None:
+                await self.cache_response(cache_key, response)
+                flight.set_result(response.model_copy(deep=True))
+                yield {"event": "done", **response.model_dump()}
+                return
+
+            parts: List[str] = []
+            failed = False
+            params = self.llm_stages.params("summarize")
+            started = time.perf_counter()
+            try:
+                async with self.llm_scheduler.slot(PRIORITY_SUMMARIZE):
+                    started = time.perf_counter()
+                    with stage_timer("summarize_llm"):
+                        async for chunk in self.ollama.generate_stream(rag_prompt, **params):
+                            token = chunk.get("response", "")
+                            if token:
+                                parts.append(token)
+                                yield {"event": "token", "text": token}
+                            if chunk.get("done"):
+                                observe_ollama_timings("summarize", chunk)
+            except OllamaError as e:
+                logger.error(f"Ошибка при обращении к Ollama: {e}", exc_info=True)
+                failed = True
+                if not parts:
+                    parts.append("LLM не вернул текстовый ответ")
+            self.llm_stages.record("summarize", params["model"], time.perf_counter() - started, ok=not failed)
+
+            response.reply = "".join(parts) or "Не могу интерпретировать данные"
+            self.traces.event("llm_reply", response.reply)
+            if not failed and parts:
+                await self.cache_response(cache_key, response)
+            flight.set_result(response.model_copy(deep=True))
+            yield {"event": "done", **response.model_dump()}
+        except SchedulerOverloaded as e:
+            flight.set_exception(e)
+            yield overloaded_event(e)
+        finally:
+            if not flight.done():
+                flight.set_exception(QueryAbandoned())
+
+    def record_query(self, endpoint: str, user_input: str, started: float, response: Dict[str, Any]):
+        """Запрос пользователя и итоговый ответ в кассету — по ним сравниваются прогоны"""
+        if CASSETTE_MODE != "record":
+            return
+        self.cassette.append({
+            "type": "query", "request_id": current_request_id(), "endpoint": endpoint,
+            "user_input": user_input, "started_at": time.time(),
+            "duration_ms": round(1000 * (time.perf_counter() - started), 3),
+            "response": {key: value for key, value in response.items() if key != "event"},
+        })
+
+    def stats(self) -> Dict[str, Any]:
+        """Статистика работы агента"""
+        return {
+            "mcp_pool": self.mcp_pool.stats(),
+            "mcp_servers": self.servers.stats(),
+            "tool_discovery": self.discovery.stats(),
+            "ollama": self.ollama.stats(),
+            "llm_scheduler": self.llm_scheduler.stats(),
+            "llm_stages": self.llm_stages.stats(),
+            "router": self.router.stats(),
+            "routing_prefix": self.prefix_cache.stats(),
+            "response_cache": self.response_cache.stats(),
+            "tool_result_cache": self.tool_results.stats(),
+            "query_coalescing": self.inflight_queries.stats(),
+            "response_modes": self.response_renderer.stats(),
+            "tool_output_compaction": self.output_compactor.stats(),
+            "prefetch": {"enabled": self.prefetch_enabled, **self.prefetcher.stats()},
+            "traces": self.traces.stats(),
+            "cassette": self.cassette.stats() if self.cassette is not None else {"mode": "off"},
+        }
+
+    async def close(self):
+        await self.discovery.close()
+        await self.servers.close()
+        await self.traces.close()
+        if isinstance(self.cassette, CassetteWriter):
+            await self.cassette.close()
+        self.response_cache.close()
+        await self.mcp_pool.close()
+        await close_ollama_pool()
 
 
 # === FastAPI Сервис ===
 
+# Заголовок, при котором трасса запроса сохраняется вне зависимости от сэмплирования
+TRACE_HEADER = "X-Debug-Trace"
+
 agent = MCPAgent()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    await agent.discover_tools()
+    await asyncio.gather(agent.start_discovery(), agent.start_sessions(), agent.start_ollama())
     yield
+    await agent.close()
 
 app = FastAPI(lifespan=lifespan)
 
 
+@app.middleware("http")
+async def request_id_middleware(request: Request, call_next):
+    # Идентификатор берётся от клиента (бот), иначе создаётся; попадает в логи и заголовок ответа
+    request_id = request.headers.get(REQUEST_ID_HEADER) or new_request_id()
+    token = request_id_var.set(request_id)
+    try:
+        response = await call_next(request)
+    finally:
+        request_id_var.reset(token)
+    response.headers[REQUEST_ID_HEADER] = request_id
+    REQUESTS.inc(endpoint=request.url.path, status=str(response.status_code))
+    return response
+
+
+@app.exception_handler(SchedulerOverloaded)
+async def handle_overloaded(request: Request, exc: SchedulerOverloaded):
+    # Отказываем сразу, чтобы клиент не ждал до своего таймаута
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(max(1, math.ceil(exc.retry_after)))}
+    )
+
+
+def trace_forced(request: Request) -> bool:
+    return request.headers.get(TRACE_HEADER) == "1"
+
+
 @app.post("/query", response_model=AgentResponse)
-async def handle_query(request: UserQueryRequest):
-    return await agent.process_query(request.user_input)
+async def handle_query(request: UserQueryRequest, http_request: Request):
+    with REQUEST_DURATION.time(endpoint="/query"), \
+            agent.traces.trace(current_request_id(), force=trace_forced(http_request)):
+        started = time.perf_counter()
+        response = await agent.process_query(request.user_input)
+        agent.record_query("/query", request.user_input, started, response.model_dump())
+        return response
+
+
+def format_sse(event: Dict[str, Any]) -> str:
+    return f"event: {event['event']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+
+@app.post("/query/stream")
+async def handle_query_stream(request: UserQueryRequest, http_request: Request):
+    """Тот же /query, но итоговый ответ отдаётся токенами через Server-Sent Events"""
+    if agent.llm_scheduler.overloaded():
+        raise SchedulerOverloaded("LLM queue is full", retry_after=1)
+
+    request_id = current_request_id()
+    force_trace = trace_forced(http_request)
+
+    async def events():
+        # Время считается до последнего события, а не до отправки заголовков
+        with REQUEST_DURATION.time(endpoint="/query/stream"), agent.traces.trace(request_id, force=force_trace):
+            started = time.perf_counter()
+            async for event in agent.process_query_stream(request.user_input):
+                if event["event"] == "done":
+                    agent.record_query("/query/stream", request.user_input, started, event)
+                yield format_sse(event)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.delete("/admin/cache")
+async def handle_purge_cache(tool_name: Optional[str] = None, user_input: Optional[str] = None):
+    """Очистка кэша ответов: по инструменту и/или запросу, без параметров — целиком"""
+    purged = await agent.response_cache.purge(tool_name=tool_name, user_input=user_input)
+    return {"purged": purged}
+
+
+@app.delete("/admin/cache/tool-results")
+async def handle_purge_tool_results(tool_name: Optional[str] = None):
+    """Очистка кэша результатов инструментов: по инструменту или целиком"""
+    return {"purged": agent.tool_results.purge(tool_name=tool_name)}
+
+
+@app.get("/stats")
+async def handle_stats():
+    return agent.stats()
+
+
+@app.get("/debug/traces")
+async def handle_recent_traces(limit: int = 50):
+    """Последние сохранённые трассы (без содержимого)"""
+    return agent.traces.recent(limit)
+
+
+@app.get("/debug/traces/{request_id}")
+async def handle_trace(request_id: str):
+    """Промпты, решения, выводы инструментов и ответы LLM одного запроса"""
+    trace = agent.traces.get(request_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail="Трасса не найдена (запрос не попал в выборку или вытеснен)")
+    return trace
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def handle_metrics():
+    """Гистограммы времени стадий в текстовом формате Prometheus"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
 
 if __name__ == "__main__":
     import uvicorn
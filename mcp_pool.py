@@ -0,0 +1,250 @@
+# mcp_pool.py
+
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, List, Optional, TypeVar
+
+import mcp.types
+from fastmcp import Client
+from fastmcp.client.messages import MessageHandler
+from fastmcp.client.progress import ProgressHandler
+from fastmcp.exceptions import ToolError
+
+from server_registry import ServerRegistry, replica_urls
+
+logger = logging.getLogger("MCPPool")
+
+T = TypeVar("T")
+
+
+def build_client_config(server_name: str, server_config: Dict[str, Any]) -> Dict[str, Any]:
+    """Формирует config для fastmcp.Client с одним сервером"""
+    return {
+        "mcpServers": {
+            server_name: {
+                "url": server_config["url"],
+                "transport": server_config.get("transport", "streamable-http")
+            }
+        }
+    }
+
+
+class SessionConnectError(Exception):
+    """Не удалось открыть сессию: запрос до сервера не дошёл, его можно отправить на другую реплику"""
+
+
+class ToolListChangedHandler(MessageHandler):
+    """Передаёт notifications/tools/list_changed сервера в callback(имя сервера)"""
+
+    def __init__(self, server_name: str, callback: Callable[[str], None]):
+        self.server_name = server_name
+        self.callback = callback
+
+    async def on_tool_list_changed(self, notification: mcp.types.ToolListChangedNotification):
+        logger.info(f"Server {self.server_name} reported tools/list_changed")
+        self.callback(self.server_name)
+
+
+class ServerSessionPool:
+    """
+    Пул долгоживущих сессий к одному MCP-серверу.
+    Сессия открывается один раз и переиспользуется между запросами,
+    одновременно используется не более max_sessions сессий.
+    """
+
+    def __init__(self, server_name: str, server_config: Dict[str, Any],
+                 max_sessions: int, connect_timeout: float,
+                 on_tools_changed: Optional[Callable[[str], None]] = None):
+        self.server_name = server_name
+        self.server_config = server_config
+        self.max_sessions = max_sessions
+        self.connect_timeout = connect_timeout
+        self.on_tools_changed = on_tools_changed
+
+        self._semaphore = asyncio.Semaphore(max_sessions)
+        self._idle: List[Client] = []
+        self._in_use = 0
+        self._closed = False
+
+        # Статистика
+        self.created = 0
+        self.reconnects = 0
+        self.acquired = 0
+        self.errors = 0
+        self.wait_time_total = 0.0
+
+    async def _connect(self) -> Client:
+        handler = ToolListChangedHandler(self.server_name, self.on_tools_changed) if self.on_tools_changed else None
+        client = Client(build_client_config(self.server_name, self.server_config), message_handler=handler)
+        try:
+            await asyncio.wait_for(client.__aenter__(), timeout=self.connect_timeout)
+        except Exception as e:
+            raise SessionConnectError(f"Can't connect to {self.server_config['url']}: {str(e) or type(e).__name__}") from e
+        self.created += 1
+        logger.info(f"Opened MCP session to {self.server_name} ({self.created} total)")
+        return client
+
+    async def _discard(self, client: Client):
+        try:
+            await client.__aexit__(None, None, None)
+        except Exception as e:
+            logger.debug(f"Error while closing MCP session to {self.server_name}: {e}")
+
+    @asynccontextmanager
+    async def session(self):
+        """Выдаёт подключённую сессию из пула, после использования возвращает её обратно"""
+        if self._closed:
+            raise RuntimeError(f"MCP session pool for {self.server_name} is closed")
+
+        started = time.perf_counter()
+        async with self._semaphore:
+            self.wait_time_total += time.perf_counter() - started
+            self.acquired += 1
+
+            client = self._idle.pop() if self._idle else None
+            if client is not None and not client.is_connected():
+                # Сессия умерла, пока лежала в пуле
+                await self._discard(client)
+                client = None
+                self.reconnects += 1
+            if client is None:
+                client = await self._connect()
+
+            self._in_use += 1
+            healthy = False
+            try:
+                yield client
+                healthy = True
+            except ToolError:
+                # Ошибка самого инструмента, сессия при этом исправна
+                healthy = True
+                raise
+            finally:
+                self._in_use -= 1
+                if healthy and not self._closed:
+                    self._idle.append(client)
+                else:
+                    await self._discard(client)
+
+    async def run(self, fn: Callable[[Client], Awaitable[T]], retry: bool = True) -> T:
+        """
+        Выполняет fn(client) на сессии из пула.
+        Если сессия оборвалась (например, сервер перезапустился и streamable-http
+        сессия больше не существует) — переподключается и повторяет вызов один раз.
+        retry=False — не повторять: обрыв мог случиться, когда сервер уже выполнил запрос
+        (умершая до отправки сессия заменяется новой в session() и без повтора)
+        """
+        try:
+            async with self.session() as client:
+                return await fn(client)
+        except (ToolError, SessionConnectError):
+            raise
+        except Exception as e:
+            self.errors += 1
+            if not retry:
+                raise
+            self.reconnects += 1
+            logger.warning(f"MCP session to {self.server_name} dropped ({e}), reconnecting")
+            async with self.session() as client:
+                return await fn(client)
+
+    async def warm_up(self) -> bool:
+        """Открывает сессию заранее, чтобы первый вызов не ждал подключения. False — сервер недоступен"""
+        if self._closed or self._idle:
+            return True
+        try:
+            client = await self._connect()
+        except SessionConnectError as e:
+            logger.warning(f"{e}, session will be opened on first call")
+            return False
+        self._idle.append(client)
+        return True
+
+    async def close(self):
+        self._closed = True
+        idle, self._idle = self._idle, []
+        for client in idle:
+            await self._discard(client)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_sessions": self.max_sessions,
+            "idle": len(self._idle),
+            "in_use": self._in_use,
+            "created": self.created,
+            "reconnects": self.reconnects,
+            "acquired": self.acquired,
+            "errors": self.errors,
+            "avg_wait_ms": round(1000 * self.wait_time_total / self.acquired, 3) if self.acquired else 0.0,
+        }
+
+
+class MCPSessionPool:
+    """
+    Пулы сессий ко всем репликам серверов (ключ — URL реплики).
+    Реплику для каждого вызова выбирает реестр серверов
+    """
+
+    def __init__(self, registry: ServerRegistry, servers_config: Dict[str, Dict[str, Any]],
+                 max_sessions_per_server: int, connect_timeout: float,
+                 on_tools_changed: Optional[Callable[[str], None]] = None):
+        self.registry = registry
+        self.pools: Dict[str, ServerSessionPool] = {
+            url: ServerSessionPool(
+                server_name,
+                {**server_config, "url": url},
+                max_sessions=server_config.get("max_sessions", max_sessions_per_server),
+                connect_timeout=connect_timeout,
+                on_tools_changed=on_tools_changed
+            )
+            for server_name, server_config in servers_config.items()
+            for url in replica_urls(server_config)
+        }
+
+    def get(self, url: str) -> Optional[ServerSessionPool]:
+        return self.pools.get(url)
+
+    async def _run(self, server_name: str, fn: Callable[[Client], Awaitable[T]], retry: bool = True) -> T:
+        """Вызов на выбранной реестром реплике; если сессию открыть не удалось — на следующей"""
+        tried: List[str] = []
+        while True:
+            replica = self.registry.select(server_name, exclude=tried)
+            try:
+                async with self.registry.track(replica, healthy_errors=(ToolError,)):
+                    return await self.pools[replica.url].run(fn, retry)
+            except SessionConnectError as e:
+                tried.append(replica.url)
+                if len(tried) >= len(self.registry.replicas[server_name]):
+                    raise
+                logger.warning(f"{e}, trying another replica of {server_name}")
+
+    async def list_tools(self, server_name: str):
+        return await self._run(server_name, lambda client: client.list_tools())
+
+    async def call_tool(self, server_name: str, tool_name: str, args: Dict[str, Any],
+                        progress_handler: Optional[ProgressHandler] = None, idempotent: bool = False):
+        """
+        progress_handler(progress, total, message) — уведомления о прогрессе этого вызова.
+        После обрыва сессии повторяются только idempotent вызовы: иначе create/delete выполнится дважды
+        """
+        return await self._run(
+            server_name, lambda client: client.call_tool(tool_name, args, progress_handler=progress_handler),
+            retry=idempotent
+        )
+
+    async def ping(self, url: str):
+        """Проверка реплики для реестра серверов"""
+        return await self.pools[url].run(lambda client: client.ping())
+
+    async def warm_up(self):
+        """По одной открытой сессии на каждую реплику, все реплики подключаются одновременно"""
+        opened = await asyncio.gather(*(pool.warm_up() for pool in self.pools.values()))
+        logger.info(f"MCP sessions pre-opened: {sum(opened)}/{len(opened)} replicas")
+
+    async def close(self):
+        await asyncio.gather(*(pool.close() for pool in self.pools.values()))
+
+    def stats(self) -> Dict[str, Any]:
+        return {url: pool.stats() for url, pool in self.pools.items()}
@@ -0,0 +1,216 @@
+# metrics.py
+
+import bisect
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Идентификатор текущего запроса: ставится middleware FastAPI, виден во всех корутинах запроса
+request_id_var: ContextVar[str] = ContextVar("request_id", default="-")
+
+REQUEST_ID_HEADER = "X-Request-ID"
+
+# Границы бакетов гистограмм, сек: от миллисекунд (кэш, MCP) до минут (генерация на CPU)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def current_request_id() -> str:
+    return request_id_var.get()
+
+
+def install_request_id_logging():
+    """Добавляет request_id во все записи логов (поле %(request_id)s формата)"""
+    factory = logging.getLogRecordFactory()
+    if getattr(factory, "with_request_id", False):
+        return
+
+    def record_factory(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        record.request_id = request_id_var.get()
+        return record
+
+    record_factory.with_request_id = True
+    logging.setLogRecordFactory(record_factory)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Sequence[Tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(list(zip(self.labelnames, key)))} {_format_value(value)}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels: str):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        self._values[key] = value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(list(zip(self.labelnames, key)))} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> (счётчики по бакетам, сумма, количество)
+        self._series: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        series = self._series.get(key)
+        if series is None:
+            series = ([0] * (len(self.buckets) + 1), [0.0, 0.0])
+            self._series[key] = series
+        counts, totals = series
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        totals[0] += value
+        totals[1] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, (counts, (total, count)) in sorted(self._series.items()):
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(labels + [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {_format_value(count)}")
+        return lines
+
+
+class MetricsRegistry:
+    """Метрики агента в текстовом формате Prometheus (без зависимости prometheus_client)"""
+
+    def __init__(self):
+        self._metrics: List[object] = []
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, help_text, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Gauge:
+        metric = Gauge(name, help_text, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                  buckets: Optional[Sequence[float]] = None) -> Histogram:
+        metric = Histogram(name, help_text, labelnames, buckets or DEFAULT_BUCKETS)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+REQUESTS = registry.counter(
+    "agent_requests_total", "Запросы к агенту", ("endpoint", "status")
+)
+REQUEST_DURATION = registry.histogram(
+    "agent_request_duration_seconds", "Время обработки запроса целиком", ("endpoint",)
+)
+# Стадии: prompt_build, routing_llm, routing_prefill, routing_generation, mcp_call,
+# output_extraction, output_compaction, summarize_llm, summarize_prefill, summarize_generation
+STAGE_DURATION = registry.histogram(
+    "agent_stage_duration_seconds", "Время стадий обработки запроса", ("stage",)
+)
+MCP_CALL_DURATION = registry.histogram(
+    "agent_mcp_call_duration_seconds", "Время вызова инструмента MCP", ("server", "tool", "status")
+)
+
+# Очередь каждого хоста Ollama (ollama_pool.py): запросы, отправленные и ещё не завершённые
+OLLAMA_HOST_OUTSTANDING = registry.gauge(
+    "agent_ollama_host_outstanding", "Выполняющиеся запросы к хосту Ollama", ("host",)
+)
+# Загрузка модели в память хоста (load_duration ответа Ollama больше порога);
+# reason: request — модель выгрузилась и запрос ждал загрузки, preload, keep_alive
+OLLAMA_COLD_LOAD_DURATION = registry.histogram(
+    "agent_ollama_cold_load_seconds", "Холодная загрузка модели на хосте Ollama", ("host", "model", "reason")
+)
+
+# Вызовы LLM по стадиям (llm_stages.py) и повторы на большой модели
+LLM_CALL_DURATION = registry.histogram(
+    "agent_llm_call_duration_seconds", "Время вызова LLM по стадиям и моделям", ("stage", "model", "status")
+)
+LLM_ESCALATIONS = registry.counter(
+    "agent_llm_escalations_total", "Повторы запроса на большой модели после неудачного ответа", ("stage", "reason")
+)
+
+
+def observe_stage(stage: str, seconds: float):
+    STAGE_DURATION.observe(seconds, stage=stage)
+
+
+def stage_timer(stage: str):
+    return STAGE_DURATION.time(stage=stage)
+
+
+def observe_ollama_timings(prefix: str, data: Dict[str, object]):
+    """Prefill и генерация из итоговых полей ответа Ollama (наносекунды)"""
+    if "prompt_eval_duration" in data:
+        observe_stage(f"{prefix}_prefill", data["prompt_eval_duration"] / 1e9)
+    if "eval_duration" in data:
+        observe_stage(f"{prefix}_generation", data["eval_duration"] / 1e9)
@@ -0,0 +1,190 @@
+# ollama_client.py
+
+import json
+import logging
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import aiohttp
+
+from config import (
+    OLLAMA_BASE_URL, OLLAMA_MODEL,
+    OLLAMA_POOL_LIMIT, OLLAMA_POOL_LIMIT_PER_HOST, OLLAMA_KEEPALIVE_TIMEOUT,
+    OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT
+)
+
+logger = logging.getLogger("OllamaClient")
+
+
+class OllamaError(Exception):
+    """Ollama вернула ошибку или не ответила"""
+
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+
+class OllamaClient:
+    """
+    Клиент Ollama с общим пулом keep-alive соединений.
+    Один клиент на хост Ollama (см. OllamaPool в ollama_pool.py), сессия aiohttp
+    открывается лениво внутри работающего event loop.
+    """
+
+    def __init__(self, base_url: str = OLLAMA_BASE_URL, model: str = OLLAMA_MODEL,
+                 limit: int = OLLAMA_POOL_LIMIT, limit_per_host: int = OLLAMA_POOL_LIMIT_PER_HOST,
+                 keepalive_timeout: float = OLLAMA_KEEPALIVE_TIMEOUT,
+                 connect_timeout: float = OLLAMA_CONNECT_TIMEOUT,
+                 read_timeout: float = OLLAMA_READ_TIMEOUT):
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(total=None, connect=connect_timeout, sock_read=read_timeout)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+        # Статистика
+        self.requests = 0
+        self.errors = 0
+        self.sessions_created = 0
+        self.request_time_total = 0.0
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self.sessions_created += 1
+        return self._session
+
+    async def generate(self, prompt: str, model: Optional[str] = None, **params: Any) -> Dict[str, Any]:
+        """Вызов /api/generate без стриминга, возвращает JSON-ответ Ollama целиком"""
+        payload = {
+            "model": model or self.model,
+            "prompt": prompt,
+            "stream": False,
+            **params
+        }
+        return await self._post("/api/generate", payload)
+
+    async def chat(self, messages: List[Dict[str, str]], model: Optional[str] = None,
+                   **params: Any) -> Dict[str, Any]:
+        """Вызов /api/chat без стриминга"""
+        payload = {
+            "model": model or self.model,
+            "messages": messages,
+            "stream": False,
+            **params
+        }
+        return await self._post("/api/chat", payload)
+
+    async def chat_stream(self, messages: List[Dict[str, str]], model: Optional[str] = None,
+                          **params: Any) -> AsyncIterator[Dict[str, Any]]:
+        """Вызов /api/chat со стримингом"""
+        payload = {
+            "model": model or self.model,
+            "messages": messages,
+            "stream": True,
+            **params
+        }
+        async for chunk in self._post_stream("/api/chat", payload):
+            yield chunk
+
+    async def generate_stream(self, prompt: str, model: Optional[str] = None,
+                              **params: Any) -> AsyncIterator[Dict[str, Any]]:
+        """Вызов /api/generate со стримингом: отдаёт NDJSON-чанки Ollama по мере генерации"""
+        payload = {
+            "model": model or self.model,
+            "prompt": prompt,
+            "stream": True,
+            **params
+        }
+        async for chunk in self._post_stream("/api/generate", payload):
+            yield chunk
+
+    async def embed(self, texts: List[str], model: Optional[str] = None, **params: Any) -> Dict[str, Any]:
+        """Вызов /api/embed: векторы текстов в поле "embeddings" (в порядке texts)"""
+        payload = {
+            "model": model or self.model,
+            "input": texts,
+            **params
+        }
+        return await self._post("/api/embed", payload)
+
+    async def ps(self) -> Dict[str, Any]:
+        """Вызов /api/ps: модели, загруженные сейчас в память"""
+        return await self._request("GET", "/api/ps")
+
+    async def _post(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        return await self._request("POST", path, payload)
+
+    async def _request(self, method: str, path: str, payload: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        session = self._get_session()
+        started = time.perf_counter()
+        self.requests += 1
+        try:
+            async with session.request(method, f"{self.base_url}{path}", json=payload) as res:
+                if res.status != 200:
+                    raise OllamaError(f"Ollama API error: {res.status} — {await res.text()}", status=res.status)
+                return await res.json(content_type=None)
+        except OllamaError:
+            self.errors += 1
+            raise
+        except (aiohttp.ClientError, TimeoutError) as e:
+            self.errors += 1
+            raise OllamaError(f"Ошибка при обращении к Ollama: {e}") from e
+        finally:
+            self.request_time_total += time.perf_counter() - started
+
+    async def _post_stream(self, path: str, payload: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        session = self._get_session()
+        started = time.perf_counter()
+        self.requests += 1
+        try:
+            async with session.post(f"{self.base_url}{path}", json=payload) as res:
+                if res.status != 200:
+                    raise OllamaError(f"Ollama API error: {res.status} — {await res.text()}", status=res.status)
+                # Строки NDJSON режем сами: последний чанк с "context" бывает длиннее
+                # лимита строки StreamReader.readline
+                buffer = b""
+                async for data in res.content.iter_any():
+                    buffer += data
+                    *lines, buffer = buffer.split(b"\n")
+                    for line in lines:
+                        if not line.strip():
+                            continue
+                        chunk = json.loads(line)
+                        if "error" in chunk:
+                            raise OllamaError(f"Ollama API error: {chunk['error']}")
+                        yield chunk
+                if buffer.strip():
+                    yield json.loads(buffer)
+        except OllamaError:
+            self.errors += 1
+            raise
+        except (aiohttp.ClientError, TimeoutError, json.JSONDecodeError) as e:
+            self.errors += 1
+            raise OllamaError(f"Ошибка при обращении к Ollama: {e}") from e
+        finally:
+            self.request_time_total += time.perf_counter() - started
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "sessions_created": self.sessions_created,
+            "avg_request_ms": round(1000 * self.request_time_total / self.requests, 3) if self.requests else 0.0,
+            "pool_limit": self.limit,
+            "pool_limit_per_host": self.limit_per_host,
+            "session_open": self._session is not None and not self._session.closed,
+        }
+
@@ -0,0 +1,317 @@
+# ollama_pool.py
+
+import asyncio
+import logging
+import random
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+from config import (
+    OLLAMA_HOSTS, OLLAMA_MODEL, OLLAMA_KEEP_ALIVE, OLLAMA_PRELOAD_MODELS,
+    OLLAMA_BUSINESS_HOURS, OLLAMA_BUSINESS_DAYS, OLLAMA_KEEP_ALIVE_REFRESH_INTERVAL,
+    OLLAMA_HOST_RETRY_AFTER, OLLAMA_COLD_LOAD_THRESHOLD
+)
+from llm_stages import stage_models
+from metrics import OLLAMA_COLD_LOAD_DURATION, OLLAMA_HOST_OUTSTANDING
+from ollama_client import OllamaClient, OllamaError
+
+logger = logging.getLogger("OllamaPool")
+
+
+def model_name(model: str) -> str:
+    """Имя модели как в /api/ps: без тега — :latest"""
+    return model if ":" in model else f"{model}:latest"
+
+
+class OllamaHost:
+    """Один хост Ollama: свой клиент, очередь, модели в памяти, холодные загрузки"""
+
+    def __init__(self, base_url: str, model: str):
+        self.client = OllamaClient(base_url, model)
+        self.base_url = self.client.base_url
+        self.outstanding = 0
+        # Модели в памяти хоста: по /api/ps и по ответам на запросы
+        self.resident: Set[str] = set()
+        # Когда модель последний раз отвечала на этом хосте (monotonic)
+        self.last_used: Dict[str, float] = {}
+        self.down_until = 0.0
+        self.last_error: Optional[str] = None
+
+        # Статистика
+        self.max_outstanding = 0
+        self.cold_loads = 0
+        self.cold_load_time_total = 0.0
+        self.failovers = 0
+
+    def available(self) -> bool:
+        return time.monotonic() >= self.down_until
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.client.stats(),
+            "available": self.available(),
+            "outstanding": self.outstanding,
+            "max_outstanding": self.max_outstanding,
+            "resident_models": sorted(self.resident),
+            "cold_loads": self.cold_loads,
+            "cold_load_s": round(self.cold_load_time_total, 3),
+            "failovers": self.failovers,
+            "last_error": self.last_error,
+        }
+
+
+class OllamaPool:
+    """
+    Несколько хостов Ollama за тем же интерфейсом, что у OllamaClient.
+    Запрос уходит на доступный хост с наименьшей очередью среди тех, где модель уже в памяти;
+    если таких нет — на наименее загруженный. Хост, не ответивший на запрос, на retry_after
+    секунд исключается, запрос повторяется на другом (поток — только если чанков ещё не было).
+    При запуске модели preload_models загружаются на все хосты, в рабочие часы их keep_alive
+    продлевается в фоне
+    """
+
+    def __init__(self, hosts: Sequence[str] = OLLAMA_HOSTS, model: str = OLLAMA_MODEL,
+                 keep_alive: str = OLLAMA_KEEP_ALIVE, preload_models: Optional[Sequence[str]] = OLLAMA_PRELOAD_MODELS,
+                 business_hours: Optional[Tuple[int, int]] = OLLAMA_BUSINESS_HOURS,
+                 business_days: Sequence[int] = OLLAMA_BUSINESS_DAYS,
+                 refresh_interval: float = OLLAMA_KEEP_ALIVE_REFRESH_INTERVAL,
+                 retry_after: float = OLLAMA_HOST_RETRY_AFTER,
+                 cold_load_threshold: float = OLLAMA_COLD_LOAD_THRESHOLD):
+        self.model = model
+        self.hosts = [OllamaHost(url, model) for url in hosts]
+        self.keep_alive = keep_alive
+        # По умолчанию — модели всех стадий (LLM_STAGE_MODELS)
+        self.preload_models = list(preload_models if preload_models is not None else stage_models())
+        self.business_hours = business_hours
+        self.business_days = tuple(business_days)
+        self.refresh_interval = refresh_interval
+        self.retry_after = retry_after
+        self.cold_load_threshold = cold_load_threshold
+        self._task: Optional[asyncio.Task] = None
+
+        # Статистика
+        self.preloads = 0
+        self.keep_alive_refreshes = 0
+
+    def in_business_hours(self) -> bool:
+        if self.business_hours is None:
+            return True
+        now = datetime.now()
+        start, end = self.business_hours
+        return now.weekday() in self.business_days and start <= now.hour < end
+
+    def select(self, model: str, exclude: Sequence[str] = ()) -> OllamaHost:
+        candidates = [host for host in self.hosts if host.base_url not in exclude]
+        if not candidates:
+            raise OllamaError("Все хосты Ollama недоступны")
+        # Если все хосты недавно сбоили, пробуем их всё равно — лучше, чем отказать сразу
+        candidates = [host for host in candidates if host.available()] or candidates
+        name = model_name(model)
+        candidates = [host for host in candidates if name in host.resident] or candidates
+        least = min(host.outstanding for host in candidates)
+        return random.choice([host for host in candidates if host.outstanding == least])
+
+    def _set_outstanding(self, host: OllamaHost, delta: int):
+        host.outstanding += delta
+        host.max_outstanding = max(host.max_outstanding, host.outstanding)
+        OLLAMA_HOST_OUTSTANDING.set(host.outstanding, host=host.base_url)
+
+    @asynccontextmanager
+    async def _track(self, host: OllamaHost) -> AsyncIterator[None]:
+        self._set_outstanding(host, 1)
+        try:
+            yield
+        finally:
+            self._set_outstanding(host, -1)
+
+    def _observe(self, host: OllamaHost, model: str, data: Dict[str, Any], reason: str = "request"):
+        """
+        Итоговый ответ: модель теперь в памяти хоста; долгий load_duration — холодная загрузка.
+        reason — чем она вызвана: запросом (модель выгрузилась — этого и не должно быть), preload, keep_alive
+        """
+        name = model_name(model)
+        host.resident.add(name)
+        host.last_used[name] = time.monotonic()
+        load_seconds = data.get("load_duration", 0) / 1e9
+        if load_seconds < self.cold_load_threshold:
+            return
+        OLLAMA_COLD_LOAD_DURATION.observe(load_seconds, host=host.base_url, model=name, reason=reason)
+        if reason == "preload":
+            logger.info(f"Loaded {name} on {host.base_url} in {load_seconds:.1f} s")
+            return
+        host.cold_loads += 1
+        host.cold_load_time_total += load_seconds
+        logger.warning(f"Cold load of {name} on {host.base_url} ({reason}): {load_seconds:.1f} s")
+
+    def _failed(self, host: OllamaHost, error: OllamaError) -> bool:
+        """Ошибка запроса. True — хост не ответил и запрос можно повторить на другом"""
+        if error.status is not None and error.status < 500:
+            return False
+        if host.available():
+            logger.warning(f"Ollama host {host.base_url} failed, excluded for {self.retry_after} s: {error}")
+        host.down_until = time.monotonic() + self.retry_after
+        host.last_error = str(error)
+        host.failovers += 1
+        return True
+
+    async def _call(self, model: str,
+                    call: Callable[[OllamaClient], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        tried: List[str] = []
+        while True:
+            host = self.select(model, tried)
+            try:
+                async with self._track(host):
+                    data = await call(host.client)
+            except OllamaError as e:
+                tried.append(host.base_url)
+                if not self._failed(host, e) or len(tried) >= len(self.hosts):
+                    raise
+                continue
+            self._observe(host, model, data)
+            return data
+
+    async def _stream(self, model: str,
+                      call: Callable[[OllamaClient], AsyncIterator[Dict[str, Any]]]) -> AsyncIterator[Dict[str, Any]]:
+        tried: List[str] = []
+        while True:
+            host = self.select(model, tried)
+            started = False
+            stream = call(host.client)
+            try:
+                async with self._track(host):
+                    async for chunk in stream:
+                        started = True
+                        if chunk.get("done"):
+                            self._observe(host, model, chunk)
+                        yield chunk
+                return
+            except OllamaError as e:
+                tried.append(host.base_url)
+                if not self._failed(host, e) or started or len(tried) >= len(self.hosts):
+                    raise
+            finally:
+                # Агент мог оборвать генерацию — соединение с хостом закрывается сразу
+                await stream.aclose()
+
+    async def generate(self, prompt: str, model: Optional[str] = None, **params: Any) -> Dict[str, Any]:
+        model = model or self.model
+        params.setdefault("keep_alive", self.keep_alive)
+        return await self._call(model, lambda client: client.generate(prompt, model, **params))
+
+    async def chat(self, messages: List[Dict[str, str]], model: Optional[str] = None,
+                   **params: Any) -> Dict[str, Any]:
+        model = model or self.model
+        params.setdefault("keep_alive", self.keep_alive)
+        return await self._call(model, lambda client: client.chat(messages, model, **params))
+
+    def generate_stream(self, prompt: str, model: Optional[str] = None,
+                        **params: Any) -> AsyncIterator[Dict[str, Any]]:
+        model = model or self.model
+        params.setdefault("keep_alive", self.keep_alive)
+        return self._stream(model, lambda client: client.generate_stream(prompt, model, **params))
+
+    def chat_stream(self, messages: List[Dict[str, str]], model: Optional[str] = None,
+                    **params: Any) -> AsyncIterator[Dict[str, Any]]:
+        model = model or self.model
+        params.setdefault("keep_alive", self.keep_alive)
+        return self._stream(model, lambda client: client.chat_stream(messages, model, **params))
+
+    async def embed(self, texts: List[str], model: Optional[str] = None, **params: Any) -> Dict[str, Any]:
+        model = model or self.model
+        params.setdefault("keep_alive", self.keep_alive)
+        return await self._call(model, lambda client: client.embed(texts, model, **params))
+
+    async def _refresh_resident(self, host: OllamaHost):
+        try:
+            data = await host.client.ps()
+        except OllamaError as e:
+            self._failed(host, e)
+            return
+        host.resident = {model_name(model["name"]) for model in data.get("models", [])}
+
+    async def _load(self, host: OllamaHost, model: str, reason: str) -> bool:
+        """Загружает модель на хост (пустой промпт) или продлевает её keep_alive, если она уже в памяти"""
+        try:
+            async with self._track(host):
+                data = await host.client.generate("", model, keep_alive=self.keep_alive)
+        except OllamaError as e:
+            self._failed(host, e)
+            logger.error(f"Can't load {model} on {host.base_url}: {e}")
+            return False
+        self._observe(host, model, data, reason)
+        return True
+
+    async def warm_up(self):
+        """Загрузка preload_models на все хосты (при запуске сервиса)"""
+        started = time.perf_counter()
+        await asyncio.gather(*(self._refresh_resident(host) for host in self.hosts))
+        results = await asyncio.gather(*(
+            self._load(host, model, "preload") for host in self.hosts for model in self.preload_models
+        ))
+        self.preloads += sum(results)
+        logger.info(
+            f"Preloaded {sum(results)}/{len(results)} models on {len(self.hosts)} Ollama hosts "
+            f"in {time.perf_counter() - started:.1f} s"
+        )
+
+    async def _keep_alive_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await asyncio.gather(*(self._refresh_resident(host) for host in self.hosts if host.available()))
+                if not self.in_business_hours():
+                    # Вне рабочих часов модели выгружаются сами по истечении keep_alive
+                    continue
+                # Модель, отвечавшая за последний интервал, продлевает keep_alive своими запросами
+                now = time.monotonic()
+                stale = [
+                    (host, model) for host in self.hosts for model in self.preload_models
+                    if host.available() and now - host.last_used.get(model_name(model), 0.0) >= self.refresh_interval
+                ]
+                results = await asyncio.gather(*(self._load(host, model, "keep_alive") for host, model in stale))
+                self.keep_alive_refreshes += sum(results)
+            except Exception as e:
+                logger.error(f"Ollama keep-alive refresh failed: {e}", exc_info=True)
+
+    def start(self):
+        """Фоновое обновление моделей в памяти хостов и продление keep_alive"""
+        if self._task is None and self.refresh_interval > 0:
+            self._task = asyncio.get_running_loop().create_task(self._keep_alive_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for host in self.hosts:
+            await host.client.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "preload_models": self.preload_models,
+            "preloads": self.preloads,
+            "keep_alive_refreshes": self.keep_alive_refreshes,
+            "business_hours": self.in_business_hours(),
+            "cold_loads": sum(host.cold_loads for host in self.hosts),
+            "hosts": {host.base_url: host.stats() for host in self.hosts},
+        }
+
+
+_pool: Optional[OllamaPool] = None
+
+
+def get_ollama_pool() -> OllamaPool:
+    """Единый пул хостов Ollama на процесс"""
+    global _pool
+    if _pool is None:
+        _pool = OllamaPool()
+    return _pool
+
+
+async def close_ollama_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
@@ -0,0 +1,323 @@
+# output_compactor.py
+
+import heapq
+import itertools
+import json
+import logging
+import re
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from tool_catalog import estimate_tokens
+from tool_router import WORD_RE
+
+logger = logging.getLogger("OutputCompactor")
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_DECODER = json.JSONDecoder()
+# Потоковый разбор не выдал ни одной записи
+_NO_ITEMS = object()
+
+
+def compact_json(value: Any) -> str:
+    """JSON без отступов и пробелов — отступы сами по себе съедают заметную часть токенов"""
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def drop_fields(value: Any, fields: Sequence[str]) -> Any:
+    """Рекурсивно убирает ненужные ключи (например, _links в ответах OpenProject)"""
+    if not fields:
+        return value
+    if isinstance(value, dict):
+        return {key: drop_fields(item, fields) for key, item in value.items() if key not in fields}
+    if isinstance(value, list):
+        return [drop_fields(item, fields) for item in value]
+    return value
+
+
+def _skip_ws(text: str, pos: int) -> int:
+    return _WHITESPACE.match(text, pos).end()
+
+
+def _iter_array(text: str, pos: int) -> Iterator[Any]:
+    """Элементы JSON-массива, начинающегося в pos, по одному"""
+    pos = _skip_ws(text, pos + 1)
+    if text[pos] == "]":
+        return pos + 1
+    while True:
+        item, pos = _DECODER.raw_decode(text, pos)
+        yield item
+        pos = _skip_ws(text, pos)
+        if text[pos] == ",":
+            pos = _skip_ws(text, pos + 1)
+        elif text[pos] == "]":
+            return pos + 1
+        else:
+            raise ValueError(f"Expected ',' or ']' at {pos}")
+
+
+def _walk(text: str, pos: int, path: Sequence[str], envelope: Dict[str, Any]) -> Iterator[Any]:
+    """
+    Идёт по JSON до массива по пути path и выдаёт его элементы, не разбирая документ целиком.
+    Скалярные поля объектов по пути складываются в envelope (total, count и т.п.)
+    """
+    pos = _skip_ws(text, pos)
+    char = text[pos]
+    if not path or char != "{":
+        if char == "[":
+            return (yield from _iter_array(text, pos))
+        value, pos = _DECODER.raw_decode(text, pos)
+        yield value
+        return pos
+
+    pos = _skip_ws(text, pos + 1)
+    if text[pos] == "}":
+        return pos + 1
+    while True:
+        key, pos = _DECODER.raw_decode(text, pos)
+        pos = _skip_ws(text, pos)
+        if text[pos] != ":":
+            raise ValueError(f"Expected ':' at {pos}")
+        pos = _skip_ws(text, pos + 1)
+        if key == path[0]:
+            pos = yield from _walk(text, pos, path[1:], envelope)
+        else:
+            value, pos = _DECODER.raw_decode(text, pos)
+            if not isinstance(value, (dict, list)):
+                envelope[key] = value
+        pos = _skip_ws(text, pos)
+        if text[pos] == ",":
+            pos = _skip_ws(text, pos + 1)
+        elif text[pos] == "}":
+            return pos + 1
+        else:
+            raise ValueError(f"Expected ',' or '}}' at {pos}")
+
+
+def iter_json_items(text: str, items_path: Sequence[str] = ()) -> Tuple[Iterator[Any], Dict[str, Any]]:
+    """
+    Потоковый разбор большого JSON: записи массива по пути items_path (или корневого массива).
+    В памяти одновременно только одна запись, а не всё дерево json.loads
+    """
+    envelope: Dict[str, Any] = {}
+    return _walk(text, 0, list(items_path), envelope), envelope
+
+
+def find_items(value: Any, items_path: Sequence[str]) -> Tuple[List[Any], Dict[str, Any]]:
+    """Записи уже разобранного JSON: массив по пути, корневой массив или самый большой массив верхнего уровня"""
+    envelope: Dict[str, Any] = {}
+    node = value
+    for key in items_path:
+        if not isinstance(node, dict) or key not in node:
+            node = value
+            break
+        envelope.update({k: v for k, v in node.items() if not isinstance(v, (dict, list))})
+        node = node[key]
+    else:
+        if items_path:
+            return (node if isinstance(node, list) else [node]), envelope
+
+    if isinstance(value, list):
+        return value, {}
+    if isinstance(value, dict):
+        lists = [(len(v), k) for k, v in value.items() if isinstance(v, list)]
+        if lists:
+            _, key = max(lists)
+            envelope = {k: v for k, v in value.items() if not isinstance(v, (dict, list))}
+            return value[key], envelope
+    return [value], {}
+
+
+def split_text(text: str, chunk_tokens: int, chars_per_token: float) -> List[str]:
+    """Нарезка текста на куски около chunk_tokens токенов по абзацам и строкам"""
+    limit = int(chunk_tokens * chars_per_token)
+    chunks, current, size = [], [], 0
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        while len(line) > limit:
+            if current:
+                chunks.append("\n".join(current))
+                current, size = [], 0
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if size + len(line) > limit and current:
+            chunks.append("\n".join(current))
+            current, size = [], 0
+        current.append(line)
+        size += len(line) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def query_terms(text: str) -> List[str]:
+    """Слова запроса и их триграммы — триграммы ловят другие падежи ("задачи" / "задачах")"""
+    terms = set()
+    for word in WORD_RE.findall(text.lower()):
+        if len(word) < 2:
+            continue
+        terms.add(word)
+        terms.update(word[i:i + 3] for i in range(len(word) - 2))
+    return sorted(terms)
+
+
+def relevance(terms: Sequence[str], chunk: str) -> float:
+    """
+    Доля признаков запроса, встречающихся в куске. Поиск подстрок идёт на C, поэтому
+    десятки тысяч записей оцениваются за секунды, в отличие от векторизации каждой записи
+    """
+    if not terms:
+        return 0.0
+    chunk = chunk.lower()
+    return sum(1 for term in terms if term in chunk) / len(terms)
+
+
+class OutputCompactor:
+    """
+    Сжатие результата инструмента перед RAG-промптом:
+    компактный JSON без лишних полей, а если он не влезает в бюджет токенов —
+    только записи (куски текста), наиболее близкие к запросу пользователя.
+    Поля политики инструмента: drop_fields — какие ключи убрать,
+    items_path — путь к массиву записей ("_embedded.elements")
+    """
+
+    def __init__(self, token_budget: int, chunk_tokens: int, stream_min_chars: int,
+                 chars_per_token: float):
+        self.token_budget = token_budget
+        self.chunk_tokens = chunk_tokens
+        self.stream_min_chars = stream_min_chars
+        self.chars_per_token = chars_per_token
+
+        # Статистика
+        self.compactions = 0
+        self.streamed = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self.chunks_total = 0
+        self.chunks_dropped = 0
+
+    def _tokens(self, text: str) -> int:
+        return estimate_tokens(text, self.chars_per_token)
+
+    def _chunks(self, text: str, policy: Dict[str, Any]) -> Tuple[Iterator[str], Dict[str, Any]]:
+        fields = policy.get("drop_fields", ())
+        items_path = [key for key in policy.get("items_path", "").split(".") if key]
+        stripped = text.lstrip()
+
+        if stripped[:1] in ("{", "["):
+            try:
+                if len(text) >= self.stream_min_chars:
+                    self.streamed += 1
+                    items, envelope = iter_json_items(stripped, items_path)
+                    items = self._until_error(items)
+                    # Ни одной записи (лог вида "[INFO] ...", битое начало) — это не JSON, режем как текст
+                    first = next(items, _NO_ITEMS)
+                    if first is _NO_ITEMS:
+                        raise ValueError("no JSON items parsed")
+                    items = itertools.chain([first], items)
+                else:
+                    items, envelope = find_items(json.loads(text), items_path)
+                return (compact_json(drop_fields(item, fields)) for item in items), envelope
+            except (ValueError, IndexError):
+                # Не JSON или обрезанный JSON — режем как текст
+                pass
+
+        return iter(split_text(text, self.chunk_tokens, self.chars_per_token)), {}
+
+    @staticmethod
+    def _until_error(items: Iterator[Any]) -> Iterator[Any]:
+        # Обрезанный или битый хвост большого JSON не отменяет уже разобранные записи
+        try:
+            yield from items
+        except (ValueError, IndexError) as e:
+            logger.warning(f"Streaming JSON parse stopped: {e}")
+
+    def _select(self, chunks: Iterator[str], terms: Sequence[str],
+                budget: int) -> Tuple[List[str], int, int]:
+        """
+        Оставляет куски в пределах бюджета. Пока всё влезает, куски не оцениваются;
+        после превышения бюджета уходят наименее близкие к запросу (порядок кусков сохраняется)
+        """
+        # (близость, -номер, номер, текст, токены): при равной близости уходят более поздние куски
+        kept: List[Tuple[float, int, int, str, int]] = []
+        kept_tokens = 0
+        total = 0
+        scoring = False
+
+        for index, chunk in enumerate(chunks):
+            total += 1
+            tokens = self._tokens(chunk)
+            if tokens > budget:
+                chunk = chunk[:int(budget * self.chars_per_token)] + "…"
+                tokens = self._tokens(chunk)
+
+            if scoring:
+                heapq.heappush(kept, (relevance(terms, chunk), -index, index, chunk, tokens))
+            else:
+                kept.append((0.0, -index, index, chunk, tokens))
+            kept_tokens += tokens
+
+            if not scoring and kept_tokens > budget:
+                scoring = True
+                kept = [(relevance(terms, c), neg, i, c, t) for _, neg, i, c, t in kept]
+                heapq.heapify(kept)
+            if scoring:
+                while kept_tokens > budget and kept:
+                    kept_tokens -= heapq.heappop(kept)[4]
+
+        kept.sort(key=lambda entry: entry[2])
+        return [entry[3] for entry in kept], len(kept), total
+
+    def compact(self, tool_name: str, policy: Dict[str, Any], user_input: str, parts: List[str],
+                token_budget: Optional[int] = None) -> str:
+        """Сжатый текст результата для RAG-промпта (token_budget — если бюджет делится между инструментами)"""
+        text = "\n\n".join(parts)
+        before = self._tokens(text)
+
+        terms = query_terms(user_input)
+        sections: List[List[str]] = [[] for _ in parts]
+        kept_total = chunks_total = 0
+        remaining = token_budget or self.token_budget
+        # Короткие части (например, строка-сводка) забирают сколько им нужно,
+        # остаток бюджета делится между крупными
+        order = sorted(range(len(parts)), key=lambda i: len(parts[i]))
+        for position, index in enumerate(order):
+            budget = max(1, remaining // (len(parts) - position))
+            chunks, envelope = self._chunks(parts[index], policy)
+            selected, kept, total = self._select(chunks, terms, budget)
+            kept_total += kept
+            chunks_total += total
+            section = sections[index]
+            # Поля envelope потокового разбора дописываются по ходу чтения записей — фильтруются здесь
+            envelope = drop_fields(envelope, policy.get("drop_fields", ()))
+            if envelope:
+                section.append(compact_json(envelope))
+            section.extend(selected)
+            if kept < total:
+                section.append(f"(показано {kept} из {total} записей, наиболее относящихся к запросу)")
+            remaining -= sum(self._tokens(line) for line in section)
+
+        compacted = "\n".join("\n".join(section) for section in sections if section)
+        after = self._tokens(compacted)
+
+        self.compactions += 1
+        self.tokens_before += before
+        self.tokens_after += after
+        self.chunks_total += chunks_total
+        self.chunks_dropped += chunks_total - kept_total
+        logger.info(
+            f"Tool output of {tool_name} compacted: ~{before} -> ~{after} tokens "
+            f"({kept_total}/{chunks_total} chunks kept)"
+        )
+        return compacted
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "token_budget": self.token_budget,
+            "compactions": self.compactions,
+            "streamed": self.streamed,
+            "tokens_before": self.tokens_before,
+            "tokens_after": self.tokens_after,
+            "chunks_total": self.chunks_total,
+            "chunks_dropped": self.chunks_dropped,
+        }
@@ -0,0 +1,137 @@
+# prefetch.py
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+import numpy as np
+
+from tool_policies import get_tool_policy
+from tool_result_cache import canonical_args
+from tool_router import ToolIndex, embed_text, extract_trivial_args
+
+logger = logging.getLogger("Prefetch")
+
+
+class Prefetch:
+    """Спекулятивный вызов инструмента, начатый до ответа LLM"""
+
+    def __init__(self, tool_name: str, args: Dict[str, Any], task: asyncio.Task, source: str):
+        self.tool_name = tool_name
+        self.args = args
+        self.task = task
+        self.source = source
+        self.started = time.perf_counter()
+        self.finished: Optional[float] = None
+        self.claimed = False
+        task.add_done_callback(self._done)
+
+    def _done(self, task: asyncio.Task):
+        self.finished = time.perf_counter()
+        # Исключение забирается здесь, даже если результат не понадобится
+        if not task.cancelled():
+            task.exception()
+
+    def matches(self, tool_name: str, args: Dict[str, Any]) -> bool:
+        return self.tool_name == tool_name and canonical_args(self.args) == canonical_args(args)
+
+
+class SpeculativePrefetcher:
+    """
+    Предсказывает инструмент по похожим запросам, которые уже выбирала LLM
+    (или по индексу инструментов), и вызывает его параллельно с LLM.
+    Участвуют только инструменты с side_effect_free в политике и аргументами,
+    которые можно получить без LLM. Если LLM выбрала другое — результат выбрасывается
+    """
+
+    def __init__(self, index: ToolIndex, history_size: int, min_similarity: float, min_score: float):
+        self.index = index
+        self.min_similarity = min_similarity
+        self.min_score = min_score
+        # (вектор запроса, выбранный LLM инструмент)
+        self._history: Deque[Tuple[np.ndarray, str]] = deque(maxlen=history_size)
+
+        # Статистика
+        self.predictions = 0
+        self.started = 0
+        self.hits = 0
+        self.wasted = 0
+        self.not_eligible = 0
+        self.saved_time_total = 0.0
+
+    def record(self, user_input: str, tool_name: str):
+        """Запоминает выбор LLM для будущих предсказаний"""
+        self._history.append((embed_text(user_input, self.index.dim), tool_name))
+
+    def predict(self, user_input: str) -> Optional[Tuple[str, str]]:
+        """(инструмент, источник предсказания) или None"""
+        if self._history:
+            vector = embed_text(user_input, self.index.dim)
+            similarities = np.stack([past for past, _ in self._history]) @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.min_similarity:
+                return self._history[best][1], "history"
+
+        ranked = self.index.rank(user_input, k=1)
+        if ranked and ranked[0][1] >= self.min_score:
+            return ranked[0][0], "index"
+        return None
+
+    def start(self, user_input: str, tools_map: Dict[str, Any],
+              call: Callable[[str, Dict[str, Any]], Optional[Awaitable[Any]]]) -> Optional[Prefetch]:
+        """
+        Запускает вызов предсказанного инструмента. call(имя, аргументы) возвращает
+        корутину вызова или None, если инструмент вызвать нельзя
+        """
+        prediction = self.predict(user_input)
+        if prediction is None:
+            return None
+        tool_name, source = prediction
+        self.predictions += 1
+
+        tool = tools_map.get(tool_name)
+        args = extract_trivial_args(tool, user_input) if tool is not None else None
+        if args is None or not get_tool_policy(tool_name).get("side_effect_free"):
+            self.not_eligible += 1
+            return None
+
+        coro = call(tool_name, args)
+        if coro is None:
+            self.not_eligible += 1
+            return None
+        self.started += 1
+        logger.info(f"Prefetching {tool_name} ({source}) while routing LLM is generating")
+        return Prefetch(tool_name, args, asyncio.ensure_future(coro), source)
+
+    def claim(self, prefetch: Optional[Prefetch], tool_name: str, args: Dict[str, Any]) -> Optional[asyncio.Task]:
+        """Задача с уже идущим вызовом, если LLM выбрала тот же инструмент с теми же аргументами"""
+        if prefetch is None or prefetch.claimed or not prefetch.matches(tool_name, args):
+            return None
+        prefetch.claimed = True
+        self.hits += 1
+        # Сэкономлено столько, сколько вызов успел пройти до ответа LLM
+        self.saved_time_total += (prefetch.finished or time.perf_counter()) - prefetch.started
+        logger.info(f"Prefetch hit: {tool_name}")
+        return prefetch.task
+
+    def release(self, prefetch: Optional[Prefetch]):
+        """Завершение запроса: невостребованный вызов отменяется и считается впустую"""
+        if prefetch is None or prefetch.claimed:
+            return
+        self.wasted += 1
+        prefetch.task.cancel()
+        logger.info(f"Prefetch wasted: {prefetch.tool_name}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "history": len(self._history),
+            "predictions": self.predictions,
+            "started": self.started,
+            "hits": self.hits,
+            "wasted": self.wasted,
+            "not_eligible": self.not_eligible,
+            "hit_rate": round(self.hits / self.started, 4) if self.started else 0.0,
+            "avg_saved_ms": round(1000 * self.saved_time_total / self.hits, 3) if self.hits else 0.0,
+        }
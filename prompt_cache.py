@@ -0,0 +1,102 @@
+# prompt_cache.py
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("PromptCache")
+
+
+class RoutingPrefix:
+    """
+    Статичная часть промпта выбора инструмента (инструкция и каталог инструментов).
+    Привязана к версии каталога и набору отобранных инструментов.
+    """
+
+    def __init__(self, key: Tuple[str, Tuple[str, ...]], text: str):
+        self.key = key
+        self.text = text
+        self.created_at = time.time()
+        # Токены контекста Ollama после обработки префикса (режим "context")
+        self.context: Optional[List[int]] = None
+        self.lock = asyncio.Lock()
+        # Первый запрос с этим префиксом обрабатывается Ollama целиком
+        self.warm = False
+        # JSON Schema ответа для параметра format (строится при первом использовании)
+        self.format_schema: Optional[Dict[str, Any]] = None
+
+    @property
+    def catalog_version(self) -> str:
+        return self.key[0]
+
+
+class PrefillStats:
+    """Время обработки промпта (prefill) Ollama: холодные запросы против переиспользованного префикса"""
+
+    def __init__(self):
+        self.samples: Dict[str, Dict[str, float]] = {
+            "cold": {"count": 0, "tokens": 0, "ms": 0.0},
+            "warm": {"count": 0, "tokens": 0, "ms": 0.0},
+        }
+
+    def record(self, warm: bool, ms: float, tokens: int = 0):
+        sample = self.samples["warm" if warm else "cold"]
+        sample["count"] += 1
+        sample["tokens"] += tokens
+        sample["ms"] += ms
+
+    def stats(self) -> Dict[str, Any]:
+        result = {}
+        for kind, sample in self.samples.items():
+            count = sample["count"]
+            result[kind] = {
+                "count": count,
+                "avg_prefill_tokens": round(sample["tokens"] / count, 1) if count else 0.0,
+                "avg_prefill_ms": round(sample["ms"] / count, 3) if count else 0.0,
+            }
+        return result
+
+
+class RoutingPrefixCache:
+    """Кэш префиксов промпта, сбрасывается при смене версии каталога инструментов"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.catalog_version = ""
+        self._prefixes: "OrderedDict[Tuple[str, Tuple[str, ...]], RoutingPrefix]" = OrderedDict()
+        self.builds = 0
+        self.invalidations = 0
+        self.prefill = PrefillStats()
+
+    def get(self, catalog_version: str, tool_names: Tuple[str, ...],
+            build: Callable[[], str]) -> RoutingPrefix:
+        if catalog_version != self.catalog_version:
+            if self._prefixes:
+                self.invalidations += 1
+                logger.info(f"Routing prefix cache invalidated: catalog {self.catalog_version} -> {catalog_version}")
+            self._prefixes.clear()
+            self.catalog_version = catalog_version
+
+        key = (catalog_version, tool_names)
+        prefix = self._prefixes.get(key)
+        if prefix is not None:
+            self._prefixes.move_to_end(key)
+            return prefix
+
+        prefix = RoutingPrefix(key, build())
+        self.builds += 1
+        self._prefixes[key] = prefix
+        if len(self._prefixes) > self.max_entries:
+            self._prefixes.popitem(last=False)
+        return prefix
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "catalog_version": self.catalog_version,
+            "prefixes": len(self._prefixes),
+            "builds": self.builds,
+            "invalidations": self.invalidations,
+            "prefill": self.prefill.stats(),
+        }
@@ -1,38 +1,91 @@
 # qa_server.py
 
-import requests
-from fastmcp import FastMCP
+import asyncio
+import time
+from contextlib import aclosing
+from typing import List
+
+from fastmcp import Context, FastMCP
+
+from config import QA_MAX_CONCURRENCY, QA_MAX_QUEUE, QA_REQUEST_DEADLINE, QA_PROGRESS_INTERVAL
+from llm_scheduler import LLMScheduler, SchedulerOverloaded, PRIORITY_SUMMARIZE
+from llm_stages import LLMStages
+from ollama_client import OllamaError
+from ollama_pool import close_ollama_pool, get_ollama_pool
 mcp = FastMCP("QA Server", port=3335)
+# Модель и параметры ответов — стадия qa в LLM_STAGE_MODELS
+llm_stages = LLMStages()
+# Не больше QA_MAX_CONCURRENCY генераций одновременно и QA_MAX_QUEUE в очереди (у всех вопросов один приоритет)
+scheduler = LLMScheduler(QA_MAX_CONCURRENCY, QA_MAX_QUEUE, {"summarize": QA_REQUEST_DEADLINE})
 @mcp.tool(
     name="ask_llama3",
     description="Отвечает на любые вопросы"
     )
-def ask_llama3(question: str) -> str:
+async def ask_llama3(question: str, ctx: Context) -> str:
     """
     name: ask_llama3
     description: Отвечает на любые вопросы
     parameters:
       question: string
     returns: string
+
+    Ответ генерируется потоком: уже готовый текст уходит клиенту уведомлениями о прогрессе
+    (message — очередной кусок текста) не чаще раза в QA_PROGRESS_INTERVAL секунд.
+    Через QA_REQUEST_DEADLINE секунд возвращается то, что модель успела сгенерировать
     """
+    params = llm_stages.params("qa")
+    parts: List[str] = []
+    pending: List[str] = []
+    started = time.perf_counter()
+    last_sent = started
+
+    async def flush():
+        nonlocal last_sent
+        if pending:
+            await ctx.report_progress(len(parts), message="".join(pending))
+            pending.clear()
+        last_sent = time.perf_counter()
+
     try:
-        response = requests.post(
-            "http://localhost:11434/api/generate",
-            json={
-                "model": "llama3",
-                "prompt": question,
-                "stream": False
-            }
-        )
-        if response.status_code == 200:
-            return response.json().get("response", "Нет ответа от модели.")
-        else:
-            return f"Ошибка Ollama: {response.status_code}"
+        async with asyncio.timeout(QA_REQUEST_DEADLINE):
+            async with scheduler.slot(PRIORITY_SUMMARIZE):
+                started = time.perf_counter()
+                # aclosing закрывает соединение с Ollama при дедлайне — генерация прекращается
+                async with aclosing(get_ollama_pool().generate_stream(question, **params)) as chunks:
+                    async for chunk in chunks:
+                        token = chunk.get("response", "")
+                        if token:
+                            parts.append(token)
+                            pending.append(token)
+                        if time.perf_counter() - last_sent >= QA_PROGRESS_INTERVAL:
+                            await flush()
+            await flush()
+    except TimeoutError:
+        llm_stages.record("qa", params["model"], time.perf_counter() - started, ok=False)
+        if not parts:
+            return f"Модель не ответила за {QA_REQUEST_DEADLINE} с"
+        return "".join(parts) + f"\n\n(ответ прерван: превышено время {QA_REQUEST_DEADLINE} с)"
+    except SchedulerOverloaded:
+        return "Сервер перегружен, попробуйте позже"
+    except OllamaError as e:
+        llm_stages.record("qa", params["model"], time.perf_counter() - started, ok=False)
+        if e.status is not None:
+            return f"Ошибка Ollama: {e.status}"
+        return f"Ошибка при вызове модели: {str(e)}"
     except Exception as e:
         return f"Ошибка при вызове модели: {str(e)}"
+    llm_stages.record("qa", params["model"], time.perf_counter() - started)
+    return "".join(parts) or "Нет ответа от модели."
+
+
+async def main():
+    try:
+        await mcp.run_async(transport="streamable-http")
+    finally:
+        # Закрывает keep-alive соединения с хостами Ollama
+        await close_ollama_pool()
 
 
 if __name__ == "__main__":
     print("Запуск QA Server на порту 3335")
-    mcp.run(transport="streamable-http")
-    
\ No newline at end of file
+    asyncio.run(main())
@@ -0,0 +1,467 @@
+# rag_index.py
+#
+# Индекс документации проекта для rag_query.py: фрагменты документов и их векторы
+# в файле, который открывается через np.memmap, и метаданные рядом с ним.
+#
+#   python rag_index.py                      — проиндексировать RAG_DOCS_DIR (только изменившиеся файлы)
+#   python rag_index.py --search "вопрос"    — найти фрагменты по вопросу
+
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import os
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from config import (
+    RAG_DOCS_DIR, RAG_FILE_EXTENSIONS, RAG_INDEX_DIR, RAG_CHUNK_TOKENS, PROMPT_CHARS_PER_TOKEN,
+    RAG_EMBEDDER, RAG_EMBED_MODEL, RAG_EMBED_BATCH, RAG_HASH_DIM, RAG_QUERY_PREFIX, RAG_DOCUMENT_PREFIX,
+    RAG_TOP_K, RAG_IVF_MIN_ROWS, RAG_IVF_NPROBE, RAG_COMPACT_RATIO
+)
+from ollama_pool import close_ollama_pool, get_ollama_pool
+from output_compactor import split_text
+from tool_router import embed_text
+
+logger = logging.getLogger("RagIndex")
+
+META_FILE = "meta.json"
+# Строка индекса: где лежит текст фрагмента, из какого он файла, не удалён ли, в каком кластере IVF
+ROW_DTYPE = np.dtype([("offset", "<i8"), ("length", "<i4"), ("file", "<i4"), ("alive", "u1"), ("list", "<i4")])
+# Обучение IVF: итерации k-means и сколько векторов для него брать
+IVF_TRAIN_ITERATIONS = 10
+IVF_TRAIN_SAMPLE = 50_000
+# По сколько строк перемножать при переписывании индекса и разметке кластеров
+BLOCK_ROWS = 16_384
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def empty_meta() -> Dict[str, Any]:
+    return {
+        "generation": 0, "commit": 0, "embedder": None, "dim": 0,
+        "rows": 0, "passages_bytes": 0, "next_file_id": 0, "files": {},
+        "vectors_file": None, "passages_file": None, "rows_file": None,
+        "centroids_file": None, "ivf_trained_rows": 0, "updated_at": None,
+    }
+
+
+def scan_docs(docs_dir: str, extensions: Sequence[str]) -> Dict[str, Tuple[float, int]]:
+    """Файлы документов: относительный путь -> (mtime, размер)"""
+    found: Dict[str, Tuple[float, int]] = {}
+    for root, _, names in os.walk(docs_dir):
+        for name in names:
+            if not name.lower().endswith(tuple(extensions)):
+                continue
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            found[os.path.relpath(path, docs_dir).replace(os.sep, "/")] = (stat.st_mtime, stat.st_size)
+    return dict(sorted(found.items()))
+
+
+def train_ivf(sample: np.ndarray, nlist: int, seed: int = 0) -> np.ndarray:
+    """Центры кластеров (сферический k-means по нормированным векторам)"""
+    rng = np.random.default_rng(seed)
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(IVF_TRAIN_ITERATIONS):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        counts = np.bincount(assign, minlength=nlist)
+        # Пустой кластер получает случайный вектор выборки
+        empty = counts == 0
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        centroids = normalize(sums)
+    return centroids
+
+
+def assign_lists(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    lists = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), BLOCK_ROWS):
+        lists[start:start + BLOCK_ROWS] = np.argmax(vectors[start:start + BLOCK_ROWS] @ centroids.T, axis=1)
+    return lists
+
+
+class Embedder:
+    """Векторы текстов: модель Ollama (/api/embed) или хэшированные признаки слов ("hash")"""
+
+    def __init__(self, kind: str = RAG_EMBEDDER, model: str = RAG_EMBED_MODEL,
+                 batch: int = RAG_EMBED_BATCH, hash_dim: int = RAG_HASH_DIM):
+        self.kind = kind
+        self.model = model
+        self.batch = batch
+        self.hash_dim = hash_dim
+
+    @property
+    def name(self) -> str:
+        """Векторы разных моделей несравнимы: при смене name индекс строится заново"""
+        return f"hash:{self.hash_dim}" if self.kind == "hash" else f"ollama:{self.model}"
+
+    def _hash_embed(self, texts: List[str]) -> np.ndarray:
+        return np.vstack([embed_text(text, self.hash_dim) for text in texts])
+
+    async def embed(self, texts: List[str], query: bool = False) -> np.ndarray:
+        if self.kind == "hash":
+            # Тысячи фрагментов файла считаются заметное время — не в event loop
+            return await asyncio.to_thread(self._hash_embed, texts)
+        prefix = RAG_QUERY_PREFIX if query else RAG_DOCUMENT_PREFIX
+        vectors: List[List[float]] = []
+        for start in range(0, len(texts), self.batch):
+            batch = [prefix + text for text in texts[start:start + self.batch]]
+            data = await get_ollama_pool().embed(batch, self.model)
+            vectors.extend(data["embeddings"])
+        return normalize(vectors)
+
+
+class IndexView:
+    """
+    Открытое состояние индекса. load() собирает новое целиком и подменяет одной ссылкой,
+    поэтому поиск в потоке (asyncio.to_thread) не видит строк одной версии и векторов другой
+    """
+
+    def __init__(self, meta: Dict[str, Any], rows: np.ndarray, vectors: Optional[np.ndarray] = None,
+                 passages: Optional[np.ndarray] = None, centroids: Optional[np.ndarray] = None):
+        self.meta = meta
+        self.rows = rows
+        self.vectors = vectors
+        self.passages = passages
+        self.centroids = centroids
+        self.sources: Dict[int, str] = {entry["id"]: path for path, entry in meta["files"].items()}
+        # Кластеры IVF: номера строк, упорядоченные по кластеру, и границы кластеров в этом порядке
+        self.list_order: Optional[np.ndarray] = None
+        self.list_bounds: Optional[np.ndarray] = None
+        if centroids is not None:
+            self.list_order = np.argsort(rows["list"], kind="stable")
+            self.list_bounds = np.searchsorted(rows["list"][self.list_order], np.arange(len(centroids) + 1))
+
+    def search(self, query: np.ndarray, k: int, nprobe: int) -> List[Tuple[int, float]]:
+        """k ближайших живых фрагментов: [(строка, близость)] по убыванию близости"""
+        query = np.asarray(query, dtype=np.float32)
+        # Индекс построен другим embedder (до переиндексации векторы несравнимы)
+        if self.vectors is None or query.shape != (self.vectors.shape[1],):
+            return []
+        if self.centroids is not None:
+            probe = np.argsort(-(self.centroids @ query))[:nprobe]
+            candidates = np.sort(np.concatenate([
+                self.list_order[self.list_bounds[c]:self.list_bounds[c + 1]] for c in probe
+            ]))
+            candidates = candidates[self.rows["alive"][candidates] == 1]
+            scores = self.vectors[candidates] @ query
+        else:
+            candidates = None
+            scores = np.asarray(self.vectors @ query)
+            scores[self.rows["alive"] == 0] = -np.inf
+        k = min(k, len(scores))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        rows = candidates[top] if candidates is not None else top
+        return [(int(row), float(scores[i])) for row, i in zip(rows, top) if np.isfinite(scores[i])]
+
+    def passage(self, row: int) -> Tuple[str, str]:
+        """(файл, текст) фрагмента"""
+        record = self.rows[row]
+        start = int(record["offset"])
+        text = bytes(self.passages[start:start + int(record["length"])]).decode("utf-8")
+        return self.sources.get(int(record["file"]), "?"), text
+
+
+class RagIndex:
+    """
+    Фрагменты документов и их векторы на диске. Векторы — float32-матрица, открытая через np.memmap:
+    запуск сервера не читает и не пересчитывает их. meta.json хранит файлы (mtime, размер, sha1),
+    таблица строк rows.*.npy — где лежит текст каждого фрагмента.
+    Фрагменты изменившихся файлов помечаются удалёнными, новые дописываются в конец; когда удалённых
+    больше compact_ratio, индекс переписывается. meta.json заменяется атомарно последним, поэтому
+    прерванная индексация оставляет прежний индекс.
+    Поиск — косинусная близость (векторы нормированы) по всей матрице, а начиная с ivf_min_rows
+    фрагментов — только по nprobe ближайшим к вопросу кластерам
+    """
+
+    def __init__(self, index_dir: str = RAG_INDEX_DIR, ivf_min_rows: int = RAG_IVF_MIN_ROWS,
+                 nprobe: int = RAG_IVF_NPROBE, compact_ratio: float = RAG_COMPACT_RATIO):
+        self.index_dir = index_dir
+        self.ivf_min_rows = ivf_min_rows
+        self.nprobe = nprobe
+        self.compact_ratio = compact_ratio
+        self.view = IndexView(empty_meta(), np.zeros(0, dtype=ROW_DTYPE))
+        self._meta_mtime: Optional[float] = None
+        self._reindex_lock = asyncio.Lock()
+
+        # Статистика
+        self.searches = 0
+        self.search_time_total = 0.0
+        self.last_reindex: Dict[str, Any] = {}
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.index_dir, name)
+
+    def load(self) -> bool:
+        """Открывает индекс с диска; векторы и тексты отображаются в память, а не читаются"""
+        meta_path = self._path(META_FILE)
+        if not os.path.exists(meta_path):
+            return False
+        mtime = os.stat(meta_path).st_mtime
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        count = meta["rows"]
+        rows = np.load(self._path(meta["rows_file"]))[:count] if count else np.zeros(0, dtype=ROW_DTYPE)
+        vectors = np.memmap(self._path(meta["vectors_file"]), dtype=np.float32, mode="r",
+                            shape=(count, meta["dim"])) if count else None
+        passages = np.memmap(self._path(meta["passages_file"]), dtype=np.uint8, mode="r",
+                             shape=(meta["passages_bytes"],)) if meta["passages_bytes"] else None
+        centroids = np.load(self._path(meta["centroids_file"])) if meta["centroids_file"] else None
+
+        self.view = IndexView(meta, rows, vectors, passages, centroids)
+        self._meta_mtime = mtime
+        return True
+
+    def maybe_reload(self):
+        """Подхватывает индекс, обновлённый другим процессом (python rag_index.py)"""
+        try:
+            mtime = os.stat(self._path(META_FILE)).st_mtime
+        except OSError:
+            return
+        if mtime != self._meta_mtime:
+            self.load()
+            logger.info(f"Index reloaded: {len(self.view.rows)} chunks")
+
+    def search(self, query: np.ndarray, k: int = RAG_TOP_K) -> List[Tuple[str, str, float]]:
+        """k ближайших к вопросу фрагментов: [(файл, текст, близость)] по убыванию близости"""
+        started = time.perf_counter()
+        view = self.view
+        try:
+            return [(*view.passage(row), score) for row, score in view.search(query, k, self.nprobe)]
+        finally:
+            self.searches += 1
+            self.search_time_total += time.perf_counter() - started
+
+    # === Индексация ===
+
+    def _write_rows(self, meta: Dict[str, Any], rows: np.ndarray):
+        """Новая таблица строк и meta.json (атомарно), потом удаление файлов прежнего состояния"""
+        previous = self.view.meta if self._meta_mtime is not None else empty_meta()
+        meta["commit"] += 1
+        meta["rows_file"] = f"rows.{meta['commit']}.npy"
+        meta["updated_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        np.save(self._path(meta["rows_file"]), rows)
+        tmp_path = self._path(f"{META_FILE}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp_path, self._path(META_FILE))
+
+        current = {meta[key] for key in ("rows_file", "vectors_file", "passages_file", "centroids_file")}
+        for key in ("rows_file", "vectors_file", "passages_file", "centroids_file"):
+            name = previous.get(key)
+            if name and name not in current:
+                try:
+                    os.remove(self._path(name))
+                except OSError as e:
+                    logger.warning(f"Can't remove old index file {name}: {e}")
+
+    def _append(self, meta: Dict[str, Any], vectors: np.ndarray, texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """Дописывает векторы и тексты в файлы поколения; хвост прерванной записи отрезается"""
+        encoded = [text.encode("utf-8") for text in texts]
+        with open(self._path(meta["vectors_file"]), "ab") as f:
+            f.truncate(meta["rows"] * meta["dim"] * 4)
+            f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        with open(self._path(meta["passages_file"]), "ab") as f:
+            f.truncate(meta["passages_bytes"])
+            f.write(b"".join(encoded))
+        lengths = np.array([len(data) for data in encoded], dtype=np.int64)
+        offsets = meta["passages_bytes"] + np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        meta["rows"] += len(texts)
+        meta["passages_bytes"] += int(lengths.sum())
+        return offsets, lengths
+
+    def _new_generation(self, meta: Dict[str, Any]):
+        meta["generation"] += 1
+        meta["vectors_file"] = f"vectors.{meta['generation']}.f32"
+        meta["passages_file"] = f"passages.{meta['generation']}.bin"
+        meta["rows"] = meta["passages_bytes"] = 0
+        for key in ("vectors_file", "passages_file"):
+            open(self._path(meta[key]), "wb").close()
+
+    def _compact(self, meta: Dict[str, Any], rows: np.ndarray) -> np.ndarray:
+        """Переписывает индекс без удалённых фрагментов"""
+        alive = np.flatnonzero(rows["alive"])
+        old_vectors = np.memmap(self._path(meta["vectors_file"]), dtype=np.float32, mode="r",
+                                shape=(meta["rows"], meta["dim"]))
+        old_passages = np.memmap(self._path(meta["passages_file"]), dtype=np.uint8, mode="r",
+                                 shape=(meta["passages_bytes"],)) if meta["passages_bytes"] else None
+        self._new_generation(meta)
+        compacted = rows[alive].copy()
+        for start in range(0, len(alive), BLOCK_ROWS):
+            block = alive[start:start + BLOCK_ROWS]
+            texts = [
+                bytes(old_passages[rows[i]["offset"]:rows[i]["offset"] + rows[i]["length"]]).decode("utf-8")
+                for i in block
+            ]
+            offsets, lengths = self._append(meta, old_vectors[block], texts)
+            compacted["offset"][start:start + len(block)] = offsets
+            compacted["length"][start:start + len(block)] = lengths
+        logger.info(f"Index compacted: {len(rows)} -> {len(compacted)} chunks")
+        return compacted
+
+    def _update_ivf(self, meta: Dict[str, Any], rows: np.ndarray, centroids: Optional[np.ndarray],
+                    force: bool) -> Optional[np.ndarray]:
+        """Обучает кластеры заново, когда индекс вырос вдвое с прошлого обучения, иначе размечает новые строки"""
+        count = meta["rows"]
+        if count < self.ivf_min_rows:
+            meta["centroids_file"], meta["ivf_trained_rows"] = None, 0
+            return None
+        vectors = np.memmap(self._path(meta["vectors_file"]), dtype=np.float32, mode="r", shape=(count, meta["dim"]))
+        if centroids is None or force or count > 2 * meta["ivf_trained_rows"]:
+            alive = np.flatnonzero(rows["alive"])
+            rng = np.random.default_rng(0)
+            sample = vectors[np.sort(rng.choice(alive, min(len(alive), IVF_TRAIN_SAMPLE), replace=False))]
+            nlist = max(1, int(math.sqrt(len(alive))))
+            started = time.perf_counter()
+            centroids = train_ivf(np.asarray(sample), nlist)
+            rows["list"] = assign_lists(vectors, centroids)
+            meta["ivf_trained_rows"] = count
+            meta["centroids_file"] = f"centroids.{meta['commit'] + 1}.npy"
+            np.save(self._path(meta["centroids_file"]), centroids)
+            logger.info(f"IVF trained: {nlist} lists over {len(alive)} chunks in {time.perf_counter() - started:.1f} s")
+        else:
+            new = np.flatnonzero(rows["list"] < 0)
+            if len(new):
+                rows["list"][new] = assign_lists(vectors[new], centroids)
+        return centroids
+
+    async def reindex(self, docs_dir: str, embedder: Embedder, extensions: Sequence[str] = RAG_FILE_EXTENSIONS,
+                      chunk_tokens: int = RAG_CHUNK_TOKENS,
+                      chars_per_token: float = PROMPT_CHARS_PER_TOKEN) -> Dict[str, Any]:
+        """Индексирует только новые и изменившиеся файлы docs_dir, удаляет фрагменты исчезнувших"""
+        async with self._reindex_lock:
+            started = time.perf_counter()
+            os.makedirs(self.index_dir, exist_ok=True)
+            self.maybe_reload()
+            meta = json.loads(json.dumps(self.view.meta))
+            rows = self.view.rows.copy()
+            centroids = self.view.centroids
+            result = {"added_files": 0, "removed_files": 0, "added_chunks": 0, "removed_chunks": 0}
+
+            if meta["embedder"] != embedder.name:
+                if meta["embedder"] is not None:
+                    logger.warning(f"Embedder changed {meta['embedder']} -> {embedder.name}, rebuilding index")
+                meta.update({"embedder": embedder.name, "dim": 0, "files": {}, "centroids_file": None,
+                             "ivf_trained_rows": 0})
+                rows, centroids = np.zeros(0, dtype=ROW_DTYPE), None
+                self._new_generation(meta)
+
+            def drop(path: str):
+                entry = meta["files"].pop(path)
+                dead = (rows["file"] == entry["id"]) & (rows["alive"] == 1)
+                result["removed_chunks"] += int(dead.sum())
+                rows["alive"][dead] = 0
+
+            current = scan_docs(docs_dir, extensions) if os.path.isdir(docs_dir) else {}
+            removed = [path for path in meta["files"] if path not in current]
+            for path in removed:
+                drop(path)
+                result["removed_files"] += 1
+            # Изменились и метаданные файла (mtime при том же содержимом) — их тоже нужно сохранить
+            touched = bool(removed) or meta["embedder"] != self.view.meta["embedder"]
+
+            new_rows: List[np.ndarray] = [rows]
+            for path, (mtime, size) in current.items():
+                entry = meta["files"].get(path)
+                if entry is not None and entry["mtime"] == mtime and entry["size"] == size:
+                    continue
+                touched = True
+                with open(os.path.join(docs_dir, path), "rb") as f:
+                    data = f.read()
+                sha1 = hashlib.sha1(data).hexdigest()
+                if entry is not None and entry["sha1"] == sha1:
+                    entry.update(mtime=mtime, size=size)
+                    continue
+                if entry is not None:
+                    drop(path)
+                chunks = split_text(data.decode("utf-8", errors="replace"), chunk_tokens, chars_per_token)
+                file_id = meta["next_file_id"]
+                meta["next_file_id"] += 1
+                meta["files"][path] = {"id": file_id, "mtime": mtime, "size": size, "sha1": sha1,
+                                       "chunks": len(chunks)}
+                result["added_files"] += 1
+                if not chunks:
+                    continue
+                vectors = await embedder.embed(chunks)
+                if not meta["dim"]:
+                    meta["dim"] = vectors.shape[1]
+                offsets, lengths = await asyncio.to_thread(self._append, meta, vectors, chunks)
+                added = np.zeros(len(chunks), dtype=ROW_DTYPE)
+                added["offset"], added["length"], added["file"], added["alive"] = offsets, lengths, file_id, 1
+                added["list"] = -1
+                new_rows.append(added)
+                result["added_chunks"] += len(chunks)
+                logger.info(f"Indexed {path}: {len(chunks)} chunks")
+
+            if not touched and self._meta_mtime is not None:
+                self.last_reindex = {**result, "duration_s": round(time.perf_counter() - started, 3)}
+                return self.last_reindex
+
+            rows = np.concatenate(new_rows)
+            compacted = len(rows) and (rows["alive"] == 0).sum() > self.compact_ratio * len(rows)
+            if compacted:
+                rows = await asyncio.to_thread(self._compact, meta, rows)
+            centroids = await asyncio.to_thread(self._update_ivf, meta, rows, centroids, bool(compacted))
+            self._write_rows(meta, rows)
+            self.load()
+            self.last_reindex = {**result, "duration_s": round(time.perf_counter() - started, 3)}
+            logger.info(f"Reindex done: {self.last_reindex}, {int(self.view.rows['alive'].sum())} chunks in index")
+            return self.last_reindex
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "embedder": self.view.meta["embedder"],
+            "dim": self.view.meta["dim"],
+            "files": len(self.view.meta["files"]),
+            "chunks": int(self.view.rows["alive"].sum()) if len(self.view.rows) else 0,
+            "deleted_chunks": int((self.view.rows["alive"] == 0).sum()) if len(self.view.rows) else 0,
+            "ivf_lists": len(self.view.centroids) if self.view.centroids is not None else 0,
+            "updated_at": self.view.meta["updated_at"],
+            "searches": self.searches,
+            "avg_search_ms": round(1000 * self.search_time_total / self.searches, 3) if self.searches else 0.0,
+            "last_reindex": self.last_reindex,
+        }
+
+
+async def main(args: argparse.Namespace):
+    index = RagIndex(args.index)
+    embedder = Embedder(args.embedder)
+    try:
+        if args.search:
+            index.load()
+            if index.view.meta["embedder"] not in (None, embedder.name):
+                print(f"Индекс построен {index.view.meta['embedder']}, а не {embedder.name}: переиндексируйте")
+            query = (await embedder.embed([args.search], query=True))[0]
+            for source, text, score in index.search(query, args.top_k):
+                print(f"{score:.3f} [{source}] {text[:300]}\n")
+            print(json.dumps(index.stats(), ensure_ascii=False, indent=2))
+        else:
+            await index.reindex(args.docs, embedder)
+            print(json.dumps(index.stats(), ensure_ascii=False, indent=2))
+    finally:
+        await close_ollama_pool()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Индекс документации проекта для rag_query.py")
+    parser.add_argument("--docs", default=RAG_DOCS_DIR, help="папка документов")
+    parser.add_argument("--index", default=RAG_INDEX_DIR, help="папка индекса")
+    parser.add_argument("--embedder", default=RAG_EMBEDDER, choices=("ollama", "hash"), help="чем считать векторы")
+    parser.add_argument("--search", help="вопрос: найти фрагменты вместо индексации")
+    parser.add_argument("--top-k", type=int, default=RAG_TOP_K, help="сколько фрагментов показать")
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    asyncio.run(main(parser.parse_args()))
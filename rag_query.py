@@ -1,23 +1,97 @@
 # rag_query.py
 
-import requests
+import asyncio
+import logging
+
 from fastmcp import FastMCP
+
+from config import RAG_DOCS_DIR, RAG_TOP_K, RAG_REINDEX_INTERVAL
+from ollama_pool import close_ollama_pool
+from rag_index import Embedder, RagIndex
+
+logger = logging.getLogger("RagQuery")
+
 mcp = FastMCP("information about project participants", port=3337)
+# Индекс открывается с диска без пересчёта векторов; изменившиеся документы доиндексируются в фоне
+rag_index = RagIndex()
+embedder = Embedder()
+# Вопросы об участниках ищутся в тех же документах: состав команды — docs/participants.md
+PARTICIPANTS_QUERY_PREFIX = "участники проекта"
+
+
+async def search_docs(question: str) -> str:
+    """RAG_TOP_K самых близких к вопросу фрагментов документации с именем файла"""
+    try:
+        query = (await embedder.embed([question], query=True))[0]
+    except Exception as e:
+        return f"Ошибка при построении вектора вопроса: {str(e)}"
+    # Перемножение с матрицей векторов и чтение файлов индекса — в потоке, чтобы не блокировать event loop
+    await asyncio.to_thread(rag_index.maybe_reload)
+    found = await asyncio.to_thread(rag_index.search, query, RAG_TOP_K)
+    if not found:
+        return "В документации проекта ничего не найдено"
+    return "\n\n".join(f"[{source}] {text.strip()}" for source, text, _ in found)
+
+
 @mcp.tool(
     name="information_about_project_participants",
     description="Отвечает на вопросы об участниках проекта"
     )
-def rag_query() -> str:
+async def rag_query(question: str) -> str:
     """
     name: rag_query
     description: Отвечает на вопросы об участниках проекта
     parameters:
       question: string
     returns: string
+
+    Ищет ответ в документации проекта, как search_project_docs, с уточнением "участники проекта"
+    """
+    return await search_docs(f"{PARTICIPANTS_QUERY_PREFIX}: {question}")
+
+
+@mcp.tool(
+    name="search_project_docs",
+    description="Ищет в документации проекта фрагменты, отвечающие на вопрос"
+    )
+async def search_project_docs(question: str) -> str:
+    """
+    name: search_project_docs
+    description: Ищет в документации проекта фрагменты, отвечающие на вопрос
+    parameters:
+      question: string
+    returns: string
+
+    Возвращает RAG_TOP_K самых близких к вопросу фрагментов с именем файла
     """
-    return f"Руководитель, архитектор и разработчик - Ваганов Алексей, Аналитик - Дмитрий Гришаев, разработчик Дмитрий Акинфиев"
+    return await search_docs(question)
+
+
+async def reindex_loop():
+    """Доиндексирует изменившиеся документы при запуске и затем раз в RAG_REINDEX_INTERVAL секунд"""
+    while True:
+        try:
+            await rag_index.reindex(RAG_DOCS_DIR, embedder)
+        except Exception as e:
+            logger.error(f"Reindex of {RAG_DOCS_DIR} failed: {e}")
+        if RAG_REINDEX_INTERVAL <= 0:
+            return
+        await asyncio.sleep(RAG_REINDEX_INTERVAL)
+
+
+async def main():
+    if rag_index.load():
+        logger.info(f"Index loaded: {rag_index.stats()['chunks']} chunks")
+    task = asyncio.create_task(reindex_loop())
+    try:
+        await mcp.run_async(transport="streamable-http")
+    finally:
+        task.cancel()
+        # Соединения с Ollama открыты, если векторы считает модель (RAG_EMBEDDER = "ollama")
+        await close_ollama_pool()
+
 
 if __name__ == "__main__":
     print("Запуск QA Server на порту 3337")
-    mcp.run(transport="streamable-http")
-    
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
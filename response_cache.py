@@ -0,0 +1,190 @@
+# response_cache.py
+
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger("ResponseCache")
+
+QUOTES_RE = re.compile(r"[\"'«»“”„`]")
+# Знак в конце предложения; операторы, знак числа и десятичная точка внутри запроса остаются:
+# "5+3" и "5-3", "-5" и "5" — разные вопросы
+TRAILING_PUNCTUATION_RE = re.compile(r"[\s?!.…]+$")
+SPACES_RE = re.compile(r"\s+")
+
+
+def normalize_query(text: str) -> str:
+    """Нормализация запроса: регистр, ё/е, кавычки, знак в конце и лишние пробелы не важны"""
+    text = text.lower().replace("ё", "е")
+    text = QUOTES_RE.sub(" ", text)
+    text = SPACES_RE.sub(" ", text).strip()
+    return TRAILING_PUNCTUATION_RE.sub("", text)
+
+
+def flight_key(text: str) -> str:
+    """
+    Ключ объединения одновременных одинаковых запросов: только регистр и пробелы.
+    Строже ключа кэша — ошибочно объединённый запрос получил бы чужой ответ
+    """
+    return SPACES_RE.sub(" ", text.lower()).strip()
+
+
+class SQLiteCacheBackend:
+    """Хранение кэша на диске, чтобы он переживал перезапуск сервиса"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, query TEXT, tool_name TEXT, expires_at REAL, payload TEXT)"
+            )
+            self._conn.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+            self._conn.commit()
+
+    def get(self, key: str) -> Optional[Tuple[float, str, str, Dict[str, Any]]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT expires_at, query, tool_name, payload FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        expires_at, query, tool_name, payload = row
+        return expires_at, query, tool_name, json.loads(payload)
+
+    def set(self, key: str, query: str, tool_name: str, expires_at: float, payload: Dict[str, Any]):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, query, tool_name, expires_at, payload) VALUES (?, ?, ?, ?, ?)",
+                (key, query, tool_name, expires_at, json.dumps(payload, ensure_ascii=False))
+            )
+            self._conn.commit()
+
+    def delete(self, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def purge(self, tool_name: Optional[str] = None, query: Optional[str] = None) -> int:
+        conditions, params = [], []
+        if tool_name is not None:
+            conditions.append("tool_name = ?")
+            params.append(tool_name)
+        if query is not None:
+            conditions.append("query = ?")
+            params.append(query)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._lock:
+            count = self._conn.execute(f"DELETE FROM responses{where}", params).rowcount
+            self._conn.commit()
+        return count
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ResponseCache:
+    """
+    Кэш итоговых ответов агента.
+    Ключ — нормализованный запрос и версия каталога инструментов,
+    в памяти не больше max_entries записей (LRU), диск — опционально
+    """
+
+    def __init__(self, max_entries: int, path: Optional[str] = None):
+        self.max_entries = max_entries
+        # key -> (expires_at, нормализованный запрос, инструмент, ответ)
+        self._entries: "OrderedDict[str, Tuple[float, str, str, Dict[str, Any]]]" = OrderedDict()
+        self.disk = SQLiteCacheBackend(path) if path else None
+
+        # Статистика
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(catalog_version: str, user_input: str) -> Tuple[str, str]:
+        query = normalize_query(user_input)
+        key = hashlib.sha1(f"{catalog_version}\n{query}".encode("utf-8")).hexdigest()
+        return key, query
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[3]
+            del self._entries[key]
+
+        if self.disk is not None:
+            entry = await asyncio.to_thread(self.disk.get, key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._remember(key, entry)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return entry[3]
+                await asyncio.to_thread(self.disk.delete, key)
+
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, query: str, tool_name: str, payload: Dict[str, Any], ttl: float):
+        entry = (time.time() + ttl, query, tool_name, payload)
+        self._remember(key, entry)
+        self.stores += 1
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.set, key, query, tool_name, entry[0], payload)
+
+    def _remember(self, key: str, entry: Tuple[float, str, str, Dict[str, Any]]):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def purge(self, tool_name: Optional[str] = None, user_input: Optional[str] = None) -> int:
+        """Удаляет записи по инструменту и/или запросу, без параметров — весь кэш"""
+        query = normalize_query(user_input) if user_input is not None else None
+        keys = [
+            key for key, (_, entry_query, entry_tool, _) in self._entries.items()
+            if (tool_name is None or entry_tool == tool_name) and (query is None or entry_query == query)
+        ]
+        for key in keys:
+            del self._entries[key]
+        purged = len(keys)
+        if self.disk is not None:
+            purged = max(purged, await asyncio.to_thread(self.disk.purge, tool_name, query))
+        logger.info(f"Response cache purged: {purged} entries (tool={tool_name}, query={query})")
+        return purged
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "disk": self.disk.path if self.disk is not None else None,
+        }
@@ -0,0 +1,109 @@
+# response_modes.py
+
+import json
+import logging
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger("ResponseModes")
+
+# Режимы превращения результата инструмента в ответ пользователю
+MODE_PASSTHROUGH = "passthrough"
+MODE_TEMPLATE = "template"
+MODE_LLM_SUMMARIZE = "llm_summarize"
+# Режим не задан в политике — решает эвристика looks_like_answer
+MODE_AUTO = "auto"
+
+RESPONSE_MODES = (MODE_PASSTHROUGH, MODE_TEMPLATE, MODE_LLM_SUMMARIZE, MODE_AUTO)
+
+
+class _TemplateFields(dict):
+    """Недостающие поля шаблона остаются в тексте как есть, а не роняют форматирование"""
+
+    def __missing__(self, key: str) -> str:
+        return "{" + key + "}"
+
+
+def render_template(template: str, text: str, data: Optional[Dict[str, Any]]) -> str:
+    """Шаблон str.format: поля результата инструмента и {text} — текст результата целиком"""
+    fields = _TemplateFields(data or {})
+    fields["text"] = text
+    return template.format_map(fields)
+
+
+def looks_like_answer(text: str, max_chars: int, min_alpha_ratio: float) -> bool:
+    """
+    Результат уже похож на готовый ответ: короткий связный текст на русском,
+    а не JSON, таблица или набор чисел
+    """
+    stripped = text.strip()
+    if not stripped or len(stripped) > max_chars:
+        return False
+    if stripped[0] in "{[":
+        try:
+            json.loads(stripped)
+            return False
+        except json.JSONDecodeError:
+            pass
+
+    chars = [char for char in stripped if not char.isspace()]
+    letters = [char for char in chars if char.isalpha()]
+    if len(stripped.split()) < 2 or len(letters) < min_alpha_ratio * len(chars):
+        return False
+    # Итоговый ответ должен быть на русском — текст на другом языке пересказывает LLM
+    cyrillic = sum(1 for char in letters if "а" <= char.lower() <= "я" or char.lower() == "ё")
+    return cyrillic * 2 >= len(letters)
+
+
+class ResponseRenderer:
+    """
+    Выбирает, нужен ли второй проход LLM по результату инструмента.
+    Режим задаётся политикой инструмента (response_mode, response_template),
+    без него короткий готовый текст отдаётся как есть
+    """
+
+    def __init__(self, bypass_max_chars: int, bypass_min_alpha_ratio: float):
+        self.bypass_max_chars = bypass_max_chars
+        self.bypass_min_alpha_ratio = bypass_min_alpha_ratio
+        # Статистика по фактически выбранным режимам
+        self.counts: Dict[str, int] = {
+            MODE_PASSTHROUGH: 0, MODE_TEMPLATE: 0, "auto_bypass": 0, MODE_LLM_SUMMARIZE: 0
+        }
+
+    def render(self, tool_name: str, policy: Dict[str, Any], text: str,
+               data: Optional[Dict[str, Any]] = None) -> Optional[str]:
+        """Готовый ответ без LLM или None, если результат надо пересказать через LLM"""
+        mode = policy.get("response_mode", MODE_AUTO)
+        if mode not in RESPONSE_MODES:
+            logger.warning(f"Unknown response_mode '{mode}' for {tool_name}, using {MODE_AUTO}")
+            mode = MODE_AUTO
+
+        if mode == MODE_PASSTHROUGH:
+            self.counts[MODE_PASSTHROUGH] += 1
+            return text
+
+        if mode == MODE_TEMPLATE:
+            template = policy.get("response_template")
+            if template:
+                try:
+                    reply = render_template(template, text, data)
+                    self.counts[MODE_TEMPLATE] += 1
+                    return reply
+                except (ValueError, IndexError, AttributeError) as e:
+                    logger.warning(f"Bad response_template for {tool_name}: {e}")
+            else:
+                logger.warning(f"response_mode 'template' without response_template for {tool_name}")
+
+        if mode == MODE_AUTO and looks_like_answer(text, self.bypass_max_chars, self.bypass_min_alpha_ratio):
+            self.counts["auto_bypass"] += 1
+            return text
+
+        self.counts[MODE_LLM_SUMMARIZE] += 1
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        total = sum(self.counts.values())
+        bypassed = total - self.counts[MODE_LLM_SUMMARIZE]
+        return {
+            **self.counts,
+            "bypass_rate": round(bypassed / total, 3) if total else 0.0,
+        }
@@ -0,0 +1,224 @@
+# server_registry.py
+
+import asyncio
+import logging
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Collection, Dict, List, Optional
+
+logger = logging.getLogger("ServerRegistry")
+
+# Состояния автомата отключения реплики
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Вес нового замера в скользящем среднем времени ответа
+LATENCY_EWMA_ALPHA = 0.3
+# Ошибка учитывается в среднем как ответ за столько секунд: быстро падающая реплика
+# не должна выглядеть самой быстрой и забирать весь трафик
+FAILURE_LATENCY_PENALTY = 5.0
+
+
+class ServerUnavailable(Exception):
+    """У сервера нет ни одной доступной реплики"""
+
+
+def replica_urls(server_config: Dict[str, Any]) -> List[str]:
+    """Адреса реплик сервера: "urls" или единственный "url" """
+    return list(server_config.get("urls") or [server_config["url"]])
+
+
+class Replica:
+    """Одна реплика MCP-сервера: выполняющиеся запросы, время ответа, ошибки и состояние отключения"""
+
+    def __init__(self, server_name: str, url: str):
+        self.server_name = server_name
+        self.url = url
+        self.state = CLOSED
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.latency_ewma: Optional[float] = None
+        self.last_success = 0.0
+        self.last_error: Optional[str] = None
+
+        # Статистика
+        self.requests = 0
+        self.errors = 0
+        self.cancelled = 0
+        self.latency_total = 0.0
+        self.probes = 0
+        self.probe_failures = 0
+        self.trips = 0
+
+    def available(self, reset_timeout: float) -> bool:
+        """Можно ли отправить запрос: закрыт, или после reset_timeout — один пробный запрос"""
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and time.monotonic() - self.opened_at >= reset_timeout:
+            self.state = HALF_OPEN
+        return self.state == HALF_OPEN and not self.trial_in_flight
+
+    def score(self) -> float:
+        """Ожидаемое время ответа с учётом очереди: меньше — лучше (реплика без замеров — 0)"""
+        return (self.outstanding + 1) * (self.latency_ewma or 0.0)
+
+    def observe_latency(self, seconds: float, count: bool = True):
+        if count:
+            self.latency_total += seconds
+        if self.latency_ewma is None:
+            self.latency_ewma = seconds
+        else:
+            self.latency_ewma += LATENCY_EWMA_ALPHA * (seconds - self.latency_ewma)
+
+    def record_success(self):
+        self.consecutive_failures = 0
+        self.last_success = time.monotonic()
+        if self.state != CLOSED:
+            logger.info(f"Replica {self.url} of {self.server_name} is back, circuit closed")
+        self.state = CLOSED
+
+    def record_failure(self, error: str, failure_threshold: int):
+        self.errors += 1
+        self.observe_latency(FAILURE_LATENCY_PENALTY, count=False)
+        self.consecutive_failures += 1
+        self.last_error = error
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.consecutive_failures >= failure_threshold):
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self.trips += 1
+            logger.warning(
+                f"Replica {self.url} of {self.server_name} circuit opened after "
+                f"{self.consecutive_failures} failures: {error}"
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "errors": self.errors,
+            "error_rate": round(self.errors / self.requests, 4) if self.requests else 0.0,
+            "cancelled": self.cancelled,
+            "latency_ewma_ms": round(1000 * self.latency_ewma, 3) if self.latency_ewma is not None else None,
+            "avg_latency_ms": round(1000 * self.latency_total / self.requests, 3) if self.requests else 0.0,
+            "probes": self.probes,
+            "probe_failures": self.probe_failures,
+            "trips": self.trips,
+            "last_error": self.last_error,
+        }
+
+
+class ServerRegistry:
+    """
+    Реплики MCP-серверов из MCP_SERVERS_CONFIG ("urls" — несколько адресов одного сервера).
+    Запрос уходит на доступную реплику с наименьшим (выполняющиеся + 1) * среднее время ответа;
+    после failure_threshold ошибок подряд реплика отключается на reset_timeout, потом получает
+    один пробный запрос. Фоновые проверки пингуют реплики без недавних удачных запросов.
+    Индекс инструмент -> сервер строится при обнаружении инструментов
+    """
+
+    def __init__(self, servers_config: Dict[str, Dict[str, Any]], failure_threshold: int,
+                 reset_timeout: float, probe_interval: float, probe_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.replicas: Dict[str, List[Replica]] = {
+            server_name: [Replica(server_name, url) for url in replica_urls(server_config)]
+            for server_name, server_config in servers_config.items()
+        }
+        # Инструмент -> имя сервера
+        self.tool_servers: Dict[str, str] = {}
+        self._probe_task: Optional[asyncio.Task] = None
+
+    def set_tool_servers(self, tool_servers: Dict[str, str]):
+        self.tool_servers = tool_servers
+
+    def server_for(self, tool_name: str) -> Optional[str]:
+        return self.tool_servers.get(tool_name)
+
+    def select(self, server_name: str, exclude: Collection[str] = ()) -> Replica:
+        candidates = [
+            r for r in self.replicas[server_name] if r.url not in exclude and r.available(self.reset_timeout)
+        ]
+        if not candidates:
+            raise ServerUnavailable(f"All replicas of {server_name} are unavailable")
+        best = min(replica.score() for replica in candidates)
+        # Среди равных — случайная, чтобы реплики без замеров получали запросы поровну
+        return random.choice([replica for replica in candidates if replica.score() == best])
+
+    @asynccontextmanager
+    async def track(self, replica: Replica, healthy_errors: tuple = ()) -> AsyncIterator[None]:
+        """
+        Учёт запроса к реплике. Исключения healthy_errors (ошибка самого инструмента) не считаются
+        отказом реплики; отменённый запрос (таймаут вызывающего) только добавляет время ответа
+        """
+        if replica.state == HALF_OPEN:
+            replica.trial_in_flight = True
+        replica.outstanding += 1
+        replica.requests += 1
+        started = time.perf_counter()
+        try:
+            yield
+        except healthy_errors:
+            replica.record_success()
+            raise
+        except asyncio.CancelledError:
+            replica.cancelled += 1
+            replica.observe_latency(time.perf_counter() - started)
+            raise
+        except Exception as e:
+            replica.record_failure(str(e) or type(e).__name__, self.failure_threshold)
+            raise
+        else:
+            replica.record_success()
+            replica.observe_latency(time.perf_counter() - started)
+        finally:
+            replica.outstanding -= 1
+            replica.trial_in_flight = False
+
+    async def _probe(self, replica: Replica, ping: Callable[[str], Awaitable[Any]]):
+        replica.probes += 1
+        try:
+            await asyncio.wait_for(ping(replica.url), self.probe_timeout)
+        except Exception as e:
+            replica.probe_failures += 1
+            replica.record_failure(f"health probe: {str(e) or type(e).__name__}", self.failure_threshold)
+            return
+        replica.record_success()
+
+    async def _probe_loop(self, ping: Callable[[str], Awaitable[Any]]):
+        while True:
+            now = time.monotonic()
+            # Реплика, успешно отвечавшая на запросы в последний интервал, в проверке не нуждается
+            stale = [
+                replica for replicas in self.replicas.values() for replica in replicas
+                if now - replica.last_success >= self.probe_interval
+                and (replica.state != OPEN or replica.available(self.reset_timeout))
+            ]
+            await asyncio.gather(*(self._probe(replica, ping) for replica in stale))
+            await asyncio.sleep(self.probe_interval)
+
+    def start(self, ping: Callable[[str], Awaitable[Any]]):
+        """Фоновые проверки реплик; ping(url) — пинг реплики через её сессию"""
+        if self._probe_task is None and self.probe_interval > 0:
+            self._probe_task = asyncio.get_running_loop().create_task(self._probe_loop(ping))
+
+    async def close(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            await asyncio.gather(self._probe_task, return_exceptions=True)
+            self._probe_task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "tools_indexed": len(self.tool_servers),
+            "servers": {
+                server_name: {replica.url: replica.stats() for replica in replicas}
+                for server_name, replicas in self.replicas.items()
+            },
+        }
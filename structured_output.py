@@ -0,0 +1,179 @@
+# structured_output.py
+
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+from tool_catalog import compact_schema
+
+JSON_TYPES = {
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+    "array": list,
+    "object": dict,
+    "null": type(None),
+}
+
+
+def _has_ref(schema: Any) -> bool:
+    if isinstance(schema, dict):
+        return "$ref" in schema or any(_has_ref(v) for v in schema.values())
+    if isinstance(schema, list):
+        return any(_has_ref(v) for v in schema)
+    return False
+
+
+def build_routing_schema(tools: List[Any], max_calls: int = 1) -> Dict[str, Any]:
+    """
+    JSON Schema ответа выбора инструмента для параметра format Ollama:
+    имя — одно из переданных инструментов, args — по inputSchema этого инструмента.
+    При max_calls > 1 допускается и план {"calls": [...]} из нескольких независимых вызовов
+    """
+    variants = []
+    for tool in tools:
+        args_schema = compact_schema(getattr(tool, "inputSchema", None) or {})
+        # Ссылки на $defs внутри anyOf грамматика Ollama не разбирает
+        if not args_schema or _has_ref(args_schema):
+            args_schema = {"type": "object"}
+        variants.append({
+            "type": "object",
+            "properties": {
+                "function": {"type": "string", "enum": [tool.name]},
+                "args": args_schema,
+            },
+            "required": ["function", "args"],
+        })
+    call_schema = variants[0] if len(variants) == 1 else {"anyOf": variants}
+    if max_calls <= 1:
+        return call_schema
+    plan_schema = {
+        "type": "object",
+        "properties": {
+            "calls": {"type": "array", "items": call_schema, "minItems": 2, "maxItems": max_calls},
+        },
+        "required": ["calls"],
+    }
+    return {"anyOf": variants + [plan_schema]}
+
+
+class JsonObjectScanner:
+    """
+    Инкрементальный разбор ответа модели: находит первый JSON-объект верхнего уровня
+    и сообщает, как только он закрылся, чтобы не ждать (и не оплачивать) хвост генерации
+    """
+
+    def __init__(self):
+        self.buffer: List[str] = []
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escape = False
+        self.complete = False
+
+    def feed(self, text: str) -> bool:
+        """Добавляет кусок ответа. Возвращает True, когда объект закрыт"""
+        for char in text:
+            if self.complete:
+                break
+            if not self.started:
+                if char != "{":
+                    continue
+                self.started = True
+            self.buffer.append(char)
+
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char == "{":
+                self.depth += 1
+            elif char == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.complete = True
+        return self.complete
+
+    def result(self) -> Optional[Dict[str, Any]]:
+        if not self.complete:
+            return None
+        try:
+            value = json.loads("".join(self.buffer))
+        except json.JSONDecodeError:
+            return None
+        return value if isinstance(value, dict) else None
+
+
+def extract_json_object(text: str) -> Optional[Dict[str, Any]]:
+    """Первый полный JSON-объект в тексте"""
+    scanner = JsonObjectScanner()
+    scanner.feed(text)
+    return scanner.result()
+
+
+def _coerce(value: Any, expected: str) -> Tuple[Any, bool]:
+    """Безопасное приведение типов, которые маленькие модели часто путают ("3" вместо 3)"""
+    if expected in ("number", "integer") and isinstance(value, str):
+        try:
+            number = float(value.strip())
+        except ValueError:
+            return value, False
+        if expected == "integer":
+            if not number.is_integer():
+                return value, False
+            return int(number), True
+        return (int(number) if number.is_integer() else number), True
+    if expected == "string" and isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value), True
+    if expected == "integer" and isinstance(value, float) and value.is_integer():
+        return int(value), True
+    return value, False
+
+
+def _matches(value: Any, expected: str) -> bool:
+    if expected in ("integer", "number") and isinstance(value, bool):
+        return False
+    python_type = JSON_TYPES.get(expected)
+    return python_type is None or isinstance(value, python_type)
+
+
+def validate_args(args: Any, schema: Dict[str, Any]) -> Tuple[Dict[str, Any], List[str]]:
+    """
+    Проверяет аргументы по inputSchema инструмента (обязательные поля, типы, enum).
+    Возвращает аргументы с приведёнными типами и список ошибок
+    """
+    if not isinstance(args, dict):
+        return {}, ["args должен быть объектом"]
+
+    schema = schema or {}
+    properties = schema.get("properties", {})
+    errors = []
+    result = dict(args)
+
+    for name in schema.get("required", []):
+        if name not in result:
+            errors.append(f"не указан обязательный параметр '{name}'")
+
+    for name, value in args.items():
+        prop = properties.get(name)
+        if prop is None:
+            if schema.get("additionalProperties") is False:
+                errors.append(f"неизвестный параметр '{name}'")
+            continue
+
+        expected = prop.get("type")
+        if isinstance(expected, str) and not _matches(value, expected):
+            value, coerced = _coerce(value, expected)
+            if not coerced:
+                errors.append(f"параметр '{name}' должен иметь тип {expected}")
+            result[name] = value
+
+        if "enum" in prop and value not in prop["enum"]:
+            errors.append(f"параметр '{name}' должен быть одним из {prop['enum']}")
+
+    return result, errors
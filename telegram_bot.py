@@ -1,8 +1,11 @@
 # telegram_bot.py
 
 import os
+import json
+import time
 import logging
 import asyncio
+import uuid
 from aiogram import Bot, Dispatcher, types
 from aiogram.types import Message
 from aiogram.enums import ParseMode
@@ -11,11 +14,19 @@ import httpx
 from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
 from dotenv import load_dotenv
 
+from config import AGENT_CLIENT_TIMEOUT, AGENT_STREAM_READ_TIMEOUT
+
 # --- Загружаем переменные окружения ---
 load_dotenv()
 
 # --- Конфигурация ---
 AGENT_API_URL = "http://localhost:8000/query"
+AGENT_STREAM_URL = "http://localhost:8000/query/stream"
+# Потоковый режим: ответ редактируется по мере генерации
+AGENT_STREAMING = os.getenv("AGENT_STREAMING", "1") == "1"
+# Не чаще одного редактирования сообщения за столько секунд (лимиты Telegram)
+STREAM_EDIT_INTERVAL = 1.5
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 
 if not TELEGRAM_BOT_TOKEN:
@@ -29,6 +40,14 @@ logger = logging.getLogger("TelegramBot")
 bot = Bot(token=TELEGRAM_BOT_TOKEN)
 dp = Dispatcher()
 
+# Заголовок, по которому агент связывает свои логи и метрики с сообщением
+REQUEST_ID_HEADER = "X-Request-ID"
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
 # --- Повторные попытки подключения к агенту ---
 @retry(
     stop=stop_after_attempt(3),
@@ -36,34 +55,111 @@ dp = Dispatcher()
     retry=retry_if_exception_type((httpx.ConnectError, httpx.ReadTimeout)),
     reraise=True
 )
-async def send_to_agent(user_input: str) -> dict:
+async def send_to_agent(user_input: str, request_id: str) -> dict:
     """Отправляет запрос в MCP-агент с retry и таймаутами"""
-    async with httpx.AsyncClient(timeout=90.0) as client:
-        logger.debug(f"Sending to agent: {user_input}")
-        response = await client.post(AGENT_API_URL, json={"user_input": user_input})
+    async with httpx.AsyncClient(timeout=AGENT_CLIENT_TIMEOUT) as client:
+        logger.debug(f"[{request_id}] Sending to agent: {user_input}")
+        response = await client.post(
+            AGENT_API_URL, json={"user_input": user_input}, headers={REQUEST_ID_HEADER: request_id}
+        )
         response.raise_for_status()
         return response.json()
 
 
+def overloaded_text(response: httpx.Response):
+    """Агент перегружен и отказал сразу — повторять запрос бессмысленно"""
+    if response.status_code in (429, 503):
+        retry_after = response.headers.get("Retry-After")
+        suffix = f" через {retry_after} сек." if retry_after else " позже"
+        return f"Сервер перегружен, попробуйте{suffix}"
+    return None
+
+
+async def stream_from_agent(user_input: str, request_id: str):
+    """Читает SSE-события из /query/stream"""
+    timeout = httpx.Timeout(connect=10.0, read=AGENT_STREAM_READ_TIMEOUT, write=10.0, pool=10.0)
+    async with httpx.AsyncClient(timeout=timeout) as client:
+        async with client.stream("POST", AGENT_STREAM_URL, json={"user_input": user_input},
+                                 headers={REQUEST_ID_HEADER: request_id}) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if line.startswith("data: "):
+                    yield json.loads(line[len("data: "):])
+
+
+async def edit_reply(reply_message: Message, text: str, shown: str) -> str:
+    """Редактирует ответ, если текст изменился. Возвращает текст, который сейчас показан"""
+    text = text[:TELEGRAM_MAX_MESSAGE_LENGTH]
+    if not text.strip() or text == shown:
+        return shown
+    try:
+        await reply_message.edit_text(text)
+        return text
+    except Exception as e:
+        # Например, "message is not modified" или flood control
+        logger.debug(f"Не удалось отредактировать сообщение: {e}")
+        return shown
+
+
+async def handle_message_stream(message: Message, request_id: str):
+    """Отвечает сразу и дописывает ответ по мере прихода токенов от агента"""
+    shown = "Выбираю инструмент…"
+    reply_message = await message.reply(shown)
+    text = ""
+    last_edit = time.monotonic()
+
+    try:
+        async for event in stream_from_agent(message.text, request_id):
+            kind = event.get("event")
+            if kind == "tool":
+                shown = await edit_reply(reply_message, f"Запрашиваю данные: {event.get('tool_name')}…", shown)
+            elif kind == "token":
+                text += event.get("text", "")
+                if time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL:
+                    shown = await edit_reply(reply_message, text, shown)
+                    last_edit = time.monotonic()
+            elif kind in ("done", "error"):
+                text = event.get("reply") or text or "Нет ответа"
+    except httpx.HTTPStatusError as e:
+        logger.error(f"[{request_id}] Ошибка сервера при запросе к агенту: {e.response.status_code}")
+        text = overloaded_text(e.response) or f"Ошибка сервера: {e.response.status_code}"
+    except httpx.ReadTimeout:
+        logger.warning(f"[{request_id}] Таймаут при ожидании ответа от агента")
+        text = text or "Сервер слишком долго не отвечает"
+    except Exception as e:
+        logger.error(f"[{request_id}] Неизвестная ошибка: {e}", exc_info=True)
+        text = text or "Произошла внутренняя ошибка"
+
+    await edit_reply(reply_message, text, shown)
+
+
 @dp.message()
 async def handle_message(message: Message):
     user_input = message.text
-    logger.info(f"Получено от пользователя: {user_input}")
+    # Тот же идентификатор попадает в логи агента — по нему сообщение прослеживается целиком
+    request_id = new_request_id()
+    logger.info(f"[{request_id}] Получено от пользователя: {user_input}")
+
+    if AGENT_STREAMING:
+        await handle_message_stream(message, request_id)
+        logger.info(f"[{request_id}] Ответ отправлен")
+        return
 
     try:
-        reply_data = await send_to_agent(user_input)
+        reply_data = await send_to_agent(user_input, request_id)
         reply_text = reply_data.get("reply", "Нет ответа")
     except httpx.HTTPStatusError as e:
-        logger.error(f"Ошибка сервера при запросе к агенту: {e.response.status_code} - {e.response.text()}")
-        reply_text = f"Ошибка сервера: {e.response.status_code}"
+        logger.error(f"[{request_id}] Ошибка сервера при запросе к агенту: {e.response.status_code} - {e.response.text}")
+        reply_text = overloaded_text(e.response) or f"Ошибка сервера: {e.response.status_code}"
     except httpx.ReadTimeout:
-        logger.warning("Таймаут при ожидании ответа от агента")
+        logger.warning(f"[{request_id}] Таймаут при ожидании ответа от агента")
         reply_text = "Сервер слишком долго не отвечает"
     except Exception as e:
-        logger.error(f"Неизвестная ошибка: {e}", exc_info=True)
+        logger.error(f"[{request_id}] Неизвестная ошибка: {e}", exc_info=True)
         reply_text = "Произошла внутренняя ошибка"
 
     await message.reply(reply_text)
+    logger.info(f"[{request_id}] Ответ отправлен")
 
 
 async def main():
@@ -0,0 +1,94 @@
+# tests/test_llm_scheduler.py
+
+import asyncio
+
+import pytest
+
+from llm_scheduler import PRIORITY_ROUTING, PRIORITY_SUMMARIZE, LLMScheduler, SchedulerOverloaded
+
+
+async def job(scheduler: LLMScheduler, priority: int, seconds: float, done: list = None, name: str = ""):
+    async with scheduler.slot(priority):
+        await asyncio.sleep(seconds)
+    if done is not None:
+        done.append(name)
+
+
+def test_waits_for_slot_without_predicted_shedding():
+    async def scenario():
+        # Средняя генерация (0.3 с) дольше дедлайна ожидания routing (0.2 с), но слот освободится раньше
+        scheduler = LLMScheduler(1, 8, {"routing": 0.2, "summarize": 5})
+        await job(scheduler, PRIORITY_SUMMARIZE, 0.3)
+        running = asyncio.create_task(job(scheduler, PRIORITY_SUMMARIZE, 0.3))
+        await asyncio.sleep(0.15)
+        await job(scheduler, PRIORITY_ROUTING, 0.01)
+        await running
+        return scheduler.shed
+
+    assert asyncio.run(scenario()) == {"queue_full": 0, "deadline": 0, "predicted": 0}
+
+
+def test_predicted_wait_counts_elapsed_time_of_active_generation():
+    async def scenario():
+        scheduler = LLMScheduler(1, 8, {"routing": 0.2, "summarize": 5}, shed_predicted=True)
+        await job(scheduler, PRIORITY_SUMMARIZE, 0.3)
+        running = asyncio.create_task(job(scheduler, PRIORITY_SUMMARIZE, 0.3))
+        await asyncio.sleep(0.02)
+        # Генерация только началась: ждать ~0.28 с больше дедлайна — отказ сразу
+        with pytest.raises(SchedulerOverloaded) as error:
+            await job(scheduler, PRIORITY_ROUTING, 0.01)
+        assert error.value.retry_after > 0.2
+        await asyncio.sleep(0.2)
+        # Осталось ~0.08 с — запрос дожидается слота
+        await job(scheduler, PRIORITY_ROUTING, 0.01)
+        await running
+        return scheduler.shed
+
+    assert asyncio.run(scenario()) == {"queue_full": 0, "deadline": 0, "predicted": 1}
+
+
+def test_deadline_exceeded_while_waiting():
+    async def scenario():
+        scheduler = LLMScheduler(1, 8, {"routing": 0.05})
+        running = asyncio.create_task(job(scheduler, PRIORITY_SUMMARIZE, 0.2))
+        await asyncio.sleep(0)
+        with pytest.raises(SchedulerOverloaded):
+            await job(scheduler, PRIORITY_ROUTING, 0.01)
+        await running
+        # Слот не потерян: следующий запрос получает его сразу
+        await asyncio.wait_for(job(scheduler, PRIORITY_ROUTING, 0.01), 0.1)
+        return scheduler
+
+    scheduler = asyncio.run(scenario())
+    assert scheduler.shed["deadline"] == 1
+    assert scheduler.stats()["active"] == 0
+
+
+def test_queue_full_rejects_immediately():
+    async def scenario():
+        scheduler = LLMScheduler(1, 1, {})
+        running = asyncio.create_task(job(scheduler, PRIORITY_SUMMARIZE, 0.1))
+        await asyncio.sleep(0)
+        waiting = asyncio.create_task(job(scheduler, PRIORITY_SUMMARIZE, 0.01))
+        await asyncio.sleep(0)
+        with pytest.raises(SchedulerOverloaded):
+            await job(scheduler, PRIORITY_ROUTING, 0.01)
+        await asyncio.gather(running, waiting)
+        return scheduler.shed["queue_full"]
+
+    assert asyncio.run(scenario()) == 1
+
+
+def test_routing_served_before_waiting_summarize():
+    async def scenario():
+        scheduler = LLMScheduler(1, 8, {})
+        done = []
+        running = asyncio.create_task(job(scheduler, PRIORITY_SUMMARIZE, 0.05))
+        await asyncio.sleep(0)
+        summarize = asyncio.create_task(job(scheduler, PRIORITY_SUMMARIZE, 0.01, done, "summarize"))
+        await asyncio.sleep(0)
+        routing = asyncio.create_task(job(scheduler, PRIORITY_ROUTING, 0.01, done, "routing"))
+        await asyncio.gather(running, summarize, routing)
+        return done
+
+    assert asyncio.run(scenario()) == ["routing", "summarize"]
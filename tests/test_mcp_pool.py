@@ -0,0 +1,63 @@
+# tests/test_mcp_pool.py
+
+import asyncio
+
+import pytest
+
+from mcp_pool import MCPSessionPool, SessionConnectError
+from server_registry import ServerRegistry
+
+SERVERS = {"openproject": {"urls": ["http://a/mcp", "http://b/mcp"]}}
+
+
+class FakeClient:
+    """Сессия, которая обрывается на первом вызове инструмента"""
+
+    def __init__(self, calls):
+        self.calls = calls
+
+    def is_connected(self):
+        return True
+
+    async def __aexit__(self, *exc):
+        pass
+
+    async def call_tool(self, tool_name, args, progress_handler=None):
+        self.calls.append(tool_name)
+        if len(self.calls) == 1:
+            raise ConnectionError("session terminated")
+        return "ok"
+
+
+def _make_pool(calls, down=()):
+    registry = ServerRegistry(SERVERS, failure_threshold=3, reset_timeout=30, probe_interval=0, probe_timeout=1)
+    pool = MCPSessionPool(registry, SERVERS, max_sessions_per_server=2, connect_timeout=1)
+    for url, server_pool in pool.pools.items():
+        async def connect(url=url):
+            if url in down:
+                raise SessionConnectError(f"Can't connect to {url}")
+            return FakeClient(calls)
+        server_pool._connect = connect
+    return pool
+
+
+def test_idempotent_call_is_retried_after_dropped_session():
+    calls = []
+    result = asyncio.run(_make_pool(calls).call_tool("openproject", "openproject-list-projects", {}, idempotent=True))
+    assert result == "ok"
+    assert calls == ["openproject-list-projects", "openproject-list-projects"]
+
+
+def test_non_idempotent_call_is_not_retried():
+    calls = []
+    with pytest.raises(ConnectionError):
+        asyncio.run(_make_pool(calls).call_tool("openproject", "openproject-create-task", {}))
+    assert calls == ["openproject-create-task"]
+
+
+def test_warm_up_opens_one_session_per_available_replica():
+    pool = _make_pool([], down=("http://b/mcp",))
+    asyncio.run(pool.warm_up())
+    stats = pool.stats()
+    assert stats["http://a/mcp"]["idle"] == 1
+    assert stats["http://b/mcp"]["idle"] == 0
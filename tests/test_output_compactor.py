@@ -0,0 +1,52 @@
+# tests/test_output_compactor.py
+
+import json
+
+from output_compactor import OutputCompactor
+
+POLICY = {"items_path": "_embedded.elements", "drop_fields": ["_links"]}
+
+
+def _compactor(stream_min_chars=1_000_000):
+    return OutputCompactor(token_budget=200, chunk_tokens=20, stream_min_chars=stream_min_chars, chars_per_token=3)
+
+
+def _work_packages(count):
+    return json.dumps({
+        "total": count,
+        "_links": {"self": {"href": "/api/v3/work_packages"}},
+        "_embedded": {"elements": [
+            {"id": i, "subject": f"Задача {i}", "_links": {"self": {"href": f"/api/v3/work_packages/{i}"}}}
+            for i in range(count)
+        ]},
+    }, ensure_ascii=False)
+
+
+def test_small_json_keeps_records_and_drops_fields():
+    compacted = _compactor().compact("list_tasks", POLICY, "задачи", [_work_packages(3)])
+    assert '"subject":"Задача 2"' in compacted
+    assert "_links" not in compacted
+
+
+def test_streaming_parse_matches_small_input_and_filters_envelope():
+    text = _work_packages(3)
+    small = _compactor().compact("list_tasks", POLICY, "задачи", [text])
+    streaming = _compactor(stream_min_chars=1)
+    assert streaming.compact("list_tasks", POLICY, "задачи", [text]) == small
+    assert streaming.streamed == 1
+
+
+def test_large_json_is_cut_to_budget_with_relevant_records():
+    compactor = _compactor()
+    compacted = compactor.compact("list_tasks", POLICY, "задача 42", [_work_packages(100)])
+    assert '"id":42' in compacted
+    assert "записей, наиболее относящихся к запросу" in compacted
+    assert compactor.tokens_after <= compactor.token_budget + 50
+
+
+def test_non_json_with_bracket_falls_back_to_text():
+    log = "\n".join(f"[INFO] шаг {i} выполнен" for i in range(200))
+    compactor = _compactor(stream_min_chars=1)
+    compacted = compactor.compact("logs", {}, "шаг 150", [log])
+    assert "шаг 150 выполнен" in compacted
+    assert compactor.chunks_total > 1
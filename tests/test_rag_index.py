@@ -0,0 +1,98 @@
+# tests/test_rag_index.py
+
+import asyncio
+import os
+
+import pytest
+
+from rag_index import Embedder, RagIndex
+
+EMBEDDER = Embedder("hash", hash_dim=64)
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def reindex(index: RagIndex, docs: str):
+    return asyncio.run(index.reindex(docs, EMBEDDER, chunk_tokens=50, chars_per_token=3))
+
+
+def search(index: RagIndex, text: str, k: int = 1):
+    query = asyncio.run(EMBEDDER.embed([text], query=True))[0]
+    return index.search(query, k)
+
+
+@pytest.fixture
+def docs(tmp_path):
+    root = tmp_path / "docs"
+    write(str(root / "team.md"), "Аналитик проекта Дмитрий Гришаев")
+    write(str(root / "api" / "openproject.md"), "OpenProject хранит задачи и проекты")
+    write(str(root / "skip.pdf"), "не индексируется")
+    return str(root)
+
+
+def test_reindex_only_changed_files(tmp_path, docs):
+    index = RagIndex(str(tmp_path / "index"))
+    first = reindex(index, docs)
+    assert (first["added_files"], first["added_chunks"]) == (2, 2)
+
+    assert reindex(index, docs)["added_files"] == 0
+
+    # Тот же текст с новым mtime — без пересчёта векторов
+    os.utime(os.path.join(docs, "team.md"), (1, 1))
+    assert reindex(index, docs)["added_chunks"] == 0
+
+    write(os.path.join(docs, "team.md"), "Руководитель проекта Ваганов Алексей")
+    changed = reindex(index, docs)
+    assert (changed["added_chunks"], changed["removed_chunks"]) == (1, 1)
+    assert search(index, "руководитель Ваганов")[0][:2] == ("team.md", "Руководитель проекта Ваганов Алексей")
+
+
+def test_removed_file_disappears_from_search(tmp_path, docs):
+    index = RagIndex(str(tmp_path / "index"))
+    reindex(index, docs)
+    os.remove(os.path.join(docs, "api", "openproject.md"))
+    assert reindex(index, docs)["removed_files"] == 1
+    assert [source for source, _, _ in search(index, "OpenProject задачи", k=5)] == ["team.md"]
+
+
+def test_index_survives_restart_without_reembedding(tmp_path, docs):
+    reindex(RagIndex(str(tmp_path / "index")), docs)
+    reopened = RagIndex(str(tmp_path / "index"))
+    assert reopened.load()
+    assert search(reopened, "аналитик Гришаев")[0][0] == "team.md"
+    assert reindex(reopened, docs)["added_chunks"] == 0
+
+
+def test_compaction_rewrites_index_without_deleted_chunks(tmp_path, docs):
+    index = RagIndex(str(tmp_path / "index"), compact_ratio=0.3)
+    reindex(index, docs)
+    generation = index.view.meta["generation"]
+    write(os.path.join(docs, "team.md"), "Разработчик Дмитрий Акинфиев")
+    reindex(index, docs)
+
+    stats = index.stats()
+    assert index.view.meta["generation"] == generation + 1
+    assert (stats["chunks"], stats["deleted_chunks"]) == (2, 0)
+    assert search(index, "разработчик Акинфиев")[0][1] == "Разработчик Дмитрий Акинфиев"
+    # Файлы прежнего поколения удалены
+    assert not any(name.endswith(f".{generation}.f32") for name in os.listdir(tmp_path / "index"))
+
+
+def test_ivf_search_finds_same_passage(tmp_path, docs):
+    for i in range(40):
+        write(os.path.join(docs, f"note{i}.md"), f"заметка номер {i} про тему{i}")
+    index = RagIndex(str(tmp_path / "index"), ivf_min_rows=10, nprobe=64)
+    reindex(index, docs)
+    assert index.stats()["ivf_lists"] > 1
+    assert search(index, "заметка про тему17")[0][0] == "note17.md"
+
+
+def test_other_embedder_dimension_returns_nothing(tmp_path, docs):
+    index = RagIndex(str(tmp_path / "index"))
+    reindex(index, docs)
+    query = asyncio.run(Embedder("hash", hash_dim=32).embed(["аналитик"], query=True))[0]
+    assert index.search(query, 3) == []
@@ -0,0 +1,32 @@
+# tests/test_response_cache.py
+
+import pytest
+
+from response_cache import ResponseCache, normalize_query
+
+
+@pytest.mark.parametrize("first, second", [
+    ("сколько будет 5+3", "сколько будет 5-3"),
+    ("сколько будет 5*3", "сколько будет 5/3"),
+    ("сколько будет 5+3", "сколько будет 5 3"),
+    ("температура -5", "температура 5"),
+    ("сложи 2.5 и 3", "сложи 25 и 3"),
+    ("сложи 2,5 и 3", "сложи 25 и 3"),
+])
+def test_different_questions_do_not_collide(first, second):
+    assert normalize_query(first) != normalize_query(second)
+    assert ResponseCache.make_key("v1", first)[0] != ResponseCache.make_key("v1", second)[0]
+
+
+@pytest.mark.parametrize("first, second", [
+    ("Кто участники проекта?", "кто участники проекта"),
+    ("  Кто   участники  проекта!!! ", "кто участники проекта"),
+    ("Покажи «задачи» проекта.", "покажи задачи проекта"),
+    ("Ещё задачи", "еще задачи"),
+])
+def test_same_question_shares_key(first, second):
+    assert normalize_query(first) == normalize_query(second)
+
+
+def test_key_depends_on_catalog_version():
+    assert ResponseCache.make_key("v1", "кто участники")[0] != ResponseCache.make_key("v2", "кто участники")[0]
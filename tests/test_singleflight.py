@@ -0,0 +1,34 @@
+# tests/test_singleflight.py
+
+import asyncio
+
+from response_cache import flight_key
+from singleflight import SingleFlight
+
+
+async def _ask_all(queries):
+    flights = SingleFlight()
+
+    async def answer(query):
+        await asyncio.sleep(0.01)
+        return f"ответ на {query}"
+
+    replies = await asyncio.gather(*(flights.do(flight_key(q), lambda q=q: answer(q)) for q in queries))
+    return replies, flights
+
+
+def test_queries_differing_in_operator_are_not_coalesced():
+    replies, flights = asyncio.run(_ask_all(["сколько будет 5+3", "сколько будет 5-3", "сколько будет 5*3"]))
+    assert replies == ["ответ на сколько будет 5+3", "ответ на сколько будет 5-3", "ответ на сколько будет 5*3"]
+    assert flights.coalesced == 0
+
+
+def test_queries_differing_in_case_and_spaces_are_coalesced():
+    replies, flights = asyncio.run(_ask_all(["Кто участники проекта", "кто  участники проекта "]))
+    assert replies[0] == replies[1]
+    assert flights.calls == 1 and flights.coalesced == 1
+
+
+def test_flight_key_is_stricter_than_cache_key():
+    assert flight_key("температура -5") != flight_key("температура 5")
+    assert flight_key("Кто участники?") != flight_key("кто участники")
@@ -0,0 +1,53 @@
+# tests/test_tool_router.py
+
+from types import SimpleNamespace
+
+from tool_router import extract_trivial_args
+
+LIST_WORK_PACKAGES = SimpleNamespace(
+    name="openproject-list-work-packages",
+    description="Список задач проекта",
+    inputSchema={
+        "type": "object",
+        "properties": {
+            "project_id": {"type": "integer", "description": "ID проекта"},
+            "status": {"type": "string", "title": "Статус", "enum": ["открыта", "просрочены", "закрыта"]},
+        },
+    },
+)
+ASK = SimpleNamespace(
+    name="ask_llama3",
+    inputSchema={"type": "object", "properties": {"question": {"type": "string"}}, "required": ["question"]},
+)
+NO_PARAMS = SimpleNamespace(name="get_current_time", inputSchema={"type": "object", "properties": {}})
+
+
+def test_question_param_filled_with_query():
+    assert extract_trivial_args(ASK, "Что такое MCP") == {"question": "Что такое MCP"}
+
+
+def test_tool_without_params():
+    assert extract_trivial_args(NO_PARAMS, "Который час") == {}
+
+
+def test_optional_filter_with_number_goes_to_llm():
+    assert extract_trivial_args(LIST_WORK_PACKAGES, "список задач проекта 5") is None
+
+
+def test_optional_filter_with_enum_value_goes_to_llm():
+    assert extract_trivial_args(LIST_WORK_PACKAGES, "список задач со статусом просрочены") is None
+
+
+def test_optional_filter_named_in_query_goes_to_llm():
+    assert extract_trivial_args(LIST_WORK_PACKAGES, "задачи в статусе, который я назову") is None
+
+
+def test_optional_filters_not_mentioned_use_fast_path():
+    assert extract_trivial_args(LIST_WORK_PACKAGES, "покажи все задачи") == {}
+
+
+def test_required_non_trivial_param_goes_to_llm():
+    tool = SimpleNamespace(name="add_numbers", inputSchema={
+        "properties": {"a": {"type": "number"}, "b": {"type": "number"}}, "required": ["a", "b"],
+    })
+    assert extract_trivial_args(tool, "сложи") is None
@@ -0,0 +1,120 @@
+# tool_catalog.py
+
+import hashlib
+import json
+import logging
+import math
+from typing import Any, Dict, List
+
+from tool_router import ToolIndex, tool_fingerprint
+
+logger = logging.getLogger("ToolCatalog")
+
+# Служебные ключи JSON Schema, которые ничего не дают модели, но занимают токены
+SCHEMA_NOISE_KEYS = {"title", "$schema", "additionalProperties", "default"}
+
+
+def estimate_tokens(text: str, chars_per_token: float) -> int:
+    """Грубая оценка числа токенов без токенизатора модели"""
+    return math.ceil(len(text) / chars_per_token)
+
+
+def compact_schema(schema: Any) -> Any:
+    if isinstance(schema, dict):
+        compacted = {}
+        for key, value in schema.items():
+            if key in SCHEMA_NOISE_KEYS:
+                continue
+            if key == "properties" and isinstance(value, dict):
+                # Здесь ключи — имена параметров, их не фильтруем
+                compacted[key] = {name: compact_schema(prop) for name, prop in value.items()}
+            else:
+                compacted[key] = compact_schema(value)
+        return compacted
+    if isinstance(schema, list):
+        return [compact_schema(v) for v in schema]
+    return schema
+
+
+def render_schema(input_schema: Dict[str, Any]) -> str:
+    """Компактное каноническое представление inputSchema (без пробелов, ключи отсортированы)"""
+    return json.dumps(compact_schema(input_schema or {}), ensure_ascii=False,
+                      separators=(",", ":"), sort_keys=True)
+
+
+class CatalogEntry:
+    """Заранее отрендеренное описание инструмента для промпта"""
+
+    def __init__(self, tool: Any, chars_per_token: float):
+        self.name = tool.name
+        self.fingerprint = tool_fingerprint(tool)
+        description = getattr(tool, "description", None) or "Нет описания"
+        input_schema = getattr(tool, "inputSchema", None) or {}
+        self.text = (
+            f"Инструмент: {self.name}\n"
+            f"   Описание: {description}\n"
+            f"   Параметры: {render_schema(input_schema)}\n\n"
+        )
+        self.tokens = estimate_tokens(self.text, chars_per_token)
+
+
+class ToolCatalog:
+    """
+    Каталог инструментов для промпта выбора инструмента.
+    В промпт попадают только top_k наиболее близких к запросу инструментов,
+    суммарно не больше token_budget токенов.
+    """
+
+    def __init__(self, index: ToolIndex, top_k: int, token_budget: int, chars_per_token: float):
+        self.index = index
+        self.top_k = top_k
+        self.token_budget = token_budget
+        self.chars_per_token = chars_per_token
+        self.entries: Dict[str, CatalogEntry] = {}
+        # Версия каталога меняется при любом изменении набора или описаний инструментов
+        self.version = ""
+
+    def update(self, tools_map: Dict[str, Any]) -> bool:
+        """Перерисовывает только новые и изменившиеся инструменты. Возвращает True, если каталог изменился"""
+        entries = {}
+        for name, tool in tools_map.items():
+            entry = self.entries.get(name)
+            if entry is None or entry.fingerprint != tool_fingerprint(tool):
+                entry = CatalogEntry(tool, self.chars_per_token)
+            entries[name] = entry
+        self.entries = entries
+
+        raw = "\n".join(f"{name}:{entry.fingerprint}" for name, entry in sorted(entries.items()))
+        version = hashlib.sha1(raw.encode("utf-8")).hexdigest()[:12]
+        if version == self.version:
+            return False
+        logger.info(f"Tool catalog changed: version {self.version or '-'} -> {version}, {len(entries)} tools")
+        self.version = version
+        return True
+
+    @property
+    def total_tokens(self) -> int:
+        return sum(entry.tokens for entry in self.entries.values())
+
+    def select(self, user_input: str) -> List[CatalogEntry]:
+        """Выбирает инструменты для промпта. Порядок — как в каталоге, чтобы промпт был стабильным"""
+        if len(self.entries) <= self.top_k and self.total_tokens <= self.token_budget:
+            return list(self.entries.values())
+
+        selected = set()
+        used_tokens = 0
+        for name, _score in self.index.rank(user_input):
+            entry = self.entries.get(name)
+            if entry is None:
+                continue
+            if selected and used_tokens + entry.tokens > self.token_budget:
+                continue
+            selected.add(name)
+            used_tokens += entry.tokens
+            if len(selected) >= self.top_k:
+                break
+        return [entry for name, entry in self.entries.items() if name in selected]
+
+    def stable(self) -> List[CatalogEntry]:
+        """Все инструменты в порядке имён: префикс меняется только вместе с версией каталога"""
+        return [self.entries[name] for name in sorted(self.entries)]
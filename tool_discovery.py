@@ -0,0 +1,192 @@
+# tool_discovery.py
+
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+import mcp.types
+
+from server_registry import replica_urls
+
+logger = logging.getLogger("ToolDiscovery")
+
+
+def _dump_tools(tools: List[Any]) -> List[Dict[str, Any]]:
+    return [tool.model_dump(mode="json", exclude_none=True) for tool in tools]
+
+
+class ToolDiscovery:
+    """
+    Обнаружение инструментов MCP: все серверы опрашиваются одновременно, у каждого свой таймаут.
+    Сервер, который не ответил, сохраняет последний удачный список инструментов.
+    Новый tools_map и индекс инструмент -> сервер собираются целиком и передаются в on_update
+    одной заменой; при каждом изменении растёт version и на диск пишется снимок каталога,
+    с которого сервис стартует, не дожидаясь серверов
+    """
+
+    def __init__(self, pool: Any, servers_config: Dict[str, Dict[str, Any]], timeout: float,
+                 refresh_interval: float, snapshot_path: Optional[str],
+                 on_update: Callable[[Dict[str, Any], Dict[str, str]], None]):
+        self.pool = pool
+        self.servers_config = servers_config
+        self.timeout = timeout
+        self.refresh_interval = refresh_interval
+        self.snapshot_path = snapshot_path
+        self.on_update = on_update
+        # Последний удачный список инструментов каждого сервера
+        self.server_tools: Dict[str, List[Any]] = {}
+        self.version = 0
+        self._fingerprint = ""
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._pending: Set[str] = set()
+        self._task: Optional[asyncio.Task] = None
+
+        # Статистика
+        self.refreshes = 0
+        self.snapshot_loaded = False
+        self.server_status: Dict[str, Dict[str, Any]] = {}
+
+    def _apply(self) -> bool:
+        """Собирает tools_map и индекс инструмент -> сервер и отдаёт их, если каталог изменился"""
+        payload = {name: _dump_tools(tools) for name, tools in self.server_tools.items()}
+        fingerprint = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+        if fingerprint == self._fingerprint:
+            return False
+
+        tools_map: Dict[str, Any] = {}
+        tool_servers: Dict[str, str] = {}
+        # Порядок серверов — как в конфиге; при совпадении имён побеждает более поздний сервер
+        for server_name in self.servers_config:
+            for tool in self.server_tools.get(server_name, []):
+                tools_map[tool.name] = tool
+                tool_servers[tool.name] = server_name
+        self.on_update(tools_map, tool_servers)
+        self._fingerprint = fingerprint
+        self.version += 1
+        logger.info(f"Tools catalog swapped: version {self.version}, {len(tools_map)} tools")
+        return True
+
+    def load_snapshot(self) -> bool:
+        """Каталог из снимка на диске (только серверы, которые есть в конфиге с теми же URL)"""
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return False
+        try:
+            with open(self.snapshot_path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+            for server_name, entry in snapshot.get("servers", {}).items():
+                server_config = self.servers_config.get(server_name)
+                if server_config is None or replica_urls(server_config) != entry.get("urls"):
+                    continue
+                self.server_tools[server_name] = [mcp.types.Tool.model_validate(tool) for tool in entry["tools"]]
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Can't load tools snapshot {self.snapshot_path}: {e}")
+            self.server_tools = {}
+            return False
+        if not self.server_tools:
+            return False
+
+        self.snapshot_loaded = True
+        self._apply()
+        logger.info(f"Tools loaded from snapshot {self.snapshot_path} (saved {snapshot.get('saved_at')})")
+        return True
+
+    def _save_snapshot(self, payload: Dict[str, Any]):
+        # Через временный файл: упавший на середине процесс не оставит битый снимок
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(payload, f, ensure_ascii=False)
+        os.replace(tmp_path, self.snapshot_path)
+
+    async def _discover_server(self, server_name: str) -> Optional[List[Any]]:
+        started = time.perf_counter()
+        status = self.server_status.setdefault(server_name, {"ok": 0, "errors": 0})
+        try:
+            tools = await asyncio.wait_for(self.pool.list_tools(server_name), self.timeout)
+        except asyncio.TimeoutError:
+            status["errors"] += 1
+            status["last_error"] = f"timeout after {self.timeout} s"
+            logger.error(f"Server {server_name} did not list tools in {self.timeout} s")
+            return None
+        except Exception as e:
+            status["errors"] += 1
+            status["last_error"] = str(e)
+            logger.error(f"Can't connect to server {server_name}: {e}")
+            return None
+        status["ok"] += 1
+        status["last_ok"] = time.time()
+        status["last_ms"] = round(1000 * (time.perf_counter() - started), 3)
+        for tool in tools:
+            logger.info(f"Found tool '{tool.name}' on {server_name}")
+        return list(tools)
+
+    async def refresh(self, server_names: Optional[Iterable[str]] = None) -> bool:
+        """Перечитывает инструменты серверов (по умолчанию всех). Возвращает True, если каталог изменился"""
+        names = [name for name in (server_names or self.servers_config) if name in self.servers_config]
+        async with self._lock:
+            results = await asyncio.gather(*(self._discover_server(name) for name in names))
+            for name, tools in zip(names, results):
+                if tools is not None:
+                    self.server_tools[name] = tools
+            self.refreshes += 1
+            changed = self._apply()
+
+        if changed and self.snapshot_path:
+            payload = {
+                "saved_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "version": self.version,
+                "servers": {
+                    name: {"urls": replica_urls(self.servers_config[name]), "tools": _dump_tools(tools)}
+                    for name, tools in self.server_tools.items()
+                },
+            }
+            try:
+                await asyncio.to_thread(self._save_snapshot, payload)
+            except OSError as e:
+                logger.warning(f"Can't save tools snapshot {self.snapshot_path}: {e}")
+        return changed
+
+    def request_refresh(self, server_name: str):
+        """Внеочередное обновление сервера (notifications/tools/list_changed)"""
+        self._pending.add(server_name)
+        self._wakeup.set()
+
+    async def _refresh_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.refresh_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            names, self._pending = (self._pending or None), set()
+            try:
+                await self.refresh(names)
+            except Exception as e:
+                logger.error(f"Tools refresh failed: {e}", exc_info=True)
+
+    def start(self, refresh_now: bool = False):
+        """Фоновое обновление; refresh_now — сразу опросить серверы (сервис запущен со снимка)"""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._refresh_loop())
+        if refresh_now:
+            self._wakeup.set()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "version": self.version,
+            "refreshes": self.refreshes,
+            "snapshot_loaded": self.snapshot_loaded,
+            "servers": {
+                name: {"tools": len(self.server_tools.get(name, [])), **self.server_status.get(name, {})}
+                for name in self.servers_config
+            },
+        }
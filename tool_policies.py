@@ -0,0 +1,29 @@
+# tool_policies.py
+
+from fnmatch import fnmatchcase
+from typing import Any, Dict
+
+from config import TOOL_POLICIES
+
+
+def _specificity(pattern: str) -> int:
+    """Сколько в шаблоне обычных символов: "openproject-list-*" конкретнее "openproject-*" """
+    return sum(1 for char in pattern if char not in "*?[]")
+
+
+def get_tool_policy(tool_name: str) -> Dict[str, Any]:
+    """
+    Политика инструмента из TOOL_POLICIES.
+    Ключи могут быть шаблонами ("openproject-delete-*"). Подходящие политики сливаются от общих
+    к частным: более конкретный шаблон переопределяет поля общего, точное имя — всех шаблонов
+    """
+    matches = [
+        pattern for pattern in TOOL_POLICIES
+        if pattern != tool_name and fnmatchcase(tool_name, pattern)
+    ]
+    policy: Dict[str, Any] = {}
+    # sorted устойчив: при равной конкретности позже записанный шаблон важнее
+    for pattern in sorted(matches, key=_specificity):
+        policy.update(TOOL_POLICIES[pattern])
+    policy.update(TOOL_POLICIES.get(tool_name, {}))
+    return policy
@@ -0,0 +1,116 @@
+# tool_result_cache.py
+
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple
+
+from singleflight import SingleFlight
+
+logger = logging.getLogger("ToolResultCache")
+
+
+def canonical_args(args: Dict[str, Any]) -> str:
+    """Аргументы в каноническом виде: одинаковые по смыслу args дают один ключ"""
+    return json.dumps(args or {}, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+class ToolResultCache:
+    """
+    Кэш результатов call_tool по (инструмент, аргументы).
+    TTL задаётся политикой инструмента:
+      result_cache_ttl — сколько секунд результат свежий (0 — не кэшировать);
+      result_stale_ttl — сколько ещё секунд после этого отдавать устаревший
+                         результат, обновляя его в фоне (stale-while-revalidate)
+    Одновременные запросы с одним ключом разделяют один вызов MCP.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        # key -> (время получения, результат)
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[float, Any]]" = OrderedDict()
+        self.inflight = SingleFlight()
+        self._refresh_tasks: Set[asyncio.Task] = set()
+
+        # Статистика
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.uncacheable = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self.evictions = 0
+
+    async def get_or_call(self, tool_name: str, args: Dict[str, Any], policy: Dict[str, Any],
+                          call: Callable[[], Awaitable[Any]]) -> Any:
+        ttl = policy.get("result_cache_ttl", 0)
+        if ttl <= 0:
+            # Некэшируемые инструменты (в том числе с побочными эффектами) вызываются как есть
+            self.uncacheable += 1
+            return await call()
+
+        key = (tool_name, canonical_args(args))
+        entry = self._entries.get(key)
+        if entry is not None:
+            stored_at, result = entry
+            age = time.time() - stored_at
+            if age < ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return result
+            if age < ttl + policy.get("result_stale_ttl", 0):
+                self._entries.move_to_end(key)
+                self.stale_hits += 1
+                self._refresh_in_background(key, call)
+                return result
+
+        self.misses += 1
+        return await self.inflight.do(key, lambda: self._fetch(key, call))
+
+    async def _fetch(self, key: Tuple[str, str], call: Callable[[], Awaitable[Any]]) -> Any:
+        result = await call()
+        self._entries[key] = (time.time(), result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return result
+
+    def _refresh_in_background(self, key: Tuple[str, str], call: Callable[[], Awaitable[Any]]):
+        if key in self.inflight:
+            return
+
+        async def refresh():
+            try:
+                await self.inflight.do(key, lambda: self._fetch(key, call))
+                self.refreshes += 1
+            except Exception as e:
+                self.refresh_errors += 1
+                logger.warning(f"Background refresh of {key[0]} failed: {e}")
+
+        task = asyncio.create_task(refresh())
+        self._refresh_tasks.add(task)
+        task.add_done_callback(self._refresh_tasks.discard)
+
+    def purge(self, tool_name: Optional[str] = None) -> int:
+        keys = [key for key in self._entries if tool_name is None or key[0] == tool_name]
+        for key in keys:
+            del self._entries[key]
+        logger.info(f"Tool result cache purged: {len(keys)} entries (tool={tool_name})")
+        return len(keys)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "uncacheable": self.uncacheable,
+            "refreshes": self.refreshes,
+            "refresh_errors": self.refresh_errors,
+            "evictions": self.evictions,
+            "coalesced": self.inflight.coalesced,
+        }
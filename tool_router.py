@@ -0,0 +1,230 @@
+# tool_router.py
+
+import hashlib
+import json
+import logging
+import math
+import re
+import time
+import zlib
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+logger = logging.getLogger("ToolRouter")
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+# Имена строковых параметров, которые можно заполнить самим текстом запроса
+TRIVIAL_ARG_NAMES = {"question", "query", "text", "q", "prompt", "вопрос"}
+# Признаки того, что запрос задаёт значение параметра: число или строка в кавычках
+NUMBER_RE = re.compile(r"\d")
+QUOTED_RE = re.compile(r"[\"«“'][^\"»”']+[\"»”']")
+# Сколько первых букв слова сравнивать (окончания русских слов меняются)
+STEM_LENGTH = 5
+
+
+def text_features(text: str) -> List[str]:
+    """
+    Признаки текста: слова и символьные триграммы слов.
+    Триграммы сглаживают русскую морфологию ("участники" / "участниках")
+    """
+    features = []
+    for word in WORD_RE.findall(text.lower().replace("_", " ")):
+        features.append(word)
+        padded = f"<{word}>"
+        features.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+    return features
+
+
+def embed_text(text: str, dim: int) -> np.ndarray:
+    """Хэшированный вектор признаков (sublinear tf), нормированный по L2"""
+    counts: Dict[int, int] = {}
+    for feature in text_features(text):
+        bucket = zlib.crc32(feature.encode("utf-8")) % dim
+        counts[bucket] = counts.get(bucket, 0) + 1
+
+    vector = np.zeros(dim, dtype=np.float32)
+    for bucket, count in counts.items():
+        vector[bucket] = 1.0 + math.log(count)
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    return vector
+
+
+def tool_document(tool: Any) -> str:
+    """Текст, по которому индексируется инструмент: имя, описание и параметры"""
+    parts = [tool.name, getattr(tool, "description", None) or ""]
+    input_schema = getattr(tool, "inputSchema", None) or {}
+    for prop_name, prop in input_schema.get("properties", {}).items():
+        parts.append(prop_name)
+        if isinstance(prop, dict):
+            parts.append(prop.get("title", "") or "")
+            parts.append(prop.get("description", "") or "")
+    return "\n".join(p for p in parts if p)
+
+
+def tool_fingerprint(tool: Any) -> str:
+    input_schema = getattr(tool, "inputSchema", None) or {}
+    raw = json.dumps(
+        [tool.name, getattr(tool, "description", None), input_schema],
+        sort_keys=True, ensure_ascii=False, default=str
+    )
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class ToolIndex:
+    """
+    Векторный индекс инструментов для быстрого сопоставления с запросом.
+    Векторы считаются один раз на инструмент и пересчитываются только
+    для изменившихся инструментов.
+    """
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.names: List[str] = []
+        self.matrix = np.zeros((0, dim), dtype=np.float32)
+        self._vectors: Dict[str, np.ndarray] = {}
+        self._fingerprints: Dict[str, str] = {}
+
+    def update(self, tools_map: Dict[str, Any]) -> bool:
+        """Инкрементально обновляет индекс под текущий каталог. Возвращает True, если он изменился"""
+        changed = False
+        for name in list(self._vectors):
+            if name not in tools_map:
+                del self._vectors[name]
+                del self._fingerprints[name]
+                changed = True
+
+        for name, tool in tools_map.items():
+            fingerprint = tool_fingerprint(tool)
+            if self._fingerprints.get(name) == fingerprint:
+                continue
+            self._vectors[name] = embed_text(tool_document(tool), self.dim)
+            self._fingerprints[name] = fingerprint
+            changed = True
+
+        if changed or len(self.names) != len(self._vectors):
+            self.names = list(self._vectors)
+            self.matrix = np.vstack([self._vectors[n] for n in self.names]) if self.names \
+                else np.zeros((0, self.dim), dtype=np.float32)
+            logger.info(f"Tool index rebuilt: {len(self.names)} tools")
+        return changed
+
+    def scores(self, text: str) -> np.ndarray:
+        """Косинусная близость запроса ко всем инструментам"""
+        if not self.names:
+            return np.zeros(0, dtype=np.float32)
+        return self.matrix @ embed_text(text, self.dim)
+
+    def rank(self, text: str, k: Optional[int] = None) -> List[Tuple[str, float]]:
+        scores = self.scores(text)
+        order = np.argsort(-scores)
+        if k is not None:
+            order = order[:k]
+        return [(self.names[i], float(scores[i])) for i in order]
+
+
+def _stems(text: str) -> Set[str]:
+    """Начала слов (от 4 букв): "статусом" и "статус" дают одно и то же "стату" """
+    return {word[:STEM_LENGTH] for word in WORD_RE.findall(text.lower().replace("_", " ")) if len(word) >= 4}
+
+
+def query_may_set(prop_name: str, prop: Dict[str, Any], user_input: str) -> bool:
+    """
+    Может ли запрос задавать необязательный параметр: в нём есть числа или строки в кавычках,
+    значение из enum параметра или слово из его имени или title ("со статусом ..." при title "Статус").
+    Описание не сравнивается: в нём обычно те же слова, по которым выбран инструмент ("задачи проекта")
+    """
+    if NUMBER_RE.search(user_input) or QUOTED_RE.search(user_input):
+        return True
+    query_stems = _stems(user_input)
+    items = prop.get("items") if isinstance(prop.get("items"), dict) else {}
+    for value in [*prop.get("enum", []), *items.get("enum", [])]:
+        if _stems(str(value)) & query_stems:
+            return True
+    return bool(_stems(f"{prop_name} {prop.get('title', '') or ''}") & query_stems)
+
+
+def extract_trivial_args(tool: Any, user_input: str) -> Optional[Dict[str, Any]]:
+    """
+    Аргументы, которые можно получить без LLM: обязательные параметры — только строка-вопрос,
+    которую заполняем текстом запроса, а необязательные фильтры запрос, судя по всему, не задаёт.
+    None — аргументы нужно извлекать с помощью LLM
+    """
+    input_schema = getattr(tool, "inputSchema", None) or {}
+    properties = input_schema.get("properties", {})
+    required = input_schema.get("required", [])
+    args: Dict[str, Any] = {}
+    for prop_name in required:
+        prop = properties.get(prop_name, {})
+        if prop_name.lower() not in TRIVIAL_ARG_NAMES or prop.get("type", "string") != "string":
+            return None
+        args[prop_name] = user_input
+    for prop_name, prop in properties.items():
+        if prop_name in required or prop_name.lower() in TRIVIAL_ARG_NAMES or not isinstance(prop, dict):
+            continue
+        # Фильтр вроде status или project_id: с {} ограничение пользователя молча потерялось бы
+        if query_may_set(prop_name, prop, user_input):
+            return None
+    return args
+
+
+class ToolRouter:
+    """Быстрый выбор инструмента без LLM, когда совпадение с запросом однозначное"""
+
+    def __init__(self, index: ToolIndex, min_score: float, min_margin: float):
+        self.index = index
+        self.min_score = min_score
+        self.min_margin = min_margin
+
+        # Статистика
+        self.decisions = 0
+        self.hits = 0
+        self.llm_args = 0
+        self.decision_time_total = 0.0
+
+    def route(self, user_input: str, tools_map: Dict[str, Any]) -> Optional[Tuple[str, Optional[Dict[str, Any]]]]:
+        """
+        Возвращает (инструмент, аргументы) или None, если решение должна принять LLM.
+        Аргументы None — инструмент однозначен, но аргументы из запроса нужно извлечь LLM
+        """
+        started = time.perf_counter()
+        decision = None
+        try:
+            ranked = self.index.rank(user_input, k=2)
+            if not ranked:
+                return None
+            best_name, best_score = ranked[0]
+            second_score = ranked[1][1] if len(ranked) > 1 else 0.0
+            if best_score < self.min_score or best_score - second_score < self.min_margin:
+                return None
+            tool = tools_map.get(best_name)
+            if tool is None:
+                return None
+            args = extract_trivial_args(tool, user_input)
+            if args is None:
+                self.llm_args += 1
+            decision = (best_name, args)
+            logger.info(
+                f"Fast-path route: {best_name} (score {best_score:.3f}, margin {best_score - second_score:.3f}"
+                f"{', args by LLM' if args is None else ''})"
+            )
+            return decision
+        finally:
+            self.decisions += 1
+            if decision is not None:
+                self.hits += 1
+            self.decision_time_total += time.perf_counter() - started
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "tools_indexed": len(self.index.names),
+            "decisions": self.decisions,
+            "hits": self.hits,
+            "hit_rate": round(self.hits / self.decisions, 4) if self.decisions else 0.0,
+            # Из них с аргументами от LLM (стадия arguments)
+            "llm_args": self.llm_args,
+            "avg_decision_ms": round(1000 * self.decision_time_total / self.decisions, 3) if self.decisions else 0.0,
+        }
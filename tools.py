@@ -1,9 +1,13 @@
 # tools.py
 
-from typing import Any
+from typing import Any, Dict, List, Optional
 from mcp.types import TextContent
 import json
 
+# JSON длиннее этого не переформатируется с отступами: json.loads десятков мегабайт
+# блокирует event loop, а отступы только раздувают число токенов
+PRETTY_JSON_MAX_CHARS = 100_000
+
 
 # def extract_text_content(result: Any) -> str:
 #     if isinstance(result, list) and len(result) > 0 and isinstance(result[0], TextContent):
@@ -15,11 +19,18 @@ def extract_text_content(result: Any) -> str:
     Возвращает все части текста из списка TextContent
     Если есть JSON — форматируем его
     """
+    # fastmcp >= 2.10 возвращает CallToolResult, части ответа — в .content
+    if hasattr(result, "content") and not isinstance(result, TextContent):
+        result = result.content
+
     if isinstance(result, list):
         full_text = []
         for content in result:
             if not isinstance(content, TextContent):
                 continue
+            if len(content.text) > PRETTY_JSON_MAX_CHARS:
+                full_text.append(content.text)
+                continue
             try:
                 # Если это JSON — форматируем
                 parsed = json.loads(content.text)
@@ -32,4 +43,39 @@ def extract_text_content(result: Any) -> str:
     elif isinstance(result, TextContent):
         return result.text
 
-    return str(result)
\ No newline at end of file
+    return str(result)
+
+
+def extract_text_parts(result: Any) -> List[str]:
+    """Исходные тексты частей ответа, без переформатирования"""
+    contents = getattr(result, "content", result)
+    if isinstance(contents, TextContent):
+        return [contents.text]
+    if isinstance(contents, list):
+        return [content.text for content in contents if isinstance(content, TextContent)]
+    return [str(result)]
+
+
+def extract_structured_content(result: Any) -> Optional[Dict[str, Any]]:
+    """
+    Структурированный результат инструмента (словарь) — для шаблонов ответа.
+    Берётся structured_content, иначе первая текстовая часть, если это JSON-объект
+    """
+    structured = getattr(result, "structured_content", None)
+    if isinstance(structured, dict):
+        return structured
+
+    contents = getattr(result, "content", result)
+    if isinstance(contents, TextContent):
+        contents = [contents]
+    if isinstance(contents, list):
+        for content in contents:
+            if isinstance(content, TextContent):
+                if len(content.text) > PRETTY_JSON_MAX_CHARS:
+                    return None
+                try:
+                    parsed = json.loads(content.text)
+                except json.JSONDecodeError:
+                    return None
+                return parsed if isinstance(parsed, dict) else None
+    return None
@@ -0,0 +1,179 @@
+# trace_store.py
+
+import asyncio
+import json
+import logging
+import random
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+
+logger = logging.getLogger("TraceStore")
+
+
+class Trace:
+    """Отладочные артефакты одного запроса: промпты, решения, выводы инструментов, ответы LLM"""
+
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self.events: List[Dict[str, Any]] = []
+        self.size = 0
+
+    def add(self, kind: str, value: Any, max_chars: int):
+        text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, default=str)
+        if len(text) > max_chars:
+            text = text[:max_chars] + f"… (обрезано, всего {len(text)} символов)"
+        self.events.append({
+            "t_ms": round(1000 * (time.perf_counter() - self._started), 3),
+            "kind": kind,
+            "data": text,
+        })
+        self.size += len(text)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"request_id": self.request_id, "started_at": self.started_at, "events": self.events}
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+
+
+class TraceStore:
+    """
+    Ограниченное хранилище трасс в памяти: сэмплирование запросов, лимит по числу трасс
+    и суммарному размеру (старые вытесняются), фоновая выгрузка завершённых трасс в JSONL
+    """
+
+    def __init__(self, sample_rate: float, max_traces: int, max_chars: int, max_event_chars: int,
+                 export_path: Optional[str] = None):
+        self.sample_rate = sample_rate
+        self.max_traces = max_traces
+        self.max_chars = max_chars
+        self.max_event_chars = max_event_chars
+        self.export_path = export_path
+        self._traces: "OrderedDict[str, Trace]" = OrderedDict()
+        self._size = 0
+        self._export_queue: Optional[asyncio.Queue] = None
+        self._export_task: Optional[asyncio.Task] = None
+
+        # Статистика
+        self.sampled = 0
+        self.skipped = 0
+        self.evicted = 0
+        self.exported = 0
+        self.export_errors = 0
+
+    @contextmanager
+    def trace(self, request_id: str, force: bool = False) -> Iterator[Optional[Trace]]:
+        """Трасса на время обработки запроса (None, если запрос не попал в выборку)"""
+        if not force and random.random() >= self.sample_rate:
+            self.skipped += 1
+            yield None
+            return
+
+        self.sampled += 1
+        trace = Trace(request_id)
+        previous = self._traces.pop(request_id, None)
+        if previous is not None:
+            self._size -= previous.size
+        self._traces[request_id] = trace
+        self._traces.move_to_end(request_id)
+        token = _current_trace.set(trace)
+        try:
+            yield trace
+        finally:
+            try:
+                _current_trace.reset(token)
+            except ValueError:
+                # Потоковый генератор закрыт из другого контекста (клиент отключился)
+                pass
+            self._evict()
+            self._export(trace)
+
+    def event(self, kind: str, value: Any):
+        """
+        Добавляет артефакт в трассу текущего запроса. Для несэмплированных запросов
+        ничего не форматируется и не пишется — передавайте сами объекты, а не f-строки
+        """
+        trace = _current_trace.get()
+        if trace is None:
+            return
+        before = trace.size
+        trace.add(kind, value, self.max_event_chars)
+        if self._traces.get(trace.request_id) is trace:
+            self._size += trace.size - before
+            self._evict()
+
+    def _evict(self):
+        while self._traces and (len(self._traces) > self.max_traces or self._size > self.max_chars):
+            _, trace = self._traces.popitem(last=False)
+            self._size -= trace.size
+            self.evicted += 1
+
+    def get(self, request_id: str) -> Optional[Dict[str, Any]]:
+        trace = self._traces.get(request_id)
+        return trace.to_dict() if trace is not None else None
+
+    def recent(self, limit: int = 50) -> List[Dict[str, Any]]:
+        traces = list(self._traces.values())[-limit:]
+        return [
+            {"request_id": t.request_id, "started_at": t.started_at, "events": len(t.events), "size": t.size}
+            for t in reversed(traces)
+        ]
+
+    def _export(self, trace: Trace):
+        if not self.export_path:
+            return
+        if self._export_queue is None:
+            self._export_queue = asyncio.Queue(maxsize=1000)
+            self._export_task = asyncio.get_running_loop().create_task(self._export_loop())
+        try:
+            self._export_queue.put_nowait(trace)
+        except asyncio.QueueFull:
+            self.export_errors += 1
+
+    async def _export_loop(self):
+        while True:
+            batch = [await self._export_queue.get()]
+            while not self._export_queue.empty():
+                batch.append(self._export_queue.get_nowait())
+            try:
+                # Сериализация и запись в файл — в потоке, event loop не ждёт диск
+                await asyncio.to_thread(self._write, batch)
+                self.exported += len(batch)
+            except OSError as e:
+                self.export_errors += len(batch)
+                logger.warning(f"Trace export to {self.export_path} failed: {e}")
+            finally:
+                for _ in batch:
+                    self._export_queue.task_done()
+
+    def _write(self, batch: List[Trace]):
+        lines = "".join(json.dumps(trace.to_dict(), ensure_ascii=False) + "\n" for trace in batch)
+        with open(self.export_path, "a", encoding="utf-8") as f:
+            f.write(lines)
+
+    async def close(self):
+        if self._export_task is None:
+            return
+        # Дописываем то, что уже в очереди
+        try:
+            await asyncio.wait_for(self._export_queue.join(), 5)
+        except asyncio.TimeoutError:
+            logger.warning("Trace export did not finish before shutdown")
+        self._export_task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sample_rate": self.sample_rate,
+            "traces": len(self._traces),
+            "size": self._size,
+            "sampled": self.sampled,
+            "skipped": self.skipped,
+            "evicted": self.evicted,
+            "exported": self.exported,
+            "export_errors": self.export_errors,
+        }